@@ -1,60 +1,257 @@
 from tornado.ioloop import IOLoop
 from tornado.web import Application, RequestHandler
-import json
-from datetime import datetime
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from email.utils import formatdate, parsedate_to_datetime
 import uuid
 from urllib.parse import parse_qs
+from 搜尋索引 import DEFAULT_SEARCH_PATHS, InsertionOrder, ResourceIndex, extract_values, parse_date
+from 精簡儲存 import encode_resource
+from 編解碼 import JSONDecodeError, dumps, loads
 
 class FHIRResource:
-    def __init__(self):
+    def __init__(self, search_paths=None, body_cache_size=100000):
+        # 依資源類型分區存放: {resource_type: {resource_id: resource}}
         self.resources = {}
+        # 各類型建立索引的搜尋路徑與對應索引
+        self.search_paths = DEFAULT_SEARCH_PATHS if search_paths is None else search_paths
+        self.indexes = {}
+        # 各類型的寫入順序, 作為搜尋結果的穩定排序
+        self.orders = {}
+        # 各類型單調遞增的寫入計數, create/update/delete 時遞增 (供快取失效判斷)
+        self.write_versions = {}
+        # 序列化後的回應內容: (類型, id) -> (versionId, UTF-8 位元組), 更新或刪除時移除
+        self.bodies = {}
+        self.body_cache_size = body_cache_size
+        # 寫入序列化於 commit_lock; 讀取端不持鎖, 以提交序號 (seqlock) 確認讀到一致的狀態
+        self.commit_lock = threading.RLock()
+        self.commit_sequence = 0
+        self.commit_depth = 0
+        self.read_retries = 8
+
+    def _partition(self, resource_type):
+        """取得 (必要時建立) 指定類型的資源分區"""
+        partition = self.resources.get(resource_type)
+        if partition is None:
+            partition = self.resources[resource_type] = {}
+            self.orders[resource_type] = InsertionOrder()
+        return partition
+
+    def count(self, resource_type=None):
+        """回傳資源數量, 直接取分區大小而不需掃描"""
+        if resource_type is not None:
+            return len(self.resources.get(resource_type, {}))
+        return {t: len(partition) for t, partition in self.resources.items()}
+
+    def version(self, resource_type):
+        """指定類型目前的寫入計數"""
+        return self.write_versions.get(resource_type, 0)
+
+    def _touch(self, resource_type):
+        self.write_versions[resource_type] = self.write_versions.get(resource_type, 0) + 1
+
+    def _index(self, resource_type):
+        """取得指定類型的索引, 該類型未設定搜尋路徑時回傳 None"""
+        index = self.indexes.get(resource_type)
+        if index is None and resource_type in self.search_paths:
+            index = self.indexes[resource_type] = ResourceIndex(self.search_paths[resource_type])
+        return index
+
+    def _index_resource(self, resource_type, resource_id, resource):
+        index = self._index(resource_type)
+        if index is not None:
+            index.add(resource_id, resource)
+
+    def _unindex_resource(self, resource_type, resource_id, resource):
+        index = self._index(resource_type)
+        if index is not None:
+            index.remove(resource_id, resource)
+
+    def _index_many(self, resource_type, records):
+        index = self._index(resource_type)
+        if index is not None:
+            index.add_many((resource_id, values) for resource_id, _, values, _ in records)
+
+    def read_header(self, resource_type, resource_id):
+        """回傳 (versionId, lastUpdated), 供條件式讀取判斷, 不序列化資源"""
+        resource = self.read(resource_type, resource_id)
+        if resource is None:
+            return None
+        meta = resource.get("meta") or {}
+        return meta.get("versionId"), meta.get("lastUpdated")
 
-    def create(self, resource_type, data):
-        resource_id = str(uuid.uuid4())
-        timestamp = datetime.now().isoformat()
-
+    def read_bytes(self, resource_type, resource_id):
+        """回傳資源序列化後的位元組, 同一版本只序列化一次"""
+        resource = self.read(resource_type, resource_id)
+        if resource is None:
+            return None
+        return self.resource_bytes(resource_type, resource_id, resource)
+
+    def resource_bytes(self, resource_type, resource_id, resource):
+        key = (resource_type, resource_id)
+        version_id = (resource.get("meta") or {}).get("versionId")
+        cached = self.bodies.get(key)
+        if cached is not None and cached[0] == version_id:
+            return cached[1]
+        body = encode_resource(resource)
+        if len(self.bodies) >= self.body_cache_size:
+            # 超過上限時淘汰最早放入的項目 (其他執行緒同時寫入時略過, 下次再淘汰)
+            try:
+                self.bodies.pop(next(iter(self.bodies)), None)
+            except (StopIteration, RuntimeError):
+                pass
+        self.bodies[key] = (version_id, body)
+        return body
+
+    def search_bytes(self, resource_type, params):
+        """搜尋結果序列化為位元組, 各 entry 的資源直接拼接已快取的內容"""
+        bundle = self.snapshot_read(self.search, resource_type, params)
+        entries = bundle.pop("entry", [])
+        parts = []
+        for entry in entries:
+            resource = entry.get("resource")
+            if len(entry) == 1 and resource is not None and "id" in resource:
+                body = self.resource_bytes(resource.get("resourceType"), resource["id"], resource)
+                parts.append(b'{"resource":' + body + b'}')
+            else:
+                parts.append(dumps(entry))
+        head = dumps(bundle)
+        return head[:-1] + b',"entry":[' + b','.join(parts) + b']}'
+
+    @contextmanager
+    def committing(self):
+        """寫入的臨界區 (可巢狀): 最外層期間提交序號為奇數, 讀取端據此判斷是否讀到一致的狀態"""
+        with self.commit_lock:
+            self.commit_depth += 1
+            if self.commit_depth == 1:
+                self.commit_sequence += 1
+            try:
+                yield
+            finally:
+                self.commit_depth -= 1
+                if self.commit_depth == 0:
+                    self.commit_sequence += 1
+
+    def snapshot_read(self, func, *args):
+        """不持鎖執行讀取; 期間有提交進行或完成時重試, 寫入持續不斷時改為在鎖內讀取"""
+        for _ in range(self.read_retries):
+            before = self.commit_sequence
+            if before % 2 == 0:
+                try:
+                    result = func(*args)
+                except Exception:
+                    # 讀到提交中途的狀態 (如迭代中的 dict 改變大小) 時重試, 否則照常拋出
+                    if self.commit_sequence == before:
+                        raise
+                    continue
+                if self.commit_sequence == before:
+                    return result
+            time.sleep(0)
+        with self.commit_lock:
+            return func(*args)
+
+    def build_version(self, resource_type, resource_id, data, previous=None):
+        """由用戶端資料產生新版本: versionId 接續 previous, lastUpdated 為目前時間"""
+        version = int(previous["meta"]["versionId"]) + 1 if previous is not None else 1
         resource = {
             "resourceType": resource_type,
             "id": resource_id,
             "meta": {
-                "versionId": "1",
-                "lastUpdated": timestamp
+                "versionId": str(version),
+                "lastUpdated": datetime.now(timezone.utc).isoformat()
             }
         }
         resource.update(data)
+        return resource
 
-        self.resources[f"{resource_type}/{resource_id}"] = resource
+    def _put(self, resource_type, resource_id, resource):
+        """放入已完成的資源 (保留其 id、版本與時間), 回傳先前的版本"""
+        partition = self._partition(resource_type)
+        previous = partition.get(resource_id)
+        partition[resource_id] = resource
+        if previous is None:
+            self.orders[resource_type].append(resource_id)
+        else:
+            self.bodies.pop((resource_type, resource_id), None)
+            self._unindex_resource(resource_type, resource_id, previous)
+        self._index_resource(resource_type, resource_id, resource)
+        self._touch(resource_type)
+        return previous
+
+    def _remove(self, resource_type, resource_id):
+        partition = self.resources.get(resource_type)
+        if partition is None:
+            return None
+        resource = partition.pop(resource_id, None)
+        if resource is not None:
+            self.bodies.pop((resource_type, resource_id), None)
+            self.orders[resource_type].discard(resource_id)
+            self._unindex_resource(resource_type, resource_id, resource)
+            self._touch(resource_type)
         return resource
 
-    def read(self, resource_type, resource_id):
-        key = f"{resource_type}/{resource_id}"
-        return self.resources.get(key)
+    def apply(self, changes):
+        """套用交易的寫入集合 [(類型, id, 資源)], 資源為 None 表示刪除; 回傳傳給 flush 的記號"""
+        with self.committing():
+            for resource_type, resource_id, resource in changes:
+                if resource is None:
+                    self._remove(resource_type, resource_id)
+                else:
+                    self._put(resource_type, resource_id, resource)
+        return None
 
-    def update(self, resource_type, resource_id, data):
-        key = f"{resource_type}/{resource_id}"
-        if key not in self.resources:
-            return None
+    def flush(self, token):
+        """等待 apply 的結果持久化; 記憶體模式不需等待"""
 
-        resource = self.resources[key]
-        version = int(resource["meta"]["versionId"])
-        timestamp = datetime.now().isoformat()
+    def bulk_load(self, resource_type, records):
+        """整批放入已完成的資源 (匯入用), 回傳被取代的舊版本 {id: 資源}
 
-        updated_resource = {
-            "resourceType": resource_type,
-            "id": resource_id,
-            "meta": {
-                "versionId": str(version + 1),
-                "lastUpdated": timestamp
-            }
-        }
-        updated_resource.update(data)
+        records 為 [(id, 資源, 索引值, 參照)], 索引值與參照由呼叫端預先取出 (見 bulk_record);
+        資源全部放入後才整批建立索引, 範圍索引只排序一次。已存在的資源被取代, versionId 接續舊版本。
+        """
+        replaced = {}
+        with self.committing():
+            partition = self._partition(resource_type)
+            order = self.orders[resource_type]
+            for resource_id, resource, _, _ in records:
+                previous = partition.get(resource_id)
+                if previous is None:
+                    partition[resource_id] = resource
+                    order.append(resource_id)
+                    continue
+                replaced[resource_id] = previous
+                resource["meta"]["versionId"] = str(int(previous["meta"]["versionId"]) + 1)
+                partition[resource_id] = resource
+                self.bodies.pop((resource_type, resource_id), None)
+                self._unindex_resource(resource_type, resource_id, previous)
+            self._index_many(resource_type, records)
+            self._touch(resource_type)
+        return replaced
 
-        self.resources[key] = updated_resource
-        return updated_resource
+    def create(self, resource_type, data):
+        resource_id = str(uuid.uuid4())
+        resource = self.build_version(resource_type, resource_id, data)
+        with self.committing():
+            self._put(resource_type, resource_id, resource)
+        return resource
+
+    def read(self, resource_type, resource_id):
+        return self.resources.get(resource_type, {}).get(resource_id)
+
+    def update(self, resource_type, resource_id, data):
+        with self.committing():
+            previous = self.read(resource_type, resource_id)
+            if previous is None:
+                return None
+            resource = self.build_version(resource_type, resource_id, data, previous)
+            self._put(resource_type, resource_id, resource)
+        return resource
 
     def delete(self, resource_type, resource_id):
-        key = f"{resource_type}/{resource_id}"
-        return self.resources.pop(key, None)
+        with self.committing():
+            return self._remove(resource_type, resource_id)
 
     def search(self, resource_type, params):
         """
@@ -69,14 +266,8 @@ class FHIRResource:
             page = 1
             count = 10
 
-        # 過濾指定類型的資源
-        matching_resources = [
-            resource for key, resource in self.resources.items()
-            if key.startswith(f"{resource_type}/")
-        ]
-
-        # 應用搜索條件
-        filtered_resources = self._apply_search_filters(matching_resources, params)
+        # 應用搜索條件, 只處理指定類型的分區
+        filtered_resources = self._apply_search_filters(resource_type, params)
 
         # 計算分頁
         start_index = (page - 1) * count
@@ -94,55 +285,45 @@ class FHIRResource:
             "entry": [{"resource": resource} for resource in paged_resources]
         }
 
-    def _apply_search_filters(self, resources, params):
-        """應用搜索過濾器"""
-        filtered = resources.copy()
+    def _apply_search_filters(self, resource_type, params):
+        """應用搜索過濾器, 已建索引的參數直接取倒排串列"""
+        partition = self.resources.get(resource_type, {})
+        index = self.indexes.get(resource_type)
 
         # 移除分頁參數
         search_params = {k: v for k, v in params.items() if not k.startswith('_')}
 
+        ids = None
+        residual = {}
         for param, values in search_params.items():
+            postings = index.lookup(param, "eq", values[0]) if index else None
+            if postings is None:
+                residual[param] = values
+            elif ids is None:
+                ids = set(postings)
+            else:
+                ids &= postings
+
+        if ids is None:
+            filtered = list(partition.values())
+        else:
+            # 集合沒有順序, 依寫入順序排列, 與未建索引時的結果一致
+            filtered = [partition[resource_id] for _, resource_id in self.orders[resource_type].sort(ids)]
+
+        # 未建索引的參數逐筆比對
+        for param, values in residual.items():
             filtered = self._filter_by_param(filtered, param, values[0])
 
         return filtered
 
     def _filter_by_param(self, resources, param, value):
         """根據參數過濾資源"""
-        filtered = []
-
-        for resource in resources:
-            # 處理不同類型的搜索參數
-            if '.' in param:
-                # 處理複雜的搜索參數 (如 name.given)
-                base, sub_param = param.split('.', 1)
-                if self._match_complex_param(resource, base, sub_param, value):
-                    filtered.append(resource)
-            else:
-                # 處理簡單的搜索參數
-                if self._match_simple_param(resource, param, value):
-                    filtered.append(resource)
-
-        return filtered
-
-    def _match_complex_param(self, resource, base, sub_param, value):
-        """匹配複雜參數"""
-        if base not in resource:
-            return False
+        return [resource for resource in resources if self._match_param(resource, param, value)]
 
-        if isinstance(resource[base], list):
-            # 處理陣列類型的參數 (如 name[])
-            for item in resource[base]:
-                if sub_param in item and str(item[sub_param]).lower() == value.lower():
-                    return True
-        elif isinstance(resource[base], dict):
-            # 處理物件類型的參數
-            return sub_param in resource[base] and str(resource[base][sub_param]).lower() == value.lower()
-
-        return False
-
-    def _match_simple_param(self, resource, param, value):
-        """匹配簡單參數"""
-        return param in resource and str(resource[param]).lower() == value.lower()
+    def _match_param(self, resource, param, value):
+        """匹配參數 (支援 name.given 這類巢狀路徑), 不分大小寫比對"""
+        value = value.lower()
+        return any(field.lower() == value for field in extract_values(resource, param))
 
     def _create_pagination_links(self, resource_type, params, current_page, count, total_resources):
         """創建分頁連結"""
@@ -197,33 +378,77 @@ class FHIRHandler(RequestHandler):
         self.set_status(204)
         self.finish()
 
+    def write_json(self, obj):
+        """以共用編解碼器序列化後寫出, 保留 application/fhir+json 內容類型"""
+        self.write(dumps(obj))
+
+    def compute_etag(self):
+        # ETag 由資源版本產生, 不對回應內容計算雜湊
+        return None
+
+    def set_version_headers(self, version_id, last_updated):
+        """設定 ETag 與 Last-Modified (lastUpdated 未帶時區時視為 UTC)"""
+        if version_id is not None:
+            self.set_header("ETag", f'W/"{version_id}"')
+        bounds = parse_date(last_updated) if last_updated else None
+        if bounds is not None:
+            self.set_header("Last-Modified", formatdate(bounds[0], usegmt=True))
+
+    def is_not_modified(self, version_id, last_updated):
+        """依 If-None-Match (優先) 或 If-Modified-Since 判斷是否可回應 304"""
+        if_none_match = self.request.headers.get("If-None-Match")
+        if if_none_match is not None:
+            tags = [tag.strip() for tag in if_none_match.split(",")]
+            return "*" in tags or any(tag.removeprefix("W/") == f'"{version_id}"' for tag in tags)
+        if_modified_since = self.request.headers.get("If-Modified-Since")
+        bounds = parse_date(last_updated) if last_updated else None
+        if if_modified_since is None or bounds is None:
+            return False
+        try:
+            since = parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+        # HTTP 日期只到秒
+        return int(bounds[0]) <= since
+
 class FHIRResourceHandler(FHIRHandler):
     def get(self, resource_type, resource_id):
-        resource = self.fhir_resource.read(resource_type, resource_id)
-        if resource:
-            self.write(resource)
+        header = self.fhir_resource.read_header(resource_type, resource_id)
+        body = None
+        if header is not None:
+            self.set_version_headers(*header)
+            if self.is_not_modified(*header):
+                self.set_status(304)
+                return
+            body = self.fhir_resource.read_bytes(resource_type, resource_id)
+        if body is not None:
+            self.write(body)
         else:
+            self.clear_header("ETag")
+            self.clear_header("Last-Modified")
             self.set_status(404)
-            self.write({"resourceType": "OperationOutcome",
+            self.write_json({"resourceType": "OperationOutcome",
                        "issue": [{"severity": "error",
                                 "code": "not-found",
                                 "diagnostics": f"Resource {resource_type}/{resource_id} not found"}]})
 
     def put(self, resource_type, resource_id):
         try:
-            data = json.loads(self.request.body)
+            data = loads(self.request.body)
             resource = self.fhir_resource.update(resource_type, resource_id, data)
             if resource:
-                self.write(resource)
+                meta = resource.get("meta") or {}
+                self.set_version_headers(meta.get("versionId"), meta.get("lastUpdated"))
+                self.write_json(resource)
             else:
                 self.set_status(404)
-                self.write({"resourceType": "OperationOutcome",
+                self.write_json({"resourceType": "OperationOutcome",
                            "issue": [{"severity": "error",
                                     "code": "not-found",
                                     "diagnostics": f"Resource {resource_type}/{resource_id} not found"}]})
-        except json.JSONDecodeError:
+        except JSONDecodeError:
             self.set_status(400)
-            self.write({"resourceType": "OperationOutcome",
+            self.write_json({"resourceType": "OperationOutcome",
                        "issue": [{"severity": "error",
                                 "code": "invalid",
                                 "diagnostics": "Invalid JSON"}]})
@@ -233,7 +458,7 @@ class FHIRResourceHandler(FHIRHandler):
             self.set_status(204)
         else:
             self.set_status(404)
-            self.write({"resourceType": "OperationOutcome",
+            self.write_json({"resourceType": "OperationOutcome",
                        "issue": [{"severity": "error",
                                 "code": "not-found",
                                 "diagnostics": f"Resource {resource_type}/{resource_id} not found"}]})
@@ -241,19 +466,29 @@ class FHIRResourceHandler(FHIRHandler):
 class FHIRTypeHandler(FHIRHandler):
     def get(self, resource_type): # 處理搜索請求
         search_params = {k: v for k, v in parse_qs(self.request.query).items()}
-        result = self.fhir_resource.search(resource_type, search_params)
+        try:
+            result = self.fhir_resource.search_bytes(resource_type, search_params)
+        except ValueError as e:
+            self.set_status(400)
+            self.write_json({"resourceType": "OperationOutcome",
+                       "issue": [{"severity": "error",
+                                "code": "invalid",
+                                "diagnostics": str(e)}]})
+            return
         self.write(result)
 
     def post(self, resource_type):
         try:
-            data = json.loads(self.request.body)
+            data = loads(self.request.body)
             resource = self.fhir_resource.create(resource_type, data)
             self.set_status(201)
             self.set_header("Location", f"/{resource_type}/{resource['id']}")
-            self.write(resource)
-        except json.JSONDecodeError:
+            meta = resource.get("meta") or {}
+            self.set_version_headers(meta.get("versionId"), meta.get("lastUpdated"))
+            self.write_json(resource)
+        except JSONDecodeError:
             self.set_status(400)
-            self.write({"resourceType": "OperationOutcome",
+            self.write_json({"resourceType": "OperationOutcome",
                        "issue": [{"severity": "error",
                                 "code": "invalid",
                                 "diagnostics": "Invalid JSON"}]})
@@ -1,8 +1,8 @@
 import tornado.ioloop
 import tornado.web
-import json
-from datetime import datetime
+from datetime import datetime, timezone
 import uuid
+from 編解碼 import JSONDecodeError, dumps, loads
 
 class FHIRResource:
     def __init__(self):
@@ -10,7 +10,7 @@ class FHIRResource:
     
     def create(self, resource_type, data):
         resource_id = str(uuid.uuid4())
-        timestamp = datetime.now().isoformat()
+        timestamp = datetime.now(timezone.utc).isoformat()
         
         resource = {
             "resourceType": resource_type,
@@ -36,7 +36,7 @@ class FHIRResource:
             
         resource = self.resources[key]
         version = int(resource["meta"]["versionId"])
-        timestamp = datetime.now().isoformat()
+        timestamp = datetime.now(timezone.utc).isoformat()
         
         updated_resource = {
             "resourceType": resource_type,
@@ -69,33 +69,37 @@ class FHIRHandler(tornado.web.RequestHandler):
         self.set_status(204)
         self.finish()
 
+    def write_json(self, obj):
+        """以共用編解碼器序列化後寫出, 保留 application/fhir+json 內容類型"""
+        self.write(dumps(obj))
+
 class FHIRResourceHandler(FHIRHandler):
     def get(self, resource_type, resource_id):
         resource = self.fhir_resource.read(resource_type, resource_id)
         if resource:
-            self.write(resource)
+            self.write_json(resource)
         else:
             self.set_status(404)
-            self.write({"resourceType": "OperationOutcome",
+            self.write_json({"resourceType": "OperationOutcome",
                        "issue": [{"severity": "error",
                                 "code": "not-found",
                                 "diagnostics": f"Resource {resource_type}/{resource_id} not found"}]})
     
     def put(self, resource_type, resource_id):
         try:
-            data = json.loads(self.request.body)
+            data = loads(self.request.body)
             resource = self.fhir_resource.update(resource_type, resource_id, data)
             if resource:
-                self.write(resource)
+                self.write_json(resource)
             else:
                 self.set_status(404)
-                self.write({"resourceType": "OperationOutcome",
+                self.write_json({"resourceType": "OperationOutcome",
                            "issue": [{"severity": "error",
                                     "code": "not-found",
                                     "diagnostics": f"Resource {resource_type}/{resource_id} not found"}]})
-        except json.JSONDecodeError:
+        except JSONDecodeError:
             self.set_status(400)
-            self.write({"resourceType": "OperationOutcome",
+            self.write_json({"resourceType": "OperationOutcome",
                        "issue": [{"severity": "error",
                                 "code": "invalid",
                                 "diagnostics": "Invalid JSON"}]})
@@ -106,7 +110,7 @@ class FHIRResourceHandler(FHIRHandler):
             self.set_status(204)
         else:
             self.set_status(404)
-            self.write({"resourceType": "OperationOutcome",
+            self.write_json({"resourceType": "OperationOutcome",
                        "issue": [{"severity": "error",
                                 "code": "not-found",
                                 "diagnostics": f"Resource {resource_type}/{resource_id} not found"}]})
@@ -114,14 +118,14 @@ class FHIRResourceHandler(FHIRHandler):
 class FHIRTypeHandler(FHIRHandler):
     def post(self, resource_type):
         try:
-            data = json.loads(self.request.body)
+            data = loads(self.request.body)
             resource = self.fhir_resource.create(resource_type, data)
             self.set_status(201)
             self.set_header("Location", f"/{resource_type}/{resource['id']}")
-            self.write(resource)
-        except json.JSONDecodeError:
+            self.write_json(resource)
+        except JSONDecodeError:
             self.set_status(400)
-            self.write({"resourceType": "OperationOutcome",
+            self.write_json({"resourceType": "OperationOutcome",
                        "issue": [{"severity": "error",
                                 "code": "invalid",
                                 "diagnostics": "Invalid JSON"}]})
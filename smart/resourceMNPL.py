@@ -1,7 +1,7 @@
 import tornado.ioloop
 from tornado.web import ApplyModel
 import json
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 import uuid
 from urllib.parse import parse_qs
 import re
@@ -14,7 +14,7 @@ class FHIRResource:
         self.references = {}
     def create(self, resource_type, data):
         resource_id = str(uuid.uuid4())
-        timestamp = datetime.now().isoformat()
+        timestamp = datetime.now(timezone.utc).isoformat()
         
         resource = {
             "resourceType": resource_type,
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# 模組以檔名直接匯入 (與伺服器相同的執行方式)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,12 @@
+from advServer import FHIRResource
+
+
+def test_indexed_search_keeps_insertion_order():
+    fhir_resource = FHIRResource()
+    patients = [fhir_resource.create("Patient", {"gender": "male" if number % 3 else "female"})
+                for number in range(60)]
+    fhir_resource.update("Patient", patients[4]["id"], {"gender": "male"})
+    bundle = fhir_resource.search("Patient", {"gender": ["male"], "_count": ["100"]})
+    expected = [patient["id"] for number, patient in enumerate(patients) if number % 3 or number == 4]
+    assert [entry["resource"]["id"] for entry in bundle["entry"]] == expected
+    assert bundle["total"] == len(expected)
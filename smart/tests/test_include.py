@@ -0,0 +1,63 @@
+from 資源搜尋 import FHIRResource
+
+
+def setup_encounters():
+    fhir_resource = FHIRResource()
+    parent = fhir_resource.create("Organization", {"name": "總院"})
+    organization = fhir_resource.create("Organization", {
+        "name": "分院", "partOf": {"reference": f"Organization/{parent['id']}"},
+    })
+    encounter = fhir_resource.create("Encounter", {
+        "status": "finished", "serviceProvider": {"reference": f"Organization/{organization['id']}"},
+    })
+    return fhir_resource, parent, organization, encounter
+
+
+def resource_ids(bundle):
+    return {entry["resource"]["id"] for entry in bundle["entry"] if "resource" in entry}
+
+
+def test_include_hyphenated_parameter():
+    fhir_resource, parent, organization, encounter = setup_encounters()
+    bundle = fhir_resource.search("Encounter", {"_include": ["Encounter:service-provider"]})
+    assert resource_ids(bundle) == {encounter["id"], organization["id"]}
+
+    bundle = fhir_resource.search("Encounter", {
+        "_include": ["Encounter:service-provider"], "_include:iterate": ["Organization:part-of"],
+    })
+    assert resource_ids(bundle) == {encounter["id"], organization["id"], parent["id"]}
+
+
+def test_revinclude_hyphenated_parameter():
+    fhir_resource, _, organization, encounter = setup_encounters()
+    bundle = fhir_resource.search("Organization", {
+        "name": ["分院"], "_revinclude": ["Encounter:service-provider"],
+    })
+    assert resource_ids(bundle) == {organization["id"], encounter["id"]}
+
+
+def setup_observations():
+    fhir_resource = FHIRResource()
+    patient = fhir_resource.create("Patient", {"name": [{"family": "王"}]})
+    group = fhir_resource.create("Group", {"type": "person"})
+    observation = fhir_resource.create("Observation", {
+        "status": "final", "subject": {"reference": f"Patient/{patient['id']}"},
+    })
+    other = fhir_resource.create("Observation", {"status": "final", "subject": {"reference": f"Group/{group['id']}"}})
+    return fhir_resource, patient, observation, other
+
+
+def test_include_parameter_named_differently_from_element():
+    fhir_resource, patient, observation, other = setup_observations()
+    # patient 只包含 subject 中的 Patient, 不含 Group
+    bundle = fhir_resource.search("Observation", {"_include": ["Observation:patient"]})
+    assert resource_ids(bundle) == {observation["id"], other["id"], patient["id"]}
+
+    bundle = fhir_resource.search("Patient", {"_revinclude": ["Observation:patient"]})
+    assert resource_ids(bundle) == {patient["id"], observation["id"]}
+
+    bundle = fhir_resource.search("Observation", {"patient.name.family": ["王"]})
+    assert resource_ids(bundle) == {observation["id"]}
+
+    bundle = fhir_resource.search("Patient", {"_has:Observation:patient:status": ["final"]})
+    assert resource_ids(bundle) == {patient["id"]}
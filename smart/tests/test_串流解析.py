@@ -0,0 +1,49 @@
+import json
+
+import pytest
+
+from 串流解析 import BundleStreamParser
+
+
+def bundle_bytes(count):
+    return json.dumps({
+        "resourceType": "Bundle", "type": "batch",
+        "entry": [{"resource": {"resourceType": "Patient", "name": [{"text": f"病人 \"{number}\" [}}"}]},
+                   "request": {"method": "POST", "url": "Patient"}} for number in range(count)],
+        "meta": {"tag": [{"code": "x"}]},
+    }, ensure_ascii=False).encode()
+
+
+@pytest.mark.parametrize("chunk_size", [1, 7, 4096])
+def test_entries_match_full_parse(chunk_size):
+    data = bundle_bytes(20)
+    parser = BundleStreamParser()
+    entries = []
+    for start in range(0, len(data), chunk_size):
+        entries += parser.feed(data[start:start + chunk_size])
+    parser.close()
+    expected = json.loads(data)
+    assert entries == expected["entry"]
+    assert parser.fields["type"] == "batch" and parser.fields["meta"] == expected["meta"]
+
+
+def test_buffer_keeps_only_current_entry():
+    data = bundle_bytes(200)
+    parser = BundleStreamParser()
+    largest = 0
+    for start in range(0, len(data), 64):
+        parser.feed(data[start:start + 64])
+        largest = max(largest, len(parser.buffer))
+    parser.close()
+    assert largest < 512
+
+
+def test_incomplete_and_oversized_bundles_are_rejected():
+    parser = BundleStreamParser()
+    parser.feed(bundle_bytes(3)[:-10])
+    with pytest.raises(ValueError):
+        parser.close()
+    # 尚未完整的 entry 超過上限即拒絕, 不等到整個值讀完
+    parser = BundleStreamParser(max_value_bytes=100)
+    with pytest.raises(ValueError):
+        parser.feed(b'{"resourceType": "Bundle", "entry": [{"resource": {"text": "' + b"x" * 200)
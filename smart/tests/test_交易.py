@@ -0,0 +1,59 @@
+import asyncio
+
+from 資源搜尋 import FHIRResource
+from 批量 import BatchOperation
+
+
+def run_transaction(fhir_resource, entries):
+    bundle = {"resourceType": "Bundle", "type": "transaction", "entry": entries}
+    return asyncio.run(BatchOperation(fhir_resource).process_batch(bundle))
+
+
+def test_search_sees_staged_writes():
+    fhir_resource = FHIRResource()
+    existing = fhir_resource.create("Observation", {"status": "final"})
+    removed = fhir_resource.create("Observation", {"status": "final"})
+    result = run_transaction(fhir_resource, [
+        {"resource": {"resourceType": "Observation", "status": "final"},
+         "request": {"method": "POST", "url": "Observation"}},
+        {"request": {"method": "DELETE", "url": f"Observation/{removed['id']}"}},
+        {"request": {"method": "GET", "url": "Observation?status=final"}},
+    ])
+    assert result["type"] == "transaction-response"
+    created = result["entry"][0]["resource"]
+    searchset = result["entry"][2]["resource"]
+    assert searchset["total"] == 2
+    assert [entry["resource"]["id"] for entry in searchset["entry"]] == [existing["id"], created["id"]]
+
+
+def test_posts_may_reference_each_other():
+    fhir_resource = FHIRResource()
+    result = run_transaction(fhir_resource, [
+        {"fullUrl": "urn:uuid:patient", "resource": {
+            "resourceType": "Patient", "link": [{"other": {"reference": "urn:uuid:related"}}]},
+         "request": {"method": "POST", "url": "Patient"}},
+        {"fullUrl": "urn:uuid:related", "resource": {
+            "resourceType": "RelatedPerson", "patient": {"reference": "urn:uuid:patient"}},
+         "request": {"method": "POST", "url": "RelatedPerson"}},
+    ])
+    assert result["type"] == "transaction-response"
+    patient, related = (entry["resource"] for entry in result["entry"])
+    assert patient["link"][0]["other"]["reference"] == f"RelatedPerson/{related['id']}"
+    assert related["patient"]["reference"] == f"Patient/{patient['id']}"
+    assert fhir_resource.read("Patient", patient["id"]) == patient
+    assert fhir_resource.read("RelatedPerson", related["id"]) == related
+
+
+def test_conditional_cycle_is_rejected():
+    fhir_resource = FHIRResource()
+    result = run_transaction(fhir_resource, [
+        {"fullUrl": "urn:uuid:a", "resource": {
+            "resourceType": "Patient", "link": [{"other": {"reference": "urn:uuid:b"}}]},
+         "request": {"method": "PUT", "url": "Patient?identifier=a"}},
+        {"fullUrl": "urn:uuid:b", "resource": {
+            "resourceType": "Patient", "link": [{"other": {"reference": "urn:uuid:a"}}]},
+         "request": {"method": "PUT", "url": "Patient?identifier=b"}},
+    ])
+    assert result["entry"][0]["status"] == "400"
+    assert "Circular" in result["entry"][0]["outcome"]["issue"][0]["diagnostics"]
+    assert fhir_resource.count("Patient") == 0
@@ -0,0 +1,50 @@
+from 寫前日誌 import DurableFHIRResource
+
+
+def history_of(fhir_resource, resource_type, resource_id):
+    history = fhir_resource.instance_history(resource_type, resource_id)
+    return [(entry["request"]["method"], entry["response"]["etag"], (entry.get("resource") or {}).get("gender"))
+            for entry in history["entry"]]
+
+
+def write_versions(fhir_resource):
+    patient = fhir_resource.create("Patient", {"gender": "male"})
+    fhir_resource.update("Patient", patient["id"], {"gender": "female"})
+    removed = fhir_resource.create("Patient", {"gender": "other"})
+    fhir_resource.delete("Patient", removed["id"])
+    return patient, removed
+
+
+def test_recovers_from_log(tmp_path):
+    fhir_resource = DurableFHIRResource(str(tmp_path))
+    patient, removed = write_versions(fhir_resource)
+    fhir_resource.close()
+
+    fhir_resource = DurableFHIRResource(str(tmp_path))
+    assert fhir_resource.read("Patient", patient["id"])["gender"] == "female"
+    assert fhir_resource.read("Patient", removed["id"]) is None
+    assert history_of(fhir_resource, "Patient", patient["id"]) == [
+        ("PUT", 'W/"2"', "female"), ("POST", 'W/"1"', "male"),
+    ]
+    fhir_resource.close()
+
+
+def test_snapshot_keeps_history(tmp_path):
+    fhir_resource = DurableFHIRResource(str(tmp_path))
+    patient, removed = write_versions(fhir_resource)
+    fhir_resource.snapshot()
+    fhir_resource.update("Patient", patient["id"], {"gender": "unknown"})
+    fhir_resource.close()
+
+    fhir_resource = DurableFHIRResource(str(tmp_path))
+    assert history_of(fhir_resource, "Patient", patient["id"]) == [
+        ("PUT", 'W/"3"', "unknown"), ("PUT", 'W/"2"', "female"), ("POST", 'W/"1"', "male"),
+    ]
+    entry, resource = fhir_resource.vread("Patient", patient["id"], "1")
+    assert resource["gender"] == "male"
+    assert history_of(fhir_resource, "Patient", removed["id"]) == [
+        ("DELETE", 'W/"2"', None), ("POST", 'W/"1"', "other"),
+    ]
+    assert len(fhir_resource.type_history("Patient")["entry"]) == 5
+    assert fhir_resource.search("Patient", {"gender:exact": ["unknown"], "_summary": ["count"]})["total"] == 1
+    fhir_resource.close()
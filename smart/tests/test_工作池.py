@@ -0,0 +1,63 @@
+import threading
+
+import pytest
+
+from 工作池 import PoolSaturated, WorkerPool
+
+
+@pytest.fixture
+def pool():
+    pool = WorkerPool(max_workers=1, max_queue=3, max_client_requests=2)
+    yield pool
+    pool.shutdown(cancel_futures=True)
+
+
+def test_client_limit_returns_429(pool):
+    pool.acquire("a")
+    pool.acquire("a")
+    with pytest.raises(PoolSaturated) as error:
+        pool.acquire("a")
+    assert error.value.status == "429" and error.value.retry_after >= 1
+    pool.acquire("b")
+    pool.release("a")
+    pool.acquire("a")
+    assert pool.stats()["rejected"]["429"] == 1
+
+
+def test_full_queue_returns_503(pool):
+    started, blocked = threading.Event(), threading.Event()
+
+    def block():
+        started.set()
+        blocked.wait()
+
+    pool.submit(block)
+    started.wait()
+    for _ in range(3):
+        pool.submit(lambda: None)
+    with pytest.raises(PoolSaturated) as error:
+        with pool.admit("c"):
+            pass
+    assert error.value.status == "503"
+    blocked.set()
+
+
+def test_clients_take_turns(pool):
+    started, blocked = threading.Event(), threading.Event()
+    order = []
+
+    def block():
+        started.set()
+        blocked.wait()
+
+    pool.submit(block)
+    started.wait()
+    futures = []
+    with pool.as_client("a"):
+        futures += [pool.submit(order.append, f"a{number}") for number in range(3)]
+    with pool.as_client("b"):
+        futures += [pool.submit(order.append, f"b{number}") for number in range(2)]
+    blocked.set()
+    for future in futures:
+        future.result(timeout=5)
+    assert order == ["a0", "b0", "a1", "b1", "a2"]
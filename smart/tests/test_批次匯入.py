@@ -0,0 +1,103 @@
+import json
+import tempfile
+import time
+
+from tornado.testing import AsyncHTTPTestCase
+
+from 批量 import make_app
+from 批次匯入 import BulkImporter
+from 寫前日誌 import DurableFHIRResource
+from 資源搜尋 import FHIRResource
+from 工作池 import shared_pool
+
+
+def import_parameters(url):
+    return json.dumps({"resourceType": "Parameters", "parameter": [{"name": "input", "part": [
+        {"name": "type", "valueCode": "Patient"}, {"name": "url", "valueUri": url},
+    ]}]})
+
+
+class ImportHandlerTest(AsyncHTTPTestCase):
+    def get_app(self):
+        self.directory = self.get_directory()
+        return make_app(import_directory=self.directory)
+
+    def get_directory(self):
+        directory = tempfile.mkdtemp()
+        with open(f"{directory}/Patient.ndjson", "w") as f:
+            for number in range(20):
+                f.write(json.dumps({"resourceType": "Patient", "id": f"p{number}", "gender": "male"}) + "\n")
+        return directory
+
+    def get_async_test_timeout(self):
+        return 60
+
+    def test_import_runs_in_shared_pool(self):
+        completed = shared_pool().stats()["completed"]
+        response = self.fetch("/$import", method="POST", body=import_parameters("Patient.ndjson"),
+                              request_timeout=60)
+        assert response.code == 200
+        parameters = {p["name"]: p for p in json.loads(response.body)["parameter"]}
+        assert parameters["total"]["valueInteger"] == 20
+        # 工作執行緒在回傳結果之後才更新統計
+        for _ in range(100):
+            if shared_pool().stats()["completed"] > completed:
+                break
+            time.sleep(0.01)
+        assert shared_pool().stats()["completed"] > completed
+        assert self.fetch("/Patient/p3").code == 200
+
+    def test_import_admission_control(self):
+        pool = shared_pool()
+        for _ in range(pool.max_client_requests):
+            pool.acquire("busy")
+        try:
+            response = self.fetch("/$import", method="POST", body=import_parameters("Patient.ndjson"),
+                                  headers={"X-Client-Id": "busy"})
+        finally:
+            for _ in range(pool.max_client_requests):
+                pool.release("busy")
+        assert response.code == 429
+        assert "Retry-After" in response.headers
+
+    def test_import_rejects_files_outside_directory(self):
+        response = self.fetch("/$import", method="POST", body=import_parameters("file:///etc/passwd"))
+        assert response.code == 400
+
+
+def write_ndjson(path, resources):
+    with open(path, "w") as f:
+        for resource in resources:
+            f.write(json.dumps(resource) + "\n")
+
+
+def test_repeated_ids_become_versions(tmp_path):
+    first, second = str(tmp_path / "Patient.000.ndjson"), str(tmp_path / "Patient.001.ndjson")
+    write_ndjson(first, [{"resourceType": "Patient", "id": "p1", "gender": "male"},
+                         {"resourceType": "Patient", "id": "p1", "gender": "female"}])
+    write_ndjson(second, [{"resourceType": "Patient", "id": "p1", "gender": "other"}])
+    fhir_resource = DurableFHIRResource(str(tmp_path / "wal"))
+    fhir_resource.create("Patient", {"gender": "unknown"})
+    for batch_size in (0, 1):
+        report = BulkImporter(fhir_resource, 1, batch_size).run([("Patient", first), ("Patient", second)])
+        assert report["total"] == 3 and report["errorCount"] == 0
+    fhir_resource.close()
+
+    fhir_resource = DurableFHIRResource(str(tmp_path / "wal"))
+    history = fhir_resource.instance_history("Patient", "p1")["entry"]
+    assert [entry["response"]["etag"] for entry in history] == [f'W/"{version}"' for version in range(6, 0, -1)]
+    assert [entry["resource"]["gender"] for entry in history] == ["other", "female", "male"] * 2
+    assert fhir_resource.count("Patient") == 2
+    fhir_resource.close()
+
+
+def test_import_reports_invalid_lines(tmp_path):
+    path = str(tmp_path / "Patient.ndjson")
+    with open(path, "w") as f:
+        f.write(json.dumps({"resourceType": "Patient", "id": "p1"}) + "\n{not json\n")
+        f.write(json.dumps({"resourceType": "Observation", "id": "o1"}) + "\n")
+    fhir_resource = FHIRResource()
+    report = BulkImporter(fhir_resource, 1).run([("Patient", path)])
+    assert report["types"] == {"Patient": 1}
+    messages = [error["message"] for error in report["errors"]]
+    assert messages[0].startswith("Invalid JSON") and "Observation" in messages[1]
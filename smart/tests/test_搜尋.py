@@ -0,0 +1,84 @@
+import pytest
+
+from 資源搜尋 import FHIRResource
+
+
+def create_patients(fhir_resource, count):
+    return [fhir_resource.create("Patient", {"gender": "male" if number % 2 else "female",
+                                             "birthDate": f"{1950 + number}-01-01"})
+            for number in range(count)]
+
+
+def test_count_zero_returns_total_only():
+    fhir_resource = FHIRResource()
+    create_patients(fhir_resource, 5)
+    bundle = fhir_resource.search("Patient", {"gender:exact": ["male"], "_count": ["0"]})
+    assert bundle["total"] == 2
+    assert not bundle.get("entry")
+    assert "link" not in bundle
+
+
+def test_negative_count_is_rejected():
+    fhir_resource = FHIRResource()
+    with pytest.raises(ValueError):
+        fhir_resource.search("Patient", {"_count": ["-1"]})
+
+
+def test_cursor_paging_visits_every_match_once():
+    fhir_resource = FHIRResource()
+    patients = create_patients(fhir_resource, 25)
+    seen = []
+    params = {"birthDate:ge": ["1960"], "_count": ["4"]}
+    while True:
+        bundle = fhir_resource.search("Patient", params)
+        assert bundle.get("total", 15) == 15
+        seen += [entry["resource"]["id"] for entry in bundle["entry"]]
+        links = [link["url"] for link in bundle["link"] if link["relation"] == "next"]
+        if not links:
+            break
+        cursor = links[0].split("_cursor=")[1].split("&")[0]
+        params = {"birthDate:ge": ["1960"], "_count": ["4"], "_cursor": [cursor]}
+    assert seen == [patient["id"] for patient in patients[10:]]
+
+
+def test_has_ignores_dangling_references():
+    fhir_resource = FHIRResource()
+    patient = fhir_resource.create("Patient", {"gender": "male"})
+    for reference in [f"Patient/{patient['id']}", "Patient/missing", "Patient/missing-too"]:
+        fhir_resource.create("Observation", {"status": "final", "subject": {"reference": reference}})
+    params = {"_has:Observation:subject:status": ["final"]}
+    assert fhir_resource.search("Patient", {**params, "_summary": ["count"]})["total"] == 1
+    bundle = fhir_resource.search("Patient", {**params, "_total": ["accurate"]})
+    assert bundle["total"] == 1
+    assert [entry["resource"]["id"] for entry in bundle["entry"]] == [patient["id"]]
+
+
+def test_chain_ignores_deleted_sources():
+    fhir_resource = FHIRResource()
+    organization = fhir_resource.create("Organization", {"name": "總院"})
+    patients = [fhir_resource.create("Patient", {
+        "managingOrganization": {"reference": f"Organization/{organization['id']}"},
+    }) for _ in range(3)]
+    fhir_resource.delete("Patient", patients[0]["id"])
+    params = {"managingOrganization.name": ["總院"], "_summary": ["count"]}
+    assert fhir_resource.search("Patient", params)["total"] == 2
+
+
+@pytest.mark.parametrize("params", [
+    {"gender:exact": ["male"], "birthDate:ge": ["1960"]},
+    {"gender:exact": ["female"], "birthDate:lt": ["1970"], "name": ["王"]},
+    {"birthDate:ge": ["1955"], "birthDate:le": ["1965"]},
+])
+def test_planned_search_and_total_match_scan(params):
+    fhir_resource = FHIRResource()
+    patients = create_patients(fhir_resource, 30)
+    for patient in patients[::4]:
+        fhir_resource.update("Patient", patient["id"], {**patient, "name": [{"family": "王"}]})
+    expected = [resource_id for resource_id, resource in fhir_resource.resources["Patient"].items()
+                if fhir_resource.matches("Patient", resource, params)]
+    bundle = fhir_resource.search("Patient", {**params, "_count": ["3"]})
+    assert bundle["total"] == len(expected)
+    assert [entry["resource"]["id"] for entry in bundle["entry"]] == expected[:3]
+    # 結果超過一頁時 _total=none 不計算總數, estimate 不少於實際筆數
+    assert "total" not in fhir_resource.search("Patient", {**params, "_count": ["1"], "_total": ["none"]})
+    assert fhir_resource.search("Patient", {**params, "_count": ["1"], "_total": ["estimate"]})["total"] >= len(expected)
@@ -0,0 +1,67 @@
+import random
+
+import pytest
+
+from 搜尋索引 import SortedKeys
+from 資源搜尋 import FHIRResource
+
+
+def search_ids(fhir_resource, resource_type, params):
+    bundle = fhir_resource.search(resource_type, {**params, "_count": ["1000"]})
+    return [entry["resource"]["id"] for entry in bundle.get("entry", [])]
+
+
+def scan_ids(fhir_resource, resource_type, params):
+    """不經索引, 逐筆比對全部資源"""
+    return [resource_id for resource_id, resource in fhir_resource.resources[resource_type].items()
+            if fhir_resource.matches(resource_type, resource, params)]
+
+
+@pytest.fixture(scope="module")
+def fhir_resource():
+    generator = random.Random(7)
+    fhir_resource = FHIRResource()
+    for _ in range(300):
+        fhir_resource.create("Observation", {
+            "status": generator.choice(["final", "amended", "preliminary"]),
+            "code": {"coding": [{"code": generator.choice(["8867-4", "8480-6", "8462-4", "2339-0"])}
+                                for _ in range(generator.randint(1, 3))]},
+            "effectiveDateTime": f"20{generator.randint(10, 24)}-{generator.randint(1, 12):02d}-01",
+            "valueQuantity": {"value": generator.randint(0, 200) / 2},
+        })
+    return fhir_resource
+
+
+@pytest.mark.parametrize("params", [
+    {"status:exact": ["final"]},
+    {"code.coding.code:below": ["84"]},
+    {"code.coding.code:below": ["8"], "status:exact": ["amended"]},
+    {"effectiveDateTime:ge": ["2018"]},
+    {"effectiveDateTime:lt": ["2015-06"]},
+    {"valueQuantity.value:gt": ["50"], "valueQuantity.value:le": ["75.5"]},
+])
+def test_index_matches_full_scan(fhir_resource, params):
+    expected = scan_ids(fhir_resource, "Observation", params)
+    assert search_ids(fhir_resource, "Observation", params) == expected
+    count = fhir_resource.search("Observation", {**params, "_summary": ["count"]})["total"]
+    assert count == len(expected)
+
+
+def test_below_count_is_distinct():
+    fhir_resource = FHIRResource()
+    fhir_resource.create("Observation", {"code": {"coding": [{"code": "8480-6"}, {"code": "8462-4"}]}})
+    fhir_resource.create("Observation", {"code": {"coding": [{"code": "8480-6"}]}})
+    params = {"code.coding.code:below": ["84"], "_summary": ["count"]}
+    assert fhir_resource.search("Observation", params)["total"] == 2
+
+
+def test_sorted_keys_insert_many_matches_insert():
+    generator = random.Random(11)
+    batches = [[(generator.randint(0, 50), f"r{batch}-{number}") for number in range(40)] for batch in range(5)]
+    batches.append([(100 + number, f"tail-{number}") for number in range(10)])
+    one_by_one, merged = SortedKeys(), SortedKeys()
+    for batch in batches:
+        for key, resource_id in batch:
+            one_by_one.insert(key, resource_id)
+        merged.insert_many(batch)
+        assert merged.keys == one_by_one.keys and merged.ids == one_by_one.ids
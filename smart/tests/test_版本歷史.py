@@ -0,0 +1,54 @@
+from datetime import datetime, timedelta, timezone
+
+from 資料庫儲存 import SQLiteFHIRResource
+from 資源搜尋 import FHIRResource
+
+
+def test_sqlite_history_survives_restart(tmp_path):
+    database = str(tmp_path / "fhir.db")
+    fhir_resource = SQLiteFHIRResource(database)
+    patient = fhir_resource.create("Patient", {"gender": "male"})
+    fhir_resource.update("Patient", patient["id"], {"gender": "female"})
+    removed = fhir_resource.create("Patient", {"gender": "other"})
+    fhir_resource.delete("Patient", removed["id"])
+    fhir_resource.close()
+
+    fhir_resource = SQLiteFHIRResource(database)
+    history = fhir_resource.instance_history("Patient", patient["id"])
+    assert [entry["response"]["etag"] for entry in history["entry"]] == ['W/"2"', 'W/"1"']
+    assert history["entry"][1]["resource"]["gender"] == "male"
+    entry, resource = fhir_resource.vread("Patient", patient["id"], "1")
+    assert entry.method == "create" and resource["gender"] == "male"
+
+    deleted = fhir_resource.instance_history("Patient", removed["id"])
+    assert [entry["request"]["method"] for entry in deleted["entry"]] == ["DELETE", "POST"]
+    assert deleted["entry"][1]["resource"]["gender"] == "other"
+
+    changes = fhir_resource.type_history("Patient")["entry"]
+    assert len(changes) == 4 and changes[0]["request"]["method"] == "DELETE"
+    fhir_resource.close()
+
+
+def test_history_falls_back_to_current_version(tmp_path):
+    fhir_resource = SQLiteFHIRResource(str(tmp_path / "fhir.db"))
+    patient = fhir_resource.create("Patient", {"gender": "male"})
+    # 啟用歷史前已存在的資源沒有任何版本記錄
+    fhir_resource.store.execute("DELETE FROM history")
+    history = fhir_resource.instance_history("Patient", patient["id"])
+    assert [entry["resource"]["id"] for entry in history["entry"]] == [patient["id"]]
+    entry, resource = fhir_resource.vread("Patient", patient["id"], "1")
+    assert resource == patient
+    assert fhir_resource.instance_history("Patient", "missing") is None
+
+
+def test_last_updated_is_utc():
+    fhir_resource = FHIRResource()
+    patient = fhir_resource.create("Patient", {"gender": "male"})
+    last_updated = datetime.fromisoformat(patient["meta"]["lastUpdated"])
+    assert last_updated.utcoffset() == timedelta(0)
+    since = (last_updated - timedelta(minutes=1)).astimezone(timezone(timedelta(hours=8))).isoformat()
+    assert len(fhir_resource.type_history("Patient", since)["entry"]) == 1
+    deleted = fhir_resource.delete("Patient", patient["id"])
+    assert deleted is not None
+    entry = fhir_resource.instance_history("Patient", patient["id"])["entry"][0]
+    assert datetime.fromisoformat(entry["response"]["lastModified"]).utcoffset() == timedelta(0)
@@ -0,0 +1,197 @@
+"""
+Bundle 串流解析
+
+逐段餵入請求內容, 取出 Bundle 的頂層欄位 (resourceType、type 等) 與 entry 陣列中
+每個完整的項目, 不需先讀入整份 Bundle。緩衝區只保留尚未完整的一個值,
+已解析的部分隨即丟棄, 記憶體用量取決於單一 entry 的大小而非整份 Bundle。
+
+掃描時以正規表示式直接跳到下一個引號或括號, 不逐位元組處理。
+"""
+import re
+
+from 編解碼 import loads
+
+_STRUCTURE = re.compile(rb'["{}\[\]]')
+_STRING_END = re.compile(rb'["\\]')
+_SCALAR_END = re.compile(rb'[,}\]\s]')
+_WHITESPACE = b" \t\r\n"
+
+
+class BundleStreamParser:
+    def __init__(self, max_value_bytes=64 << 20):
+        # 單一頂層欄位或 entry 的大小上限
+        self.max_value_bytes = max_value_bytes
+        self.buffer = bytearray()
+        self.pos = 0
+        self.state = "start"
+        self.key = None
+        # 已解析的頂層欄位 (entry 除外)
+        self.fields = {}
+        self.entry_count = 0
+        # 目前掃描中的值: 起點、已掃描到的位置、巢狀深度、是否位於字串內
+        self.value_start = None
+        self.scan = 0
+        self.depth = 0
+        self.in_string = False
+
+    @property
+    def done(self):
+        return self.state == "done"
+
+    def feed(self, data):
+        """加入一段內容, 回傳其中完整的 entry 項目 (已解碼)"""
+        self.buffer += data
+        entries = []
+        while self._step(entries):
+            pass
+        # 丟棄已處理的部分, 只保留掃描中的值
+        keep = self.pos if self.value_start is None else min(self.pos, self.value_start)
+        if keep:
+            del self.buffer[:keep]
+            self.pos -= keep
+            if self.value_start is not None:
+                self.value_start -= keep
+                self.scan -= keep
+        if self.value_start is not None and len(self.buffer) - self.value_start > self.max_value_bytes:
+            raise ValueError(f"Bundle value exceeds {self.max_value_bytes} bytes")
+        return entries
+
+    def close(self):
+        """內容結束; Bundle 不完整時拋出 ValueError"""
+        if self.state != "done":
+            raise ValueError("Incomplete Bundle JSON")
+        if self.buffer[self.pos:].strip(_WHITESPACE):
+            raise ValueError("Unexpected data after Bundle JSON")
+
+    def _next_char(self):
+        """跳過空白, 回傳下一個字元; 需要更多內容時回傳 None"""
+        while self.pos < len(self.buffer) and self.buffer[self.pos] in _WHITESPACE:
+            self.pos += 1
+        if self.pos >= len(self.buffer):
+            return None
+        return bytes(self.buffer[self.pos:self.pos + 1])
+
+    def _expect(self, char, expected):
+        if char not in expected:
+            raise ValueError(f"Invalid Bundle JSON: unexpected {char!r}, expected one of {expected!r}")
+
+    def _begin_value(self):
+        self.value_start = self.pos
+        self.scan = self.pos
+        self.depth = 0
+        self.in_string = False
+
+    def _scan_value(self):
+        """掃描目前的值, 完整時回傳解碼結果並前進, 否則回傳 None (需要更多內容)"""
+        buffer = self.buffer
+        if self.scan == self.value_start:
+            first = buffer[self.scan:self.scan + 1]
+            if first not in (b"{", b"[", b'"'):
+                match = _SCALAR_END.search(buffer, self.scan)
+                if match is None:
+                    return None
+                return self._finish_value(match.start())
+        while True:
+            if self.in_string:
+                match = _STRING_END.search(buffer, self.scan)
+                if match is None:
+                    self.scan = len(buffer)
+                    return None
+                if buffer[match.start()] == 0x5C:  # 反斜線: 跳過下一個字元
+                    if match.start() + 1 >= len(buffer):
+                        self.scan = match.start()
+                        return None
+                    self.scan = match.start() + 2
+                    continue
+                self.in_string = False
+                self.scan = match.end()
+                if self.depth == 0:
+                    return self._finish_value(self.scan)
+                continue
+            match = _STRUCTURE.search(buffer, self.scan)
+            if match is None:
+                self.scan = len(buffer)
+                return None
+            char = buffer[match.start()]
+            self.scan = match.end()
+            if char == 0x22:
+                self.in_string = True
+            elif char in b"{[":
+                self.depth += 1
+            else:
+                self.depth -= 1
+                if self.depth == 0:
+                    return self._finish_value(self.scan)
+
+    def _finish_value(self, end):
+        value = loads(bytes(self.buffer[self.value_start:end]))
+        self.pos = end
+        self.value_start = None
+        return (value,)
+
+    def _step(self, entries):
+        """推進一個狀態, 回傳是否還能繼續"""
+        state = self.state
+        if state == "done":
+            return False
+        if self.value_start is not None:
+            result = self._scan_value()
+            if result is None:
+                return False
+            value = result[0]
+            if state == "key":
+                if not isinstance(value, str):
+                    raise ValueError("Invalid Bundle JSON: object key must be a string")
+                self.key = value
+                self.state = "colon"
+            elif state == "value":
+                self.fields[self.key] = value
+                self.state = "next"
+            else:
+                entries.append(value)
+                self.entry_count += 1
+                self.state = "element_next"
+            return True
+
+        char = self._next_char()
+        if char is None:
+            return False
+        if state == "start":
+            self._expect(char, (b"{",))
+            self.pos += 1
+            self.state = "key_or_end"
+        elif state == "key_or_end":
+            self._expect(char, (b'"', b"}"))
+            if char == b"}":
+                self.pos += 1
+                self.state = "done"
+            else:
+                self.state = "key"
+                self._begin_value()
+        elif state == "colon":
+            self._expect(char, (b":",))
+            self.pos += 1
+            self.state = "entries_open" if self.key == "entry" else "value_start"
+        elif state == "value_start":
+            self.state = "value"
+            self._begin_value()
+        elif state == "next":
+            self._expect(char, (b",", b"}"))
+            self.pos += 1
+            self.state = "key_or_end" if char == b"," else "done"
+        elif state == "entries_open":
+            self._expect(char, (b"[",))
+            self.pos += 1
+            self.state = "element_or_end"
+        elif state == "element_or_end":
+            if char == b"]":
+                self.pos += 1
+                self.state = "next"
+            else:
+                self.state = "element"
+                self._begin_value()
+        elif state == "element_next":
+            self._expect(char, (b",", b"]"))
+            self.pos += 1
+            self.state = "element_or_end" if char == b"," else "next"
+        return True
@@ -0,0 +1,151 @@
+"""
+交易
+
+transaction Bundle 的各項操作先寫入交易私有的寫入集合, 不影響 store 與其他讀取者。
+交易內的讀取先看自己的寫入, 再讀 store 並記下讀到的版本 (讀取集合)。
+提交時在 store 的寫入臨界區內驗證讀取集合 (讀過的資源未被其他寫入變更), 通過後一次套用全部寫入;
+任何操作失敗或驗證不通過時整個寫入集合直接丟棄, store 不會留下部分結果。
+"""
+import uuid
+
+
+class TransactionError(ValueError):
+    """Bundle 項目或交易無法完成; status 為回應使用的 HTTP 狀態"""
+
+    def __init__(self, message, status="400"):
+        super().__init__(message)
+        self.status = status
+
+
+class TransactionConflict(TransactionError):
+    """提交時發現讀過的資源已被其他寫入變更"""
+
+    def __init__(self, message):
+        super().__init__(message, "409")
+
+
+def _version_of(resource):
+    return None if resource is None else (resource.get("meta") or {}).get("versionId")
+
+
+class Transaction:
+    """交易的私有寫入集合與讀取集合
+
+    批量處理保證同一資源在交易中只有一項操作, 同時執行的項目寫入的鍵互不重疊。
+    """
+
+    def __init__(self, fhir_resource):
+        self.fhir_resource = fhir_resource
+        # (類型, id) -> 交易結束時的資源, 刪除為 None; 依第一次寫入的順序套用
+        self.writes = {}
+        # (類型, id) -> 第一次讀取時 store 中的 versionId (不存在為 None)
+        self.reads = {}
+        # 條件式操作的搜尋: (類型, 參數, store 中符合的 id), 提交時重新搜尋以偵測新增或移除的符合資源
+        self.searches = []
+
+    def read(self, resource_type, resource_id):
+        key = (resource_type, resource_id)
+        if key in self.writes:
+            return self.writes[key]
+        resource = self.fhir_resource.read(resource_type, resource_id)
+        self.reads.setdefault(key, _version_of(resource))
+        return resource
+
+    def create(self, resource_type, data, resource_id=None):
+        """resource_id 為交易事先配置的 id, 未指定時產生新的 uuid"""
+        if resource_id is None:
+            resource_id = str(uuid.uuid4())
+        resource = self.fhir_resource.build_version(resource_type, resource_id, data)
+        self.writes[(resource_type, resource_id)] = resource
+        return resource
+
+    def update(self, resource_type, resource_id, data):
+        previous = self.read(resource_type, resource_id)
+        if previous is None:
+            return None
+        resource = self.fhir_resource.build_version(resource_type, resource_id, data, previous)
+        self.writes[(resource_type, resource_id)] = resource
+        return resource
+
+    def delete(self, resource_type, resource_id):
+        previous = self.read(resource_type, resource_id)
+        if previous is not None:
+            self.writes[(resource_type, resource_id)] = None
+        return previous
+
+    def search_ids(self, resource_type, params):
+        """交易視角的搜尋: store 中符合的 id, 再依交易內的寫入增減"""
+        stored = self._store_ids(resource_type, params)
+        self.searches.append((resource_type, params, stored))
+        ids = set(stored)
+        for (write_type, resource_id), resource in list(self.writes.items()):
+            if write_type != resource_type:
+                continue
+            if resource is not None and self.fhir_resource.matches(resource_type, resource, params):
+                ids.add(resource_id)
+            else:
+                ids.discard(resource_id)
+        return ids
+
+    def search(self, resource_type, params):
+        """交易視角的搜尋結果 (searchset Bundle), 依 _count/_page 分頁; 不處理 _include
+
+        store 中的資源依寫入順序, 交易內新建的資源排在後面。
+        """
+        ids = self.search_ids(resource_type, params)
+        total = len(ids)
+        bundle = {"resourceType": "Bundle", "type": "searchset", "total": total}
+        if params.get("_summary", [None])[0] == "count":
+            return bundle
+        try:
+            page = int(params.get("_page", ["1"])[0])
+            count = int(params.get("_count", ["10"])[0])
+        except ValueError:
+            page, count = 1, 10
+        order = self.fhir_resource.orders.get(resource_type)
+        staged = {key: position for position, key in enumerate(self.writes)}
+
+        def position(resource_id):
+            seq = order.seq(resource_id) if order is not None else None
+            if seq is not None and (resource_type, resource_id) not in staged:
+                return (0, seq)
+            return (1, staged.get((resource_type, resource_id), 0))
+
+        paged = sorted(ids, key=position)[(page - 1) * count:page * count]
+        bundle["entry"] = [{"resource": self._peek(resource_type, resource_id)} for resource_id in paged]
+        return bundle
+
+    def _peek(self, resource_type, resource_id):
+        """讀取交易視角的資源, 不記入讀取集合 (搜尋本身已記錄)"""
+        key = (resource_type, resource_id)
+        if key in self.writes:
+            return self.writes[key]
+        return self.fhir_resource.read(resource_type, resource_id)
+
+    def _store_ids(self, resource_type, params):
+        return frozenset(self.fhir_resource.snapshot_read(self.fhir_resource._search_ids, resource_type, params))
+
+    def _validate(self):
+        for resource_type, params, stored in self.searches:
+            # 已在寫入臨界區內, 直接搜尋
+            if frozenset(self.fhir_resource._search_ids(resource_type, params)) != stored:
+                raise TransactionConflict(f"Matches for conditional search on {resource_type} changed during the transaction")
+        for (resource_type, resource_id), version_id in self.reads.items():
+            current = _version_of(self.fhir_resource.read(resource_type, resource_id))
+            if current != version_id:
+                raise TransactionConflict(
+                    f"Resource {resource_type}/{resource_id} was modified by another request "
+                    f"(read version {version_id}, now {current})"
+                )
+
+    def commit(self):
+        """驗證並原子套用寫入集合, 等待持久化後回傳; 衝突時拋出 TransactionConflict"""
+        changes = [(resource_type, resource_id, resource) for (resource_type, resource_id), resource in self.writes.items()]
+        with self.fhir_resource.committing():
+            self._validate()
+            token = self.fhir_resource.apply(changes)
+        # 持久化等待 (WAL fsync) 在臨界區外, 不阻擋其他寫入
+        self.fhir_resource.flush(token)
+        self.writes = {}
+        self.reads = {}
+        self.searches = []
@@ -0,0 +1,404 @@
+"""
+寫前日誌 (WAL) 與快照
+
+記憶體模式的持久化: 每次 create/update/delete 先在記憶體完成, 再將結果附加到分段日誌,
+由背景執行緒批次寫入並 fsync (group commit), 同一批的寫入共用一次 fsync。
+累積一定筆數後於背景寫出只含現況的快照, 並刪除快照已涵蓋的舊分段。
+啟動時以 mmap 載入最新快照, 只重播快照之後的日誌。
+
+檔案格式 (日誌與快照相同的記錄框架):
+    記錄 = 長度 (uint32) + CRC32 (uint32) + 序號 LSN (uint64) + JSON 內容
+    日誌分段 wal-<首筆 LSN>.log, 內容為 [操作, 類型, id, 資源];
+    交易為 ["apply", null, null, [[類型, id, 資源或 null], ...]]
+    整批匯入為 ["load", 類型, null, [[id, 資源], ...]]
+    快照 snapshot-<LSN>.snap, 開頭為 MAGIC, 內容為 [類型, id, 資源, 歷史];
+    歷史為 [tombstone, [[versionId, lastUpdated, 方法, 反向差異], ...]], 已刪除的資源其資源為 null。
+    舊格式 (FHIRSNAP1) 的快照只有 [類型, id, 資源], 載入後每個資源只有目前版本
+"""
+import mmap
+import os
+import struct
+import threading
+import zlib
+
+from 編解碼 import dumps, loads
+from 資源搜尋 import FHIRResource
+from 搜尋索引 import bulk_record
+
+HEADER = struct.Struct("<IIQ")
+SNAPSHOT_MAGIC = b"FHIRSNAP2\n"
+LEGACY_SNAPSHOT_MAGIC = b"FHIRSNAP1\n"
+SEGMENT_PREFIX = "wal-"
+SNAPSHOT_PREFIX = "snapshot-"
+# 還原快照時每批整批放入的資源數, 也是每筆 load 日誌記錄的資源數上限
+RECOVER_BATCH = 10000
+
+
+def encode_record(lsn, payload):
+    data = dumps(payload)
+    return HEADER.pack(len(data), zlib.crc32(data), lsn) + data
+
+
+def read_records(buffer, offset=0):
+    """依序產生 (LSN, 內容); 遇到不完整或 CRC 不符的記錄 (寫到一半的尾端) 即停止"""
+    end = len(buffer)
+    while offset + HEADER.size <= end:
+        length, crc, lsn = HEADER.unpack_from(buffer, offset)
+        start = offset + HEADER.size
+        if start + length > end:
+            return
+        data = buffer[start:start + length]
+        if zlib.crc32(data) != crc:
+            return
+        yield lsn, loads(data)
+        offset = start + length
+
+
+def _map_file(path):
+    """以 mmap 唯讀開啟, 空檔回傳 None"""
+    with open(path, "rb") as file:
+        if os.fstat(file.fileno()).st_size == 0:
+            return None
+        return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def _fsync_directory(directory):
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _numbered(directory, prefix, suffix):
+    """目錄中指定前綴的檔案, 依檔名中的 LSN 排序回傳 [(LSN, 路徑)]"""
+    files = []
+    for name in os.listdir(directory):
+        if name.startswith(prefix) and name.endswith(suffix):
+            try:
+                files.append((int(name[len(prefix):-len(suffix)]), os.path.join(directory, name)))
+            except ValueError:
+                continue
+    files.sort()
+    return files
+
+
+class WriteAheadLog:
+    """分段附加式日誌; append 只放入佇列, 由 flusher 執行緒批次寫入與 fsync"""
+
+    def __init__(self, directory, next_lsn=1, segment_bytes=64 << 20):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.condition = threading.Condition()
+        self.pending = []
+        self.lsn = next_lsn - 1
+        self.durable_lsn = self.lsn
+        self.rotate_requested = False
+        self.closing = False
+        self.fsyncs = 0
+        self._open_segment(next_lsn)
+        self.flusher = threading.Thread(target=self._flush_loop, name="wal-flusher", daemon=True)
+        self.flusher.start()
+
+    def _open_segment(self, first_lsn):
+        path = os.path.join(self.directory, f"{SEGMENT_PREFIX}{first_lsn:016d}.log")
+        self.file = open(path, "ab")
+        self.segment_size = self.file.tell()
+        _fsync_directory(self.directory)
+
+    def append(self, payload):
+        """加入一筆記錄, 回傳其 LSN; 需要持久化保證時再呼叫 wait"""
+        with self.condition:
+            if self.closing:
+                raise RuntimeError("Write-ahead log is closed")
+            self.lsn += 1
+            self.pending.append(encode_record(self.lsn, payload))
+            self.condition.notify_all()
+            return self.lsn
+
+    def wait(self, lsn):
+        """等待 LSN 之前的記錄都已 fsync"""
+        with self.condition:
+            while self.durable_lsn < lsn and self.flusher.is_alive():
+                self.condition.wait()
+            if self.durable_lsn < lsn:
+                raise RuntimeError("Write-ahead log flusher stopped before the record was durable")
+
+    def rotate(self):
+        """下一批寫入前改用新分段, 讓快照涵蓋的舊分段可以刪除"""
+        with self.condition:
+            self.rotate_requested = True
+            self.condition.notify_all()
+
+    def _flush_loop(self):
+        while True:
+            with self.condition:
+                while not self.pending and not self.closing:
+                    self.condition.wait()
+                if not self.pending:
+                    return
+                # fsync 期間新到的記錄留待下一批, 同批寫入共用一次 fsync
+                batch, self.pending = self.pending, []
+                last_lsn = self.lsn
+                rotate = self.rotate_requested
+                self.rotate_requested = False
+
+            if rotate or self.segment_size >= self.segment_bytes:
+                self.file.close()
+                self._open_segment(last_lsn - len(batch) + 1)
+            data = b"".join(batch)
+            self.file.write(data)
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.segment_size += len(data)
+
+            with self.condition:
+                self.durable_lsn = last_lsn
+                self.fsyncs += 1
+                self.condition.notify_all()
+
+    def close(self):
+        with self.condition:
+            self.closing = True
+            self.condition.notify_all()
+        self.flusher.join()
+        self.file.close()
+
+
+def write_snapshot(directory, lsn, items):
+    """寫出快照 (先寫暫存檔再 rename, 中途當機不影響舊快照), 回傳路徑"""
+    path = os.path.join(directory, f"{SNAPSHOT_PREFIX}{lsn:016d}.snap")
+    temporary = path + ".tmp"
+    with open(temporary, "wb") as file:
+        file.write(SNAPSHOT_MAGIC)
+        for item in items:
+            file.write(encode_record(lsn, list(item)))
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temporary, path)
+    _fsync_directory(directory)
+    return path
+
+
+def load_snapshot(path):
+    """以 mmap 讀取快照, 依序產生 (類型, id, 資源, 歷史); 舊格式的歷史為 None"""
+    buffer = _map_file(path)
+    if buffer is None or buffer[:len(SNAPSHOT_MAGIC)] not in (SNAPSHOT_MAGIC, LEGACY_SNAPSHOT_MAGIC):
+        raise ValueError(f"Invalid snapshot: {path}")
+    try:
+        for _, item in read_records(buffer, len(SNAPSHOT_MAGIC)):
+            if len(item) == 3:
+                item.append(None)
+            yield item
+    finally:
+        buffer.close()
+
+
+def replay_segments(directory, after_lsn):
+    """依序產生快照之後的日誌記錄 (LSN, 內容); LSN 不連續時停止"""
+    expected = None
+    for _, path in _numbered(directory, SEGMENT_PREFIX, ".log"):
+        buffer = _map_file(path)
+        if buffer is None:
+            continue
+        try:
+            for lsn, payload in read_records(buffer):
+                if lsn <= after_lsn:
+                    continue
+                if expected is not None and lsn != expected:
+                    return
+                expected = lsn + 1
+                yield lsn, payload
+        finally:
+            buffer.close()
+
+
+def prune(directory, snapshot_lsn):
+    """刪除較舊的快照與完全被快照涵蓋的日誌分段 (目前使用中的最後一段一律保留)"""
+    for lsn, path in _numbered(directory, SNAPSHOT_PREFIX, ".snap"):
+        if lsn < snapshot_lsn:
+            os.remove(path)
+    segments = _numbered(directory, SEGMENT_PREFIX, ".log")
+    for (first_lsn, path), (next_first, _) in zip(segments, segments[1:]):
+        if next_first - 1 <= snapshot_lsn:
+            os.remove(path)
+
+
+def _history_item(history):
+    """版本鏈轉為快照格式 [tombstone, [[versionId, lastUpdated, 方法, 差異], ...]]"""
+    if history is None:
+        return None
+    tombstone, entries = history
+    return [tombstone, [[entry.version_id, entry.last_updated, entry.method, entry.delta] for entry in entries]]
+
+
+class DurableFHIRResource(FHIRResource):
+    """記憶體模式加上寫前日誌: 查詢速度不變, 重啟後由快照與日誌還原
+
+    sync 為 True 時寫入在記錄 fsync 後才回傳; snapshot_records 為觸發背景快照的日誌筆數。
+    """
+
+    def __init__(self, directory, search_paths=None, result_cache_bytes=0, include_limit=1000, compact=False,
+                 sync=True, snapshot_records=100000, segment_bytes=64 << 20):
+        super().__init__(search_paths, result_cache_bytes, include_limit, compact)
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.sync = sync
+        self.snapshot_records = snapshot_records
+        self.snapshot_thread = None
+        self.wal = None
+        last_lsn = self._recover()
+        self.snapshot_lsn = last_lsn
+        self.wal = WriteAheadLog(directory, last_lsn + 1, segment_bytes)
+
+    def _recover(self):
+        """載入最新快照並重播其後的日誌, 回傳最後一筆的 LSN"""
+        last_lsn = 0
+        snapshots = _numbered(self.directory, SNAPSHOT_PREFIX, ".snap")
+        if snapshots:
+            last_lsn, path = snapshots[-1]
+            # 快照依類型連續存放, 同類型的資源整批放入, 索引一次建立
+            batch_type, batch = None, []
+            for resource_type, resource_id, resource, history in load_snapshot(path):
+                if resource_type != batch_type or len(batch) >= RECOVER_BATCH:
+                    self._restore(batch_type, batch)
+                    batch_type, batch = resource_type, []
+                batch.append((resource_id, resource, history))
+            self._restore(batch_type, batch)
+        for lsn, (op, resource_type, resource_id, resource) in replay_segments(self.directory, last_lsn):
+            if op == "apply":
+                # 交易為單一記錄, 不會只重播其中一部分
+                super().apply(resource)
+            elif op == "load":
+                self._load(resource_type, resource)
+            elif op == "delete":
+                self._remove(resource_type, resource_id)
+            else:
+                self._put(resource_type, resource_id, resource)
+            last_lsn = lsn
+        return last_lsn
+
+    def _restore(self, resource_type, batch):
+        """還原快照的一批 [(id, 資源, 歷史)]: 版本鏈直接還原, 不再記為新的 create"""
+        if not batch:
+            return
+        paths = self.search_paths.get(resource_type, {})
+        # 舊格式的快照沒有歷史, 只能以目前版本重新記錄
+        self._load(resource_type, [(resource_id, resource) for resource_id, resource, history in batch if history is None])
+        records = [bulk_record(resource_id, resource, paths)
+                   for resource_id, resource, history in batch if history is not None and resource is not None]
+        if records:
+            # 略過 FHIRResource.bulk_load 的歷史記錄, 索引與參照照常建立
+            super(FHIRResource, self).bulk_load(resource_type, records)
+        self.history.restore_many(resource_type, [(resource_id, *history)
+                                                  for resource_id, _, history in batch if history is not None])
+
+    def _load(self, resource_type, items):
+        """還原時整批放入 [(id, 資源)], 不寫日誌"""
+        if items:
+            paths = self.search_paths.get(resource_type, {})
+            super().bulk_load(resource_type, [bulk_record(resource_id, resource, paths) for resource_id, resource in items])
+
+    def _log(self, op, resource_type, resource_id, resource=None):
+        if self.wal is None:
+            return None
+        lsn = self.wal.append([op, resource_type, resource_id, resource])
+        if lsn - self.snapshot_lsn >= self.snapshot_records:
+            self.snapshot(wait=False)
+        return lsn
+
+    def _durable(self, lsn):
+        if lsn is not None and self.sync:
+            self.wal.wait(lsn)
+
+    # 套用變更與附加日誌在同一個寫入臨界區內, 日誌順序即套用順序
+    def create(self, resource_type, data):
+        with self.committing():
+            resource = super().create(resource_type, data)
+            lsn = self._log("create", resource_type, resource["id"], resource)
+        self._durable(lsn)
+        return resource
+
+    def update(self, resource_type, resource_id, data):
+        with self.committing():
+            resource = super().update(resource_type, resource_id, data)
+            lsn = None if resource is None else self._log("update", resource_type, resource_id, resource)
+        self._durable(lsn)
+        return resource
+
+    def delete(self, resource_type, resource_id):
+        with self.committing():
+            resource = super().delete(resource_type, resource_id)
+            lsn = None if resource is None else self._log("delete", resource_type, resource_id)
+        self._durable(lsn)
+        return resource
+
+    def apply(self, changes):
+        """整筆交易寫成一筆日誌記錄, 回傳其 LSN"""
+        with self.committing():
+            super().apply(changes)
+            return self._log("apply", None, None, [list(change) for change in changes])
+
+    def flush(self, token):
+        self._durable(token)
+
+    def bulk_load(self, resource_type, records):
+        """整批寫成 load 日誌記錄 (每筆至多 RECOVER_BATCH 個資源), fsync 後回傳"""
+        records = list(records)
+        with self.committing():
+            replaced = super().bulk_load(resource_type, records)
+            lsn = None
+            for start in range(0, len(records), RECOVER_BATCH):
+                lsn = self._log("load", resource_type, None, [[resource_id, resource] for resource_id, resource, _, _
+                                                               in records[start:start + RECOVER_BATCH]])
+        self._durable(lsn)
+        return replaced
+
+    def snapshot(self, wait=True):
+        """在背景寫出快照; 已有快照進行中時不重複啟動"""
+        with self.commit_lock:
+            if self.snapshot_thread is not None and self.snapshot_thread.is_alive():
+                thread = self.snapshot_thread
+            else:
+                # 資源寫入後不再修改, 分區的淺複製即為此 LSN 的一致狀態
+                lsn = self.wal.lsn
+                partitions = [(resource_type, partition.copy()) for resource_type, partition in self.resources.items()]
+                # 版本鏈也在同一時點複製; 之後的寫入只附加新版本, 由日誌重播
+                histories = self.history.export()
+                self.wal.rotate()
+                self.snapshot_lsn = lsn
+                thread = self.snapshot_thread = threading.Thread(
+                    target=self._write_snapshot, args=(lsn, partitions, histories), name="wal-snapshot", daemon=True
+                )
+                thread.start()
+        if wait:
+            thread.join()
+
+    def _write_snapshot(self, lsn, partitions, histories):
+        write_snapshot(self.directory, lsn, self._snapshot_items(partitions, histories))
+        # 快照涵蓋的記錄必須已寫入舊分段後才能刪除
+        self.wal.wait(lsn)
+        prune(self.directory, lsn)
+
+    def _snapshot_items(self, partitions, histories):
+        """依類型產生快照內容; 已刪除的資源只剩版本鏈, 接在同類型的資源之後"""
+        deleted = {}
+        for (resource_type, resource_id), (tombstone, _) in histories.items():
+            if tombstone is not None:
+                deleted.setdefault(resource_type, []).append(resource_id)
+        for resource_type, partition in partitions:
+            for resource_id, resource in partition.items():
+                yield resource_type, resource_id, resource, _history_item(histories.get((resource_type, resource_id)))
+            for resource_id in deleted.pop(resource_type, ()):
+                if resource_id not in partition:
+                    yield resource_type, resource_id, None, _history_item(histories[(resource_type, resource_id)])
+        for resource_type, resource_ids in deleted.items():
+            for resource_id in resource_ids:
+                yield resource_type, resource_id, None, _history_item(histories[(resource_type, resource_id)])
+
+    def close(self):
+        """等待進行中的快照並關閉日誌"""
+        thread = self.snapshot_thread
+        if thread is not None:
+            thread.join()
+        self.wal.close()
@@ -0,0 +1,195 @@
+"""
+共用工作池
+
+整個程序共用一組固定數量的工作執行緒, 供批量處理等移出 IOLoop 的工作使用。
+- 各用戶端各有一條佇列, 工作執行緒依序輪流取用, 大量請求的用戶端不會餓死其他用戶端
+- 允入控制在請求開始時進行: 全體佇列已滿回應 503, 單一用戶端進行中的請求過多回應 429,
+  兩者皆附 Retry-After; 已允入的請求送出的工作一律排入佇列, 不會中途被拒
+- stats() 提供佇列深度、等待時間與忙碌中的工作執行緒數, 供負載測試時調整大小
+
+WorkerPool 為 concurrent.futures.Executor, 可直接傳給 loop.run_in_executor;
+工作所屬的用戶端取自 current_client (contextvars), 由 admit() 或 as_client() 設定。
+"""
+import contextvars
+import math
+import threading
+import time
+from collections import deque
+from concurrent.futures import Executor, Future
+from contextlib import contextmanager
+
+current_client = contextvars.ContextVar("current_client", default=None)
+
+
+class PoolSaturated(Exception):
+    """工作池無法再接受請求; status 為 429 或 503, retry_after 為建議的重試秒數"""
+
+    def __init__(self, message, status, retry_after):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+
+class WorkerPool(Executor):
+    def __init__(self, max_workers=10, max_queue=1000, max_client_requests=8):
+        self.max_workers = max_workers
+        # 允入時的佇列深度上限
+        self.max_queue = max_queue
+        # 單一用戶端同時進行中的請求上限
+        self.max_client_requests = max_client_requests
+        self.condition = threading.Condition()
+        # 用戶端 -> 待執行工作 (future, fn, args, kwargs, 排入時間)
+        self.queues = {}
+        # 有待執行工作的用戶端, 依輪流順序
+        self.rotation = deque()
+        self.depth = 0
+        self.active = 0
+        self.requests = {}
+        self.shutting_down = False
+        # 等待時間與執行時間的統計 (指數移動平均)
+        self.completed = 0
+        self.rejected = {"429": 0, "503": 0}
+        self.wait_average = 0.0
+        self.wait_max = 0.0
+        self.run_average = 0.0
+        self.threads = [
+            threading.Thread(target=self._work, name=f"worker-pool-{number}", daemon=True)
+            for number in range(max_workers)
+        ]
+        for thread in self.threads:
+            thread.start()
+
+    def submit(self, fn, /, *args, **kwargs):
+        future = Future()
+        client = current_client.get()
+        with self.condition:
+            if self.shutting_down:
+                raise RuntimeError("Worker pool is shut down")
+            queue = self.queues.get(client)
+            if queue is None:
+                queue = self.queues[client] = deque()
+                self.rotation.append(client)
+            queue.append((future, fn, args, kwargs, time.monotonic()))
+            self.depth += 1
+            self.condition.notify()
+        return future
+
+    def _next(self):
+        """輪流取下一個用戶端的最早工作; 呼叫端需持有 condition"""
+        client = self.rotation.popleft()
+        queue = self.queues[client]
+        task = queue.popleft()
+        if queue:
+            self.rotation.append(client)
+        else:
+            del self.queues[client]
+        self.depth -= 1
+        return task
+
+    def _work(self):
+        while True:
+            with self.condition:
+                while not self.rotation and not self.shutting_down:
+                    self.condition.wait()
+                if not self.rotation:
+                    return
+                future, fn, args, kwargs, enqueued = self._next()
+                self.active += 1
+            started = time.monotonic()
+            if future.set_running_or_notify_cancel():
+                try:
+                    future.set_result(fn(*args, **kwargs))
+                except BaseException as e:
+                    future.set_exception(e)
+            finished = time.monotonic()
+            with self.condition:
+                self.active -= 1
+                self.completed += 1
+                waited = started - enqueued
+                self.wait_average += (waited - self.wait_average) * 0.05
+                self.wait_max = max(self.wait_max, waited)
+                self.run_average += ((finished - started) - self.run_average) * 0.05
+
+    def retry_after(self):
+        """依目前佇列深度與平均執行時間估計清空佇列所需秒數"""
+        with self.condition:
+            return max(1, math.ceil(self.depth * self.run_average / self.max_workers))
+
+    def acquire(self, client):
+        """允入一個請求; 無法接受時拋出 PoolSaturated, 允入後須呼叫 release"""
+        with self.condition:
+            if self.depth >= self.max_queue:
+                self.rejected["503"] += 1
+                status, message = "503", f"Worker pool queue is full ({self.depth} tasks waiting)"
+            elif self.requests.get(client, 0) >= self.max_client_requests:
+                self.rejected["429"] += 1
+                status, message = "429", f"Too many concurrent requests from {client}"
+            else:
+                self.requests[client] = self.requests.get(client, 0) + 1
+                return
+        raise PoolSaturated(message, status, self.retry_after())
+
+    def release(self, client):
+        with self.condition:
+            self.requests[client] -= 1
+            if not self.requests[client]:
+                del self.requests[client]
+
+    @contextmanager
+    def as_client(self, client):
+        """期間送出的工作歸屬於 client"""
+        token = current_client.set(client)
+        try:
+            yield
+        finally:
+            current_client.reset(token)
+
+    @contextmanager
+    def admit(self, client):
+        """允入一個請求並設定 current_client; 無法接受時拋出 PoolSaturated"""
+        self.acquire(client)
+        try:
+            with self.as_client(client):
+                yield
+        finally:
+            self.release(client)
+
+    def stats(self):
+        with self.condition:
+            return {
+                "maxWorkers": self.max_workers,
+                "activeWorkers": self.active,
+                "queueDepth": self.depth,
+                "maxQueue": self.max_queue,
+                "queuedByClient": {str(client): len(queue) for client, queue in self.queues.items()},
+                "activeRequests": sum(self.requests.values()),
+                "completed": self.completed,
+                "rejected": dict(self.rejected),
+                "waitAverageMs": self.wait_average * 1000,
+                "waitMaxMs": self.wait_max * 1000,
+                "runAverageMs": self.run_average * 1000,
+            }
+
+    def shutdown(self, wait=True, *, cancel_futures=False):
+        with self.condition:
+            self.shutting_down = True
+            if cancel_futures:
+                while self.rotation:
+                    self._next()[0].cancel()
+            self.condition.notify_all()
+        if wait:
+            for thread in self.threads:
+                thread.join()
+
+
+_shared = None
+_shared_lock = threading.Lock()
+
+
+def shared_pool(max_workers=10, max_queue=1000, max_client_requests=8):
+    """程序共用的預設工作池, 第一次呼叫時依參數建立"""
+    global _shared
+    with _shared_lock:
+        if _shared is None:
+            _shared = WorkerPool(max_workers, max_queue, max_client_requests)
+        return _shared
@@ -0,0 +1,307 @@
+"""
+批次匯入 ($import)
+
+由 NDJSON 檔案 (每行一筆資源, 每個檔案一種類型) 大量載入資源, 不逐筆經過 create:
+- 檔案依位元組範圍切成以換行對齊的區塊, 由程序池平行解碼、驗證, 並預先取出索引值與參照
+- 資源保留原本的 id, 沒有 id 時才配置 uuid; meta 缺少的 versionId 與 lastUpdated
+  以 "1" 與整次匯入共用的時間補上, 不逐筆取得目前時間
+- 預設 (batch_size 為 0) 同類型全部解析完才呼叫一次 bulk_load, 索引只建立一次;
+  指定 batch_size 時每累積該筆數放入一批, 以限制主程序保留的記錄數 (每批都會合併一次範圍索引)
+- 同一 id 重複出現時後者為新版本: 先放入目前這批, 再開始新的一批, versionId 與歷史由 bulk_load 接續
+- 格式錯誤或類型不符的行略過並記錄位置, 報告含各類型筆數與每秒處理的資源數
+
+命令列:
+    python 批次匯入.py [--database 檔案 | --log-directory 目錄] [--workers N] 檔案.ndjson ...
+類型取自檔名 (Patient.ndjson、Patient.000.ndjson), 或以 類型=路徑 指定。
+"""
+import argparse
+import multiprocessing
+import os
+import re
+import time
+import uuid
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+
+from tornado.ioloop import IOLoop
+
+from advServer import FHIRHandler
+from 編解碼 import JSONDecodeError, loads
+from 搜尋索引 import bulk_record
+from 工作池 import PoolSaturated
+
+ID_RE = re.compile(r"^[A-Za-z0-9\-.]{1,64}$")
+
+
+def input_type(path):
+    """由檔名取得資源類型: Patient.ndjson、Patient.000.ndjson -> Patient"""
+    return os.path.basename(path).split(".")[0]
+
+
+def split_file(path, chunk_bytes):
+    """將檔案切成約 chunk_bytes 大小、結尾對齊換行的 (起點, 終點) 位元組範圍"""
+    size = os.path.getsize(path)
+    ranges = []
+    with open(path, "rb") as f:
+        start = 0
+        while start < size:
+            end = start + chunk_bytes
+            if end < size:
+                f.seek(end)
+                f.readline()
+                end = f.tell()
+            end = min(end, size)
+            ranges.append((start, end))
+            start = end
+    return ranges
+
+
+def _invalid(resource, resource_type):
+    """驗證單筆資源, 回傳錯誤訊息; 正確時回傳 None"""
+    if not isinstance(resource, dict):
+        return "Resource must be a JSON object"
+    if resource.get("resourceType") != resource_type:
+        return f"Expected resourceType {resource_type}, got {resource.get('resourceType')!r}"
+    if "id" in resource and not (isinstance(resource["id"], str) and ID_RE.match(resource["id"])):
+        return f"Invalid id: {resource['id']!r}"
+    if not isinstance(resource.get("meta", {}), dict):
+        return "meta must be a JSON object"
+    return None
+
+
+def parse_chunk(path, start, end, resource_type, paths, last_updated):
+    """於工作程序解析一個區塊, 回傳 (bulk_load 的記錄, [(位元組位置, 錯誤訊息)])"""
+    with open(path, "rb") as f:
+        f.seek(start)
+        data = f.read(end - start)
+    records = []
+    errors = []
+    offset = start
+    for line in data.split(b"\n"):
+        position = offset
+        offset += len(line) + 1
+        if not line.strip():
+            continue
+        try:
+            resource = loads(line)
+        except JSONDecodeError as e:
+            errors.append((position, f"Invalid JSON: {e}"))
+            continue
+        message = _invalid(resource, resource_type)
+        if message is not None:
+            errors.append((position, message))
+            continue
+        resource_id = resource.setdefault("id", str(uuid.uuid4()))
+        meta = resource.setdefault("meta", {})
+        meta.setdefault("versionId", "1")
+        meta.setdefault("lastUpdated", last_updated)
+        records.append(bulk_record(resource_id, resource, paths))
+    return records, errors
+
+
+class BulkImporter:
+    """將 NDJSON 檔案整批匯入 fhir_resource; workers 為解析用的程序數 (預設為 CPU 數)"""
+
+    def __init__(self, fhir_resource, workers=None, batch_size=0, chunk_bytes=8 << 20, max_errors=100):
+        self.fhir_resource = fhir_resource
+        self.workers = workers or os.cpu_count() or 1
+        self.batch_size = batch_size
+        self.chunk_bytes = chunk_bytes
+        # 報告中保留的錯誤筆數上限 (總數另計)
+        self.max_errors = max_errors
+
+    def run(self, inputs):
+        """inputs 為 [(類型, 檔案路徑)], 回傳匯入報告"""
+        started = time.perf_counter()
+        last_updated = datetime.now(timezone.utc).isoformat()
+        tasks = [
+            (resource_type, path, start, end)
+            for resource_type, path in inputs
+            for start, end in split_file(path, self.chunk_bytes)
+        ]
+        self.counts = {resource_type: 0 for resource_type, _ in inputs}
+        self.load_seconds = 0.0
+        errors = []
+        error_count = 0
+        batch_type, batch = None, {}
+        # spawn: 伺服器程序有其他執行緒, 不以 fork 複製其鎖的狀態
+        context = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(self.workers, mp_context=context) as pool:
+            for resource_type, path, records, chunk_errors in self._parse(pool, tasks, last_updated):
+                error_count += len(chunk_errors)
+                for position, message in chunk_errors[:max(0, self.max_errors - len(errors))]:
+                    errors.append({"file": path, "offset": position, "message": message})
+                if resource_type != batch_type:
+                    self._load(batch_type, batch)
+                    batch_type, batch = resource_type, {}
+                for record in records:
+                    if record[0] in batch:
+                        # 同一批內不能有重複的 id, 先放入前一版本再開始新的一批
+                        self._load(batch_type, batch)
+                        batch = {}
+                    batch[record[0]] = record
+                if self.batch_size and len(batch) >= self.batch_size:
+                    self._load(batch_type, batch)
+                    batch = {}
+        self._load(batch_type, batch)
+        seconds = time.perf_counter() - started
+        total = sum(self.counts.values())
+        return {
+            "types": self.counts,
+            "total": total,
+            "errorCount": error_count,
+            "errors": errors,
+            "seconds": seconds,
+            "loadSeconds": self.load_seconds,
+            "resourcesPerSecond": total / seconds if seconds else 0.0,
+        }
+
+    def _parse(self, pool, tasks, last_updated):
+        """依序產生各區塊的解析結果, 同時進行中的區塊不超過程序數的兩倍"""
+        search_paths = self.fhir_resource.search_paths
+        pending = deque()
+        tasks = iter(tasks)
+        while True:
+            while len(pending) < self.workers * 2:
+                task = next(tasks, None)
+                if task is None:
+                    break
+                resource_type, path, start, end = task
+                future = pool.submit(parse_chunk, path, start, end, resource_type,
+                                     search_paths.get(resource_type, {}), last_updated)
+                pending.append((resource_type, path, future))
+            if not pending:
+                return
+            resource_type, path, future = pending.popleft()
+            records, errors = future.result()
+            yield resource_type, path, records, errors
+
+    def _load(self, resource_type, batch):
+        if not batch:
+            return
+        started = time.perf_counter()
+        self.fhir_resource.bulk_load(resource_type, list(batch.values()))
+        self.load_seconds += time.perf_counter() - started
+        self.counts[resource_type] += len(batch)
+
+
+def report_parameters(report):
+    """匯入報告轉為 Parameters 資源"""
+    parameters = [
+        {"name": "outcome", "part": [
+            {"name": "type", "valueCode": resource_type},
+            {"name": "count", "valueInteger": count},
+        ]}
+        for resource_type, count in report["types"].items()
+    ]
+    parameters += [
+        {"name": "total", "valueInteger": report["total"]},
+        {"name": "errorCount", "valueInteger": report["errorCount"]},
+        {"name": "seconds", "valueDecimal": round(report["seconds"], 3)},
+        {"name": "resourcesPerSecond", "valueDecimal": round(report["resourcesPerSecond"], 1)},
+    ]
+    parameters += [
+        {"name": "error", "valueString": f"{error['file']}@{error['offset']}: {error['message']}"}
+        for error in report["errors"]
+    ]
+    return {"resourceType": "Parameters", "parameter": parameters}
+
+
+class ImportHandler(FHIRHandler):
+    """POST /$import: Parameters 的各 input 以 type 與 url 指定類型及 import_directory 內的 NDJSON 檔案
+
+    匯入完成後回應報告 (Parameters); 檔案須位於伺服器的 import_directory 之下。
+    匯入在共用工作池中執行, 與批量請求一樣經過允入控制 (429/503 附 Retry-After)。
+    """
+
+    def initialize(self, fhir_resource, import_directory, pool, workers=None):
+        super().initialize(fhir_resource)
+        self.import_directory = os.path.realpath(import_directory)
+        self.pool = pool
+        self.workers = workers
+
+    def _inputs(self, parameters):
+        if not isinstance(parameters, dict) or parameters.get("resourceType") != "Parameters":
+            raise ValueError("$import expects a Parameters resource")
+        inputs = []
+        for parameter in parameters.get("parameter", []):
+            if parameter.get("name") != "input":
+                continue
+            parts = {part.get("name"): part for part in parameter.get("part", [])}
+            url = (parts.get("url") or {}).get("valueUri") or (parts.get("url") or {}).get("valueUrl")
+            if not url:
+                raise ValueError("Each input requires a url")
+            path = os.path.realpath(os.path.join(self.import_directory, url.removeprefix("file://")))
+            if os.path.commonpath([path, self.import_directory]) != self.import_directory or not os.path.isfile(path):
+                raise ValueError(f"Input file not found in the import directory: {url}")
+            resource_type = (parts.get("type") or {}).get("valueCode") or input_type(path)
+            inputs.append((resource_type, path))
+        if not inputs:
+            raise ValueError("No input parameters")
+        return inputs
+
+    async def post(self):
+        try:
+            inputs = self._inputs(loads(self.request.body))
+        except (JSONDecodeError, ValueError) as e:
+            self.set_status(400)
+            self.write_json({"resourceType": "OperationOutcome",
+                             "issue": [{"severity": "error", "code": "invalid", "diagnostics": str(e)}]})
+            return
+        importer = BulkImporter(self.fhir_resource, self.workers)
+        client = self.request.headers.get("X-Client-Id") or self.request.remote_ip
+        try:
+            with self.pool.admit(client):
+                report = await IOLoop.current().run_in_executor(self.pool, importer.run, inputs)
+        except PoolSaturated as e:
+            self.set_status(int(e.status))
+            self.set_header("Retry-After", str(e.retry_after))
+            self.write_json({"resourceType": "OperationOutcome",
+                             "issue": [{"severity": "error", "code": "throttled", "diagnostics": str(e)}]})
+            return
+        self.write_json(report_parameters(report))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Bulk import NDJSON files")
+    parser.add_argument("files", nargs="+", help="NDJSON file, or Type=path")
+    target = parser.add_mutually_exclusive_group()
+    target.add_argument("--database", help="SQLite database file")
+    target.add_argument("--log-directory", help="WAL and snapshot directory")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--batch-size", type=int, default=0,
+                        help="resources per bulk load (default 0: each type in a single batch)")
+    args = parser.parse_args()
+
+    if args.database is not None:
+        from 資料庫儲存 import SQLiteFHIRResource
+        fhir_resource = SQLiteFHIRResource(args.database)
+    elif args.log_directory is not None:
+        from 寫前日誌 import DurableFHIRResource
+        fhir_resource = DurableFHIRResource(args.log_directory)
+    else:
+        from 資源搜尋 import FHIRResource
+        fhir_resource = FHIRResource()
+
+    inputs = []
+    for item in args.files:
+        resource_type, separator, path = item.partition("=")
+        inputs.append((resource_type, path) if separator else (input_type(item), item))
+    report = BulkImporter(fhir_resource, args.workers, args.batch_size).run(inputs)
+
+    for resource_type, count in report["types"].items():
+        print(f"{resource_type:<20} {count:>10}")
+    for error in report["errors"]:
+        print(f"{error['file']}@{error['offset']}: {error['message']}")
+    if report["errorCount"] > len(report["errors"]):
+        print(f"... {report['errorCount'] - len(report['errors'])} more errors")
+    print(f"{report['total']} resources in {report['seconds']:.2f}s "
+          f"({report['resourcesPerSecond']:.0f} resources/s, load {report['loadSeconds']:.2f}s)")
+    close = getattr(fhir_resource, "close", None)
+    if close is not None:
+        close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,148 @@
+"""
+Bundle 項目的相依關係
+
+由 Bundle 內的參照與條件式 URL 建立相依圖 (DAG), 再依 FHIR 交易處理順序
+(DELETE、POST、PUT/PATCH、GET) 分成可同時執行的批次:
+- 資源內參照其他項目的 fullUrl (如 urn:uuid:...) 時, 須等該項目寫入並取得 id;
+  交易中非條件式 POST 的 id 事先配置 (assign_ids), 參照它們的項目直接改寫, 不需等待,
+  因此 POST 之間可以互相參照, 只有條件式寫入或 PUT 之間的循環才無法排定
+- 條件式參照 (Patient?identifier=...)、條件式 create/update/delete 與搜尋須等同類型中
+  處理順序較早的寫入完成, 才能看到一致的結果
+每一批次取目前可執行 (相依項目皆已完成) 且處理順序最前的項目。
+"""
+import uuid
+from urllib.parse import parse_qs
+
+METHOD_ORDER = {"DELETE": 0, "POST": 1, "PUT": 2, "PATCH": 2, "GET": 3, "HEAD": 3}
+WRITE_METHODS = {"DELETE", "POST", "PUT", "PATCH"}
+
+
+def iter_references(value):
+    """產生資源中所有 Reference 物件 (含 reference 字串欄位的 dict)"""
+    if isinstance(value, dict):
+        if isinstance(value.get("reference"), str):
+            yield value
+        for item in value.values():
+            yield from iter_references(item)
+    elif isinstance(value, list):
+        for item in value:
+            yield from iter_references(item)
+
+
+def rewrite_references(value, rewrite):
+    """依 rewrite(參照字串) 的結果改寫參照, 回傳新物件; 未改變的部分沿用原物件"""
+    if isinstance(value, dict):
+        changed = {}
+        for key, item in value.items():
+            if key == "reference" and isinstance(item, str):
+                new_item = rewrite(item)
+            else:
+                new_item = rewrite_references(item, rewrite)
+            if new_item is not item:
+                changed[key] = new_item
+        return {**value, **changed} if changed else value
+    if isinstance(value, list):
+        items = [rewrite_references(item, rewrite) for item in value]
+        return items if any(new is not old for new, old in zip(items, value)) else value
+    return value
+
+
+def conditional_query(reference):
+    """"Type?query" 形式回傳 (類型, 搜尋參數), 否則回傳 None"""
+    if "?" not in reference or reference.startswith(("urn:", "http:", "https:")):
+        return None
+    resource_type, _, query = reference.partition("?")
+    resource_type = resource_type.strip("/")
+    if not resource_type or "/" in resource_type:
+        return None
+    return resource_type, parse_qs(query)
+
+
+class BundleEntry:
+    """單一項目在相依圖中的資訊"""
+    __slots__ = ("index", "method", "resource_type", "full_url", "conditional", "references")
+
+    def __init__(self, index, entry):
+        request = entry["request"]
+        self.index = index
+        self.method = request["method"]
+        resource = entry.get("resource")
+        url = request["url"]
+        path = url.partition("?")[0].strip("/")
+        if resource is not None and "resourceType" in resource:
+            self.resource_type = resource["resourceType"]
+        else:
+            self.resource_type = path.split("/")[0]
+        self.full_url = entry.get("fullUrl")
+        # 需要搜尋 store 才能決定目標的項目 (條件式 URL 或 ifNoneExist)
+        self.conditional = "?" in url or bool(request.get("ifNoneExist"))
+        self.references = [ref["reference"] for ref in iter_references(resource)] if resource is not None else []
+
+    @property
+    def order(self):
+        return METHOD_ORDER.get(self.method, len(METHOD_ORDER))
+
+
+class BundleGraph:
+    def __init__(self, entries, assign_ids=False):
+        self.entries = [BundleEntry(index, entry) for index, entry in enumerate(entries)]
+        # 事先配置的 id: 項目位置 -> "Type/id", 執行時以此 id 建立
+        self.assigned = {}
+        if assign_ids:
+            self.assigned = {
+                entry.index: f"{entry.resource_type}/{uuid.uuid4()}"
+                for entry in self.entries
+                if entry.full_url and entry.method == "POST" and not entry.conditional
+            }
+        # 執行後才能決定資源 id 的項目, 其 fullUrl 可被其他項目參照
+        self.providers = {
+            entry.full_url: entry.index
+            for entry in self.entries
+            if entry.full_url and entry.method in ("POST", "PUT") and entry.index not in self.assigned
+        }
+        # requires: 需要其寫入結果 (id) 的項目, 失敗時本項目也無法執行
+        self.requires = [self._requires(entry) for entry in self.entries]
+        # dependencies: 必須先完成的項目 (requires 加上條件式搜尋的先後順序)
+        self.dependencies = [self._dependencies(entry) for entry in self.entries]
+        # 可同時執行的各批項目位置; 建立時即排定, 有循環相依時拋出 ValueError
+        self.waves = self._schedule()
+
+    def assigned_references(self):
+        """事先配置 id 的 fullUrl -> "Type/id", 供改寫參照"""
+        return {self.entries[index].full_url: reference for index, reference in self.assigned.items()}
+
+    def _requires(self, entry):
+        providers = (self.providers.get(reference) for reference in entry.references)
+        return {provider for provider in providers if provider is not None and provider != entry.index}
+
+    def _dependencies(self, entry):
+        depends = set(self.requires[entry.index])
+        searched_types = set()
+        if entry.conditional:
+            searched_types.add(entry.resource_type)
+        for reference in entry.references:
+            query = conditional_query(reference)
+            if query is not None and reference not in self.providers:
+                searched_types.add(query[0])
+        # 搜尋時要看到同類型中處理順序較早 (同順序則位置較前) 的寫入
+        for other in self.entries:
+            if (other.resource_type in searched_types and other.method in WRITE_METHODS
+                    and (other.order, other.index) < (entry.order, entry.index)):
+                depends.add(other.index)
+        return depends
+
+    def _schedule(self):
+        waves = []
+        remaining = {entry.index for entry in self.entries}
+        done = set()
+        while remaining:
+            ready = [index for index in remaining if self.dependencies[index] <= done]
+            if not ready:
+                cycle = ", ".join(self.entries[index].full_url or str(index) for index in sorted(remaining))
+                raise ValueError(f"Circular references between bundle entries: {cycle}")
+            order = min(self.entries[index].order for index in ready)
+            wave = sorted(index for index in ready if self.entries[index].order == order)
+            waves.append(wave)
+            remaining.difference_update(wave)
+            done.update(wave)
+        return waves
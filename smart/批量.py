@@ -1,18 +1,33 @@
+import tornado.web
 from tornado.ioloop import IOLoop
 from tornado.web import Application, RequestHandler
-import json
 from datetime import datetime
 import uuid
 from urllib.parse import parse_qs
 import re
 from dateutil import parser as date_parser
-from concurrent.futures import ThreadPoolExecutor
 import asyncio
+import sys
+from 資源搜尋 import FHIRResource
+from 資料庫儲存 import SQLiteFHIRResource
+from 寫前日誌 import DurableFHIRResource
+from 版本歷史 import FHIRHistoryHandler
+from 編解碼 import dumps
+from 交易 import Transaction, TransactionConflict, TransactionError
+from 批次相依 import BundleGraph, conditional_query, rewrite_references
+from 工作池 import PoolSaturated, shared_pool
+from 串流解析 import BundleStreamParser
+from 批次匯入 import ImportHandler
+from advServer import FHIRResourceHandler, FHIRTypeHandler
 
 class BatchOperation:
-    def __init__(self, fhir_resource):
+    # 交易提交時讀取衝突的重試次數
+    TRANSACTION_RETRIES = 3
+
+    def __init__(self, fhir_resource, executor=None):
         self.fhir_resource = fhir_resource
-        self.executor = ThreadPoolExecutor(max_workers=10)
+        # 各請求共用同一個工作池, 不在每次請求建立執行緒
+        self.executor = shared_pool() if executor is None else executor
 
     async def process_batch(self, batch_data):
         """處理批量請求"""
@@ -22,98 +37,214 @@ class BatchOperation:
         if batch_data.get("type") not in ["batch", "transaction"]:
             raise ValueError("Bundle type must be 'batch' or 'transaction'")
 
-        is_transaction = batch_data["type"] == "transaction"
-        
-        # 交易模式下的預檢查
-        if is_transaction:
-            try:
-                self._validate_transaction(batch_data["entry"])
-            except ValueError as e:
-                return self._create_error_response(str(e))
+        entries = batch_data.get("entry", [])
+        if batch_data["type"] == "transaction":
+            return await self._process_transaction(entries)
 
-        responses = []
-        
+        # 創建回應Bundle
+        return {
+            "resourceType": "Bundle",
+            "type": "batch-response",
+            "entry": await self.process_entries(entries)
+        }
+
+    async def process_entries(self, entries, resolved=None):
+        """執行 batch 的一批 entry, 回傳與 entry 一一對應的回應
+
+        batch 的各項目獨立成敗, 直接寫入 store。串流模式逐批呼叫, resolved 跨批共用,
+        後面批次的項目可參照前面批次寫入的 fullUrl。
+        """
         try:
-            # 使用線程池處理每個請求
-            loop = asyncio.get_event_loop()
-            futures = []
-            
-            for entry in batch_data["entry"]:
-                request = entry["request"]
-                method = request["method"]
-                url = request["url"]
-                
-                if method == "POST":
-                    futures.append(loop.run_in_executor(
-                        self.executor,
-                        self._process_create,
-                        entry["resource"]
-                    ))
-                elif method == "PUT":
-                    resource_type, resource_id = self._parse_url(url)
-                    futures.append(loop.run_in_executor(
-                        self.executor,
-                        self._process_update,
-                        resource_type,
-                        resource_id,
-                        entry["resource"]
-                    ))
-                elif method == "DELETE":
-                    resource_type, resource_id = self._parse_url(url)
-                    futures.append(loop.run_in_executor(
-                        self.executor,
-                        self._process_delete,
-                        resource_type,
-                        resource_id
-                    ))
-                elif method == "GET":
-                    resource_type, resource_id = self._parse_url(url)
-                    futures.append(loop.run_in_executor(
-                        self.executor,
-                        self._process_read,
-                        resource_type,
-                        resource_id
-                    ))
-                else:
-                    responses.append({
-                        "status": "400",
-                        "outcome": self._create_operation_outcome(
-                            f"Unsupported method: {method}"
-                        )
-                    })
-                    continue
+            graph = BundleGraph(entries)
+        except (KeyError, TypeError, ValueError) as e:
+            outcome = self._create_operation_outcome(str(e))
+            return [{"status": "400", "outcome": outcome} for _ in entries]
+        return await self._run_graph(entries, graph, self.fhir_resource, resolved)
 
-            # 等待所有操作完成
-            results = await asyncio.gather(*futures, return_exceptions=True)
-            
-            # 處理結果
-            for result in results:
-                if isinstance(result, Exception):
-                    responses.append({
-                        "status": "400",
-                        "outcome": self._create_operation_outcome(str(result))
-                    })
-                else:
-                    responses.append(result)
-
-        except Exception as e:
-            if is_transaction:
-                # 交易模式下，任何錯誤都會導致整個操作回滾
-                return self._create_error_response(
-                    "Transaction failed, all changes have been rolled back"
-                )
-            responses.append({
-                "status": "400",
-                "outcome": self._create_operation_outcome(str(e))
-            })
+    async def _process_transaction(self, entries):
+        """交易: 全部成功才提交, 否則 store 不留下任何變更"""
+        try:
+            self._validate_transaction(entries)
+            # 交易內全部一起提交, POST 的 id 可事先配置, 互相參照的 urn:uuid 不構成循環
+            graph = BundleGraph(entries, assign_ids=True)
+        except (KeyError, TypeError, ValueError) as e:
+            return self._create_error_response(str(e))
 
-        # 創建回應Bundle
+        loop = asyncio.get_event_loop()
+        try:
+            for attempt in range(self.TRANSACTION_RETRIES):
+                transaction = Transaction(self.fhir_resource)
+                responses = await self._run_graph(entries, graph, transaction)
+                try:
+                    await loop.run_in_executor(self.executor, transaction.commit)
+                    break
+                except TransactionConflict:
+                    # 讀過的資源被其他請求變更, 以新的狀態重新執行整筆交易
+                    if attempt == self.TRANSACTION_RETRIES - 1:
+                        raise
+        except TransactionError as e:
+            return self._create_error_response(
+                f"Transaction failed, no changes were applied: {e}", e.status
+            )
         return {
             "resourceType": "Bundle",
-            "type": "batch-response",
+            "type": "transaction-response",
             "entry": responses
         }
 
+    async def _run_graph(self, entries, graph, target, resolved=None):
+        """依相依圖分批執行, 同一批的項目同時送入線程池
+
+        target 為 Transaction (交易) 或 store 本身 (batch)。交易中任一項目失敗即拋出
+        TransactionError; batch 則記錄該項目的錯誤, 相依於它的項目回應 424。
+        """
+        is_transaction = isinstance(target, Transaction)
+        loop = asyncio.get_event_loop()
+        responses = [None] * len(entries)
+        # 項目 fullUrl -> 寫入後的 "Type/id", 供後續項目改寫參照
+        resolved = {} if resolved is None else resolved
+        resolved.update(graph.assigned_references())
+        failed = set()
+        for wave in graph.waves:
+            runnable = []
+            for index in wave:
+                if graph.requires[index] & failed:
+                    failed.add(index)
+                    responses[index] = {
+                        "status": "424",
+                        "outcome": self._create_operation_outcome(
+                            "Entry depends on a failed entry in the same bundle"
+                        )
+                    }
+                else:
+                    runnable.append(index)
+            results = await asyncio.gather(*(
+                loop.run_in_executor(self.executor, self._execute_entry, target, entries[index], resolved,
+                                     graph.assigned.get(index))
+                for index in runnable
+            ), return_exceptions=True)
+            for index, result in zip(runnable, results):
+                if isinstance(result, Exception):
+                    if is_transaction:
+                        if isinstance(result, TransactionError):
+                            raise result
+                        raise TransactionError(f"Invalid entry {index}: {result}")
+                    failed.add(index)
+                    responses[index] = {
+                        "status": getattr(result, "status", "400"),
+                        "outcome": self._create_operation_outcome(str(result))
+                    }
+                    continue
+                response, reference = result
+                responses[index] = response
+                full_url = entries[index].get("fullUrl")
+                if full_url and reference:
+                    resolved[full_url] = reference
+        return responses
+
+    def _execute_entry(self, target, entry, resolved, assigned=None):
+        """執行單一項目, 回傳 (回應, 寫入或讀取的 "Type/id"); 失敗時拋出 TransactionError
+
+        assigned 為交易事先配置給此 POST 的 "Type/id"。
+        """
+        request = entry["request"]
+        method = request["method"]
+        url = request["url"]
+        resource = entry.get("resource")
+        if resource is not None:
+            resource = self._resolve_references(target, resource, resolved)
+
+        if method == "POST":
+            resource_type = resource["resourceType"]
+            if_none_exist = request.get("ifNoneExist")
+            if if_none_exist:
+                # 條件式 create: 已有唯一符合的資源時不建立
+                existing = self._match_one(target, resource_type, parse_qs(if_none_exist))
+                if existing is not None:
+                    reference = f"{resource_type}/{existing}"
+                    return {
+                        "status": "200",
+                        "location": reference,
+                        "resource": target.read(resource_type, existing)
+                    }, reference
+            if assigned is not None:
+                result = target.create(resource_type, resource, assigned.partition("/")[2])
+            else:
+                result = target.create(resource_type, resource)
+            reference = f"{resource_type}/{result['id']}"
+            return {"status": "201", "location": reference, "resource": result}, reference
+        if method not in ("PUT", "DELETE", "GET"):
+            raise TransactionError(f"Unsupported method: {method}")
+
+        path, _, query = url.partition("?")
+        if query:
+            return self._execute_conditional(target, method, path.strip("/"), parse_qs(query), resource)
+
+        resource_type, resource_id = self._parse_url(url)
+        reference = f"{resource_type}/{resource_id}"
+        if method == "PUT":
+            result = target.update(resource_type, resource_id, resource)
+        elif method == "DELETE":
+            result = target.delete(resource_type, resource_id)
+        else:
+            result = target.read(resource_type, resource_id)
+        if result is None:
+            raise TransactionError(f"Resource {reference} not found", "404")
+        if method == "DELETE":
+            return {"status": "204"}, None
+        return {"status": "200", "resource": result}, reference
+
+    def _execute_conditional(self, target, method, resource_type, params, resource):
+        """條件式 update/delete 與搜尋 (url 為 Type?query)"""
+        if method == "GET":
+            if isinstance(target, Transaction):
+                # 交易內的搜尋要看到同一交易先前的寫入與刪除
+                bundle = target.search(resource_type, params)
+            else:
+                bundle = self.fhir_resource.snapshot_read(self.fhir_resource.search, resource_type, params)
+            return {"status": "200", "resource": bundle}, None
+        resource_id = self._match_one(target, resource_type, params)
+        if method == "DELETE":
+            if resource_id is None:
+                raise TransactionError(f"No {resource_type} matches the conditional delete", "404")
+            target.delete(resource_type, resource_id)
+            return {"status": "204"}, None
+        # 條件式 update: 沒有符合時建立新資源
+        if resource_id is None:
+            result = target.create(resource_type, resource)
+            status = "201"
+        else:
+            result = target.update(resource_type, resource_id, resource)
+            status = "200"
+        reference = f"{resource_type}/{result['id']}"
+        return {"status": status, "location": reference, "resource": result}, reference
+
+    def _match_one(self, target, resource_type, params):
+        """條件式操作的目標: 無符合回傳 None, 多筆符合為 412"""
+        if isinstance(target, Transaction):
+            ids = target.search_ids(resource_type, params)
+        else:
+            ids = self.fhir_resource.snapshot_read(self.fhir_resource._search_ids, resource_type, params)
+        if len(ids) > 1:
+            raise TransactionError(f"Multiple {resource_type} resources match the conditional criteria", "412")
+        return next(iter(ids), None)
+
+    def _resolve_references(self, target, resource, resolved):
+        """將參照其他項目 fullUrl 或條件式參照 (Type?query) 改寫為 "Type/id" """
+        def rewrite(reference):
+            if reference in resolved:
+                return resolved[reference]
+            if reference.startswith("urn:uuid:"):
+                raise TransactionError(f"Unresolved reference {reference}")
+            query = conditional_query(reference)
+            if query is None:
+                return reference
+            resource_id = self._match_one(target, *query)
+            if resource_id is None:
+                raise TransactionError(f"Conditional reference {reference} matches no resource", "412")
+            return f"{query[0]}/{resource_id}"
+        return rewrite_references(resource, rewrite)
+
     def _validate_transaction(self, entries):
         """驗證交易請求的有效性"""
         # 檢查是否有衝突的操作
@@ -124,8 +255,11 @@ class BatchOperation:
             method = request["method"]
             
             if method in ["PUT", "DELETE", "GET"]:
-                resource_type, resource_id = self._parse_url(url)
-                key = f"{resource_type}/{resource_id}"
+                if "?" in url:
+                    key = url.strip('/')
+                else:
+                    resource_type, resource_id = self._parse_url(url)
+                    key = f"{resource_type}/{resource_id}"
                 
                 if key in resources:
                     raise ValueError(
@@ -133,91 +267,6 @@ class BatchOperation:
                     )
                 resources[key] = method
 
-    def _process_create(self, resource):
-        """處理創建操作"""
-        try:
-            result = self.fhir_resource.create(
-                resource["resourceType"],
-                resource
-            )
-            return {
-                "status": "201",
-                "location": f"{resource['resourceType']}/{result['id']}",
-                "resource": result
-            }
-        except Exception as e:
-            return {
-                "status": "400",
-                "outcome": self._create_operation_outcome(str(e))
-            }
-
-    def _process_update(self, resource_type, resource_id, resource):
-        """處理更新操作"""
-        try:
-            result = self.fhir_resource.update(
-                resource_type,
-                resource_id,
-                resource
-            )
-            if result:
-                return {
-                    "status": "200",
-                    "resource": result
-                }
-            else:
-                return {
-                    "status": "404",
-                    "outcome": self._create_operation_outcome(
-                        f"Resource {resource_type}/{resource_id} not found"
-                    )
-                }
-        except Exception as e:
-            return {
-                "status": "400",
-                "outcome": self._create_operation_outcome(str(e))
-            }
-
-    def _process_delete(self, resource_type, resource_id):
-        """處理刪除操作"""
-        try:
-            result = self.fhir_resource.delete(resource_type, resource_id)
-            if result:
-                return {"status": "204"}
-            else:
-                return {
-                    "status": "404",
-                    "outcome": self._create_operation_outcome(
-                        f"Resource {resource_type}/{resource_id} not found"
-                    )
-                }
-        except Exception as e:
-            return {
-                "status": "400",
-                "outcome": self._create_operation_outcome(str(e))
-            }
-
-    def _process_read(self, resource_type, resource_id):
-        """處理讀取操作"""
-        try:
-            result = self.fhir_resource.read(resource_type, resource_id)
-            if result:
-                return {
-                    "status": "200",
-                    "resource": result
-                }
-            else:
-                return {
-                    "status": "404",
-                    "outcome": self._create_operation_outcome(
-                        f"Resource {resource_type}/{resource_id} not found"
-                    )
-                }
-        except Exception as e:
-            return {
-                "status": "400",
-                "outcome": self._create_operation_outcome(str(e))
-            }
-
     def _parse_url(self, url):
         """解析資源URL"""
         parts = url.strip('/').split('/')
@@ -236,21 +285,35 @@ class BatchOperation:
             }]
         }
 
-    def _create_error_response(self, message):
+    def _create_error_response(self, message, status="400"):
         """創建錯誤回應"""
         return {
             "resourceType": "Bundle",
             "type": "batch-response",
             "entry": [{
-                "status": "400",
+                "status": status,
                 "outcome": self._create_operation_outcome(message)
             }]
         }
 
+@tornado.web.stream_request_body
 class BatchHandler(tornado.web.RequestHandler):
-    def initialize(self, fhir_resource):
+    """/_batch: 請求內容邊接收邊解析
+
+    batch 每累積 WINDOW_SIZE 個 entry 即處理, 回應以 chunked 編碼逐批送出, 記憶體用量不隨 Bundle 大小成長。
+    transaction 需全部 entry 才能原子提交; 頂層 type 出現在 entry 之後時也無法提早處理,
+    這兩種情況在內容接收完畢後一次處理。
+    """
+    # 串流處理, 不受 Tornado 預設 100MB 的請求大小限制
+    MAX_BODY_SIZE = 4 << 30
+    WINDOW_SIZE = 500
+
+    def initialize(self, fhir_resource, pool):
         self.fhir_resource = fhir_resource
-        self.batch_processor = BatchOperation(fhir_resource)
+        self.pool = pool
+        self.batch_processor = BatchOperation(fhir_resource, pool)
+        self.client = None
+        self.error = None
     
     def set_default_headers(self):
         self.set_header("Content-Type", "application/fhir+json")
@@ -261,33 +324,150 @@ class BatchHandler(tornado.web.RequestHandler):
     def options(self):
         self.set_status(204)
         self.finish()
+
+    def client_id(self):
+        """公平排程與限流的用戶端識別: X-Client-Id, 未帶時為來源 IP"""
+        return self.request.headers.get("X-Client-Id") or self.request.remote_ip
+
+    def prepare(self):
+        if self.request.method != "POST":
+            return
+        client = self.client_id()
+        try:
+            self.pool.acquire(client)
+        except PoolSaturated as e:
+            self.set_status(int(e.status))
+            self.set_header("Retry-After", str(e.retry_after))
+            self.finish(dumps(self.batch_processor._create_operation_outcome(str(e))))
+            return
+        self.client = client
+        self.request.connection.set_max_body_size(self.MAX_BODY_SIZE)
+        self.parser = BundleStreamParser()
+        # 已解析尚未處理的 entry
+        self.pending = []
+        # 跨批次的 fullUrl -> "Type/id"
+        self.resolved = {}
+        # 已開始輸出 batch-response
+        self.streaming = False
+
+    def on_finish(self):
+        if self.client is not None:
+            self.pool.release(self.client)
+            self.client = None
+
+    def on_connection_close(self):
+        self.on_finish()
+
+    async def data_received(self, chunk):
+        # 未允入 (已回應 429/503) 或已發生錯誤時不再處理其餘內容
+        if self.client is None or self.error is not None:
+            return
+        with self.pool.as_client(self.client):
+            try:
+                entries = self.parser.feed(chunk)
+            except ValueError as e:
+                self.error = f"Invalid JSON: {e}"
+                return
+            self.pending.extend(entries)
+            try:
+                await self._drain(final=False)
+            except Exception as e:
+                self.error = str(e)
+
+    def _is_batch(self):
+        """頂層欄位已確定為 batch Bundle (可逐批處理)"""
+        fields = self.parser.fields
+        return fields.get("resourceType") == "Bundle" and fields.get("type") == "batch"
+
+    async def _drain(self, final):
+        """batch 每滿一批即處理並送出; final 時處理剩餘的 entry"""
+        if not self._is_batch():
+            return
+        while len(self.pending) >= self.WINDOW_SIZE or (final and self.pending):
+            window = self.pending[:self.WINDOW_SIZE]
+            del self.pending[:self.WINDOW_SIZE]
+            responses = await self.batch_processor.process_entries(window, self.resolved)
+            await self._write_entries(responses)
+
+    async def _write_entries(self, responses):
+        if not self.streaming:
+            self.streaming = True
+            self.write(b'{"resourceType":"Bundle","type":"batch-response","entry":[')
+        else:
+            self.write(b",")
+        self.write(b",".join(dumps(response) for response in responses))
+        await self.flush()
     
     async def post(self):
-        try:
-            batch_data = json.loads(self.request.body)
-            result = await self.batch_processor.process_batch(batch_data)
-            self.write(result)
-        except json.JSONDecodeError:
-            self.set_status(400)
-            self.write(self.batch_processor._create_operation_outcome(
-                "Invalid JSON"
-            ))
-        except Exception as e:
+        if self.error is None:
+            try:
+                self.parser.close()
+            except ValueError as e:
+                self.error = f"Invalid JSON: {e}"
+        if self.error is not None:
+            self._fail(self.error)
+            return
+        with self.pool.as_client(self.client):
+            try:
+                if self._is_batch():
+                    await self._drain(final=True)
+                    if not self.streaming:
+                        await self._write_entries([])
+                    self.write(b"]}")
+                    return
+                batch_data = dict(self.parser.fields, entry=self.pending)
+                result = await self.batch_processor.process_batch(batch_data)
+                self.write(dumps(result))
+            except Exception as e:
+                self._fail(str(e))
+
+    def _fail(self, message):
+        outcome = self.batch_processor._create_operation_outcome(message)
+        if self.streaming:
+            # 狀態碼已送出, 以最後一個 entry 回報錯誤並結束 Bundle
+            self.write(b"," + dumps({"status": "400", "outcome": outcome}) + b"]}")
+        else:
             self.set_status(400)
-            self.write(self.batch_processor._create_operation_outcome(
-                str(e)
-            ))
+            self.write(dumps(outcome))
+
+class PoolStatsHandler(tornado.web.RequestHandler):
+    """工作池的即時指標 (佇列深度、等待時間、忙碌中的工作執行緒)"""
+    def initialize(self, pool):
+        self.pool = pool
+
+    def get(self):
+        self.set_header("Content-Type", "application/json")
+        self.write(dumps(self.pool.stats()))
 
-def make_app():
-    fhir_resource = FHIRResource()
-    return Application([
+def make_app(database=None, log_directory=None, compact=False, max_workers=10, max_queue=1000,
+             max_client_requests=8, import_directory=None):
+    """database 為 SQLite 檔案路徑時資料存放於磁碟; log_directory 為記憶體模式加上寫前日誌與快照;
+    compact 為記憶體模式改以序列化位元組存放資源; max_workers、max_queue 與 max_client_requests
+    為程序共用工作池的執行緒數、允入時的佇列上限與單一用戶端同時進行的請求上限 (於第一次建立時生效);
+    import_directory 為 $import 可讀取的 NDJSON 檔案目錄, 未指定時不提供 $import"""
+    if database is not None:
+        fhir_resource = SQLiteFHIRResource(database)
+    elif log_directory is not None:
+        fhir_resource = DurableFHIRResource(log_directory, compact=compact)
+    else:
+        fhir_resource = FHIRResource(compact=compact)
+    pool = shared_pool(max_workers, max_queue, max_client_requests)
+    routes = [
+        (r"/([^/]+)/_history", FHIRHistoryHandler, dict(fhir_resource=fhir_resource)),
+        (r"/([^/]+)/([^/]+)/_history", FHIRHistoryHandler, dict(fhir_resource=fhir_resource)),
+        (r"/([^/]+)/([^/]+)/_history/([^/]+)", FHIRHistoryHandler, dict(fhir_resource=fhir_resource)),
+        (r"/_batch", BatchHandler, dict(fhir_resource=fhir_resource, pool=pool)),
+        (r"/_pool", PoolStatsHandler, dict(pool=pool)),
+    ]
+    if import_directory is not None:
+        routes.append((r"/\$import", ImportHandler, dict(fhir_resource=fhir_resource, import_directory=import_directory, pool=pool)))
+    return Application(routes + [
         (r"/([^/]+)/([^/]+)", FHIRResourceHandler, dict(fhir_resource=fhir_resource)),
         (r"/([^/]+)", FHIRTypeHandler, dict(fhir_resource=fhir_resource)),
-        (r"/_batch", BatchHandler, dict(fhir_resource=fhir_resource)),
     ])
 
 if __name__ == "__main__":
-    trndApp = make_app()
+    trndApp = make_app(sys.argv[1] if len(sys.argv) > 1 else None)
     trndApp.listen(8888)
     print("FHIR Server running on http://localhost:8888")
     IOLoop.current().start()    #tornado.ioloop.
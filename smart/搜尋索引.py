@@ -0,0 +1,812 @@
+"""
+搜尋索引
+
+每個資源類型維護一組依搜尋路徑建立的索引, 在 create/update/delete 時同步更新,
+搜尋時直接由索引取得資源 id, 不必逐筆掃描資源內容。
+"""
+import math
+import re
+from bisect import bisect_left, bisect_right
+from datetime import datetime, timedelta, timezone
+from functools import partial
+from operator import itemgetter
+
+# 預設建立索引的搜尋路徑: {resource_type: {path: kind}}
+DEFAULT_SEARCH_PATHS = {
+    "Patient": {
+        "gender": "token",
+        "identifier.value": "token",
+        "name": "string",
+        "name.family": "string",
+        "name.given": "string",
+        "address.city": "string",
+        "birthDate": "date",
+    },
+    "Observation": {
+        "status": "token",
+        "code.coding.code": "code",
+        "category.coding.code": "code",
+        "effectiveDateTime": "date",
+        "issued": "date",
+        "valueQuantity.value": "number",
+    },
+    "Condition": {
+        "code.coding.code": "code",
+        "clinicalStatus.coding.code": "token",
+        "onsetDateTime": "date",
+        "recordedDate": "date",
+    },
+    "Procedure": {
+        "status": "token",
+        "code.coding.code": "code",
+        "performedDateTime": "date",
+        "performedPeriod.start": "date",
+    },
+    "Encounter": {
+        "status": "token",
+        "period.start": "date",
+        "period.end": "date",
+    },
+    "Organization": {
+        "identifier.value": "token",
+        "name": "string",
+    },
+    "Practitioner": {
+        "identifier.value": "token",
+        "name": "string",
+    },
+}
+
+# 參照類搜尋參數對應的元素: {resource_type: {search-parameter: (持有參照的元素名稱, 目標類型)}}
+# 參數名稱與元素不同 (如 Observation 的 patient 為 subject 中的 Patient) 時須列在此表;
+# 目標類型為 None 表示不限定
+REFERENCE_SEARCH_PARAMS = {
+    "Patient": {
+        "general-practitioner": ("generalPractitioner", None),
+        "organization": ("managingOrganization", "Organization"),
+        "link": ("other", None),
+    },
+    "Observation": {
+        "subject": ("subject", None),
+        "patient": ("subject", "Patient"),
+        "encounter": ("encounter", "Encounter"),
+        "performer": ("performer", None),
+        "based-on": ("basedOn", None),
+        "part-of": ("partOf", None),
+        "has-member": ("hasMember", None),
+        "derived-from": ("derivedFrom", None),
+        "specimen": ("specimen", "Specimen"),
+        "device": ("device", None),
+        "focus": ("focus", None),
+    },
+    "Condition": {
+        "subject": ("subject", None),
+        "patient": ("subject", "Patient"),
+        "encounter": ("encounter", "Encounter"),
+        "asserter": ("asserter", None),
+    },
+    "Procedure": {
+        "subject": ("subject", None),
+        "patient": ("subject", "Patient"),
+        "encounter": ("encounter", "Encounter"),
+        "performer": ("actor", None),
+        "based-on": ("basedOn", None),
+        "part-of": ("partOf", None),
+        "location": ("location", "Location"),
+    },
+    "Encounter": {
+        "subject": ("subject", None),
+        "patient": ("subject", "Patient"),
+        "service-provider": ("serviceProvider", "Organization"),
+        "part-of": ("partOf", "Encounter"),
+        "participant": ("individual", None),
+        "practitioner": ("individual", "Practitioner"),
+        "location": ("location", "Location"),
+        "episode-of-care": ("episodeOfCare", "EpisodeOfCare"),
+        "based-on": ("basedOn", "ServiceRequest"),
+        "diagnosis": ("condition", None),
+    },
+    "Organization": {
+        "part-of": ("partOf", "Organization"),
+        "endpoint": ("endpoint", "Endpoint"),
+    },
+    "DiagnosticReport": {
+        "subject": ("subject", None),
+        "patient": ("subject", "Patient"),
+        "encounter": ("encounter", "Encounter"),
+        "performer": ("performer", None),
+        "result": ("result", "Observation"),
+        "based-on": ("basedOn", None),
+    },
+    "MedicationRequest": {
+        "subject": ("subject", None),
+        "patient": ("subject", "Patient"),
+        "encounter": ("encounter", "Encounter"),
+        "requester": ("requester", None),
+        "medication": ("medicationReference", "Medication"),
+        "intended-performer": ("performer", None),
+    },
+    "RelatedPerson": {
+        "patient": ("patient", "Patient"),
+    },
+}
+
+_EMPTY = frozenset()
+
+
+def extract_values(resource, path):
+    """依點號路徑 (或預先拆好的路徑 tuple) 取出資源中的純量值 (陣列自動展開), 統一轉為字串"""
+    values = []
+
+    def collect(obj):
+        if isinstance(obj, dict):
+            for v in obj.values():
+                collect(v)
+        elif isinstance(obj, list):
+            for item in obj:
+                collect(item)
+        elif isinstance(obj, bool):
+            values.append("true" if obj else "false")
+        elif obj is not None:
+            values.append(str(obj))
+
+    def walk(obj, parts):
+        if isinstance(obj, list):
+            for item in obj:
+                walk(item, parts)
+        elif not parts:
+            collect(obj)
+        elif isinstance(obj, dict) and parts[0] in obj:
+            walk(obj[parts[0]], parts[1:])
+
+    walk(resource, path.split(".") if isinstance(path, str) else path)
+    return values
+
+
+def extract_index_values(resource, paths):
+    """取出資源在各搜尋路徑上的值 {路徑: 值}, 沒有值的路徑省略 (供整批建立索引)"""
+    values = {}
+    for path in paths:
+        found = extract_values(resource, path)
+        if found:
+            values[path] = found
+    return values
+
+
+def _discard(postings, key, resource_id):
+    """自倒排串列移除 id, 串列為空時一併刪除鍵值"""
+    ids = postings.get(key)
+    if ids is not None:
+        ids.discard(resource_id)
+        if not ids:
+            del postings[key]
+
+
+class TokenIndex:
+    """倒排索引: 值 -> 資源 id 集合, 用於等值與 :exact 查詢"""
+
+    def __init__(self):
+        self.exact = {}
+        self.folded = {}
+
+    def add(self, resource_id, values):
+        for value in values:
+            self.exact.setdefault(value, set()).add(resource_id)
+            folded = value.lower()
+            ids = self.folded.get(folded)
+            if ids is None:
+                ids = self.folded[folded] = set()
+                self._add_value(folded)
+            ids.add(resource_id)
+
+    def add_many(self, items):
+        """整批加入 [(id, 值)]"""
+        for resource_id, values in items:
+            self.add(resource_id, values)
+
+    def remove(self, resource_id, values):
+        for value in values:
+            _discard(self.exact, value, resource_id)
+            folded = value.lower()
+            _discard(self.folded, folded, resource_id)
+            if folded not in self.folded:
+                self._remove_value(folded)
+
+    def _add_value(self, folded):
+        """新出現的相異值 (供子類別建立額外索引)"""
+
+    def _remove_value(self, folded):
+        """不再被任何資源使用的相異值"""
+
+    def lookup(self, op, value):
+        """回傳符合的 id 集合; 不支援的運算回傳 None"""
+        if op == "exact":
+            return self.exact.get(value, _EMPTY)
+        if op == "eq":
+            return self.folded.get(value.lower(), _EMPTY)
+        if op == "contains":
+            needle = value.lower()
+            if not needle:
+                return None
+            return self._union(folded for folded in self._candidate_values(needle) if needle in folded)
+        return None
+
+    def _candidate_values(self, needle):
+        """可能包含 needle 的相異值; token 欄位相異值少, 直接逐一檢查"""
+        return self.folded
+
+    def estimate(self, op, value):
+        """估計符合筆數 (供查詢計畫排序), 不支援的運算回傳 None"""
+        if op == "exact":
+            return len(self.exact.get(value, _EMPTY))
+        if op == "eq":
+            return len(self.folded.get(value.lower(), _EMPTY))
+        if op == "contains" and value:
+            # 各符合相異值的串列長度總和, 為實際筆數的上限
+            needle = value.lower()
+            return sum(len(self.folded[folded]) for folded in self._candidate_values(needle)
+                       if needle in folded)
+        return None
+
+    def _union(self, folded_values):
+        ids = set()
+        for folded in folded_values:
+            ids |= self.folded[folded]
+        return ids
+
+
+class NgramIndex(TokenIndex):
+    """n-gram 索引: 以相異值的 1..n 字元片段建立倒排串列, 用於 :contains 與預設模糊比對
+
+    以字元而非位元組切割, 中文姓名同樣適用。查詢時交集各片段的串列取得候選值,
+    再以子字串比對驗證, 驗證對象是少量相異值而非資源本身。
+    """
+
+    def __init__(self, n=3):
+        super().__init__()
+        self.n = n
+        self.grams = {}
+
+    def _grams(self, text):
+        grams = set()
+        for size in range(1, min(self.n, len(text)) + 1):
+            for start in range(len(text) - size + 1):
+                grams.add(text[start:start + size])
+        return grams
+
+    def _add_value(self, folded):
+        for gram in self._grams(folded):
+            self.grams.setdefault(gram, set()).add(folded)
+
+    def _remove_value(self, folded):
+        for gram in self._grams(folded):
+            _discard(self.grams, gram, folded)
+
+    def _candidate_values(self, needle):
+        size = min(self.n, len(needle))
+        postings = []
+        for start in range(len(needle) - size + 1):
+            values = self.grams.get(needle[start:start + size])
+            if not values:
+                return _EMPTY
+            postings.append(values)
+        postings.sort(key=len)
+        candidates = set(postings[0])
+        for values in postings[1:]:
+            candidates &= values
+            if not candidates:
+                break
+        return candidates
+
+
+class _TrieNode:
+    __slots__ = ("children", "count")
+
+    def __init__(self):
+        self.children = {}
+        # 子樹內 (值, 資源) 配對的數量
+        self.count = 0
+
+
+class CodeIndex(TokenIndex):
+    """階層式代碼索引: 在倒排索引之外以字首樹 (trie) 組織相異代碼, 用於 :below
+
+    :below 查詢走到字首所在節點後只需遍歷該子樹; 各節點記錄子樹內的配對數,
+    供查詢規劃估計候選數 (確切筆數仍以不重複的 id 集合計算)。
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.root = _TrieNode()
+
+    def add(self, resource_id, values):
+        values = set(values)
+        super().add(resource_id, values)
+        for value in values:
+            self._adjust(value, 1)
+
+    def remove(self, resource_id, values):
+        values = set(values)
+        super().remove(resource_id, values)
+        for value in values:
+            self._adjust(value, -1)
+
+    def _adjust(self, value, delta):
+        node = self.root
+        node.count += delta
+        for char in value:
+            child = node.children.get(char)
+            if child is None:
+                child = node.children[char] = _TrieNode()
+            child.count += delta
+            if child.count <= 0:
+                # 子樹已無任何代碼, 整段剪除
+                del node.children[char]
+                return
+            node = child
+
+    def _find(self, prefix):
+        node = self.root
+        for char in prefix:
+            node = node.children.get(char)
+            if node is None:
+                return None
+        return node
+
+    def lookup(self, op, value):
+        if op != "below":
+            return super().lookup(op, value)
+        node = self._find(value)
+        if node is None:
+            return _EMPTY
+        ids = set()
+        stack = [(node, value)]
+        while stack:
+            node, code = stack.pop()
+            ids |= self.exact.get(code, _EMPTY)
+            for char, child in node.children.items():
+                stack.append((child, code + char))
+        return ids
+
+    def estimate(self, op, value):
+        """:below 直接取子樹計數; 同一資源含多個符合代碼時會重複計入, 只作為上限"""
+        if op == "below":
+            node = self._find(value)
+            return 0 if node is None else node.count
+        return super().estimate(op, value)
+
+
+# FHIR date/dateTime/instant: 精度由年到小數秒
+_DATE_RE = re.compile(
+    r"^(\d{4})(?:-(\d{2})(?:-(\d{2})"
+    r"(?:T(\d{2}):(\d{2})(?::(\d{2})(\.\d+)?)?(Z|[+-]\d{2}:\d{2})?)?)?)?$"
+)
+
+
+def parse_number(value):
+    """數值正規化為 (下界, 上界) 邊界, 上界為緊鄰的下一個浮點數"""
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        return None
+    if math.isnan(number):
+        return None
+    return number, math.nextafter(number, math.inf)
+
+
+def parse_date(value):
+    """日期正規化為依精度展開的 epoch 秒區間 [下界, 上界), 未帶時區視為 UTC"""
+    match = _DATE_RE.match(str(value).strip())
+    if match is None:
+        return None
+    year, month, day, hour, minute, second, fraction, tz = match.groups()
+
+    tzinfo = timezone.utc
+    if tz and tz != "Z":
+        sign = -1 if tz[0] == "-" else 1
+        tzinfo = timezone(sign * timedelta(hours=int(tz[1:3]), minutes=int(tz[4:6])))
+
+    try:
+        if month is None:
+            start = datetime(int(year), 1, 1, tzinfo=tzinfo)
+            end = datetime(int(year) + 1, 1, 1, tzinfo=tzinfo)
+        elif day is None:
+            start = datetime(int(year), int(month), 1, tzinfo=tzinfo)
+            end = (start + timedelta(days=32)).replace(day=1)
+        elif hour is None:
+            start = datetime(int(year), int(month), int(day), tzinfo=tzinfo)
+            end = start + timedelta(days=1)
+        elif second is None:
+            start = datetime(int(year), int(month), int(day), int(hour), int(minute), tzinfo=tzinfo)
+            end = start + timedelta(minutes=1)
+        else:
+            start = datetime(int(year), int(month), int(day), int(hour), int(minute),
+                             int(second), tzinfo=tzinfo)
+            if fraction:
+                start += timedelta(seconds=float(fraction))
+                end = start + timedelta(seconds=10 ** -(len(fraction) - 1))
+            else:
+                end = start + timedelta(seconds=1)
+    except (ValueError, OverflowError):
+        return None
+    return start.timestamp(), end.timestamp()
+
+
+def compare_range(target, search, op):
+    """以區間語意比較已正規化的目標值與搜尋值"""
+    if op == "ge":
+        return target[1] > search[0]
+    if op == "gt":
+        return target[1] > search[1]
+    if op == "le":
+        return target[0] < search[1]
+    if op == "lt":
+        return target[0] < search[0]
+    return False
+
+
+class SortedKeys:
+    """以 bisect 維護的排序陣列, 鍵與資源 id 平行存放"""
+
+    def __init__(self):
+        self.keys = []
+        self.ids = []
+
+    def __len__(self):
+        return len(self.keys)
+
+    def insert(self, key, resource_id):
+        position = bisect_right(self.keys, key)
+        self.keys.insert(position, key)
+        self.ids.insert(position, resource_id)
+
+    def insert_many(self, pairs):
+        """整批插入 [(鍵, id)]: 只排序新項目再與既有陣列合併, 鍵相同時的順序與逐筆 insert 相同"""
+        if not pairs:
+            return
+        pairs = sorted(pairs, key=itemgetter(0))
+        if not self.keys or pairs[0][0] >= self.keys[-1]:
+            # 新鍵都不小於既有的最大鍵, 直接接在尾端
+            self.keys.extend(key for key, _ in pairs)
+            self.ids.extend(resource_id for _, resource_id in pairs)
+            return
+        merged = list(zip(self.keys, self.ids))
+        merged.extend(pairs)
+        # 兩段皆已排序, timsort 只做一次合併
+        merged.sort(key=itemgetter(0))
+        self.keys = [key for key, _ in merged]
+        self.ids = [resource_id for _, resource_id in merged]
+
+    def delete(self, key, resource_id):
+        position = bisect_left(self.keys, key)
+        while position < len(self.keys) and self.keys[position] == key:
+            if self.ids[position] == resource_id:
+                del self.keys[position]
+                del self.ids[position]
+                return
+            position += 1
+
+    def greater_than(self, key):
+        return self.ids[bisect_right(self.keys, key):]
+
+    def at_least(self, key):
+        return self.ids[bisect_left(self.keys, key):]
+
+    def less_than(self, key):
+        return self.ids[:bisect_left(self.keys, key)]
+
+    def count_greater_than(self, key):
+        return len(self.keys) - bisect_right(self.keys, key)
+
+    def count_less_than(self, key):
+        return bisect_left(self.keys, key)
+
+
+class RangeIndex:
+    """範圍索引: 寫入時將值正規化為區間, 依下界與上界各自排序, 用於 :gt/:ge/:lt/:le"""
+
+    def __init__(self, parse):
+        self.parse = parse
+        self.lows = SortedKeys()
+        self.highs = SortedKeys()
+
+    def add(self, resource_id, values):
+        for value in values:
+            bounds = self.parse(value)
+            if bounds is not None:
+                self.lows.insert(bounds[0], resource_id)
+                self.highs.insert(bounds[1], resource_id)
+
+    def add_many(self, items):
+        """整批加入 [(id, 值)], 下界與上界各排序一次, 不逐筆插入陣列中段"""
+        lows, highs = [], []
+        for resource_id, values in items:
+            for value in values:
+                bounds = self.parse(value)
+                if bounds is not None:
+                    lows.append((bounds[0], resource_id))
+                    highs.append((bounds[1], resource_id))
+        self.lows.insert_many(lows)
+        self.highs.insert_many(highs)
+
+    def remove(self, resource_id, values):
+        for value in values:
+            bounds = self.parse(value)
+            if bounds is not None:
+                self.lows.delete(bounds[0], resource_id)
+                self.highs.delete(bounds[1], resource_id)
+
+    def lookup(self, op, value):
+        """兩次二分搜尋加一次切片; 搜尋值無法解析時回傳 None 交由逐筆比對"""
+        if op not in ("gt", "ge", "lt", "le"):
+            return None
+        bounds = self.parse(value)
+        if bounds is None:
+            return None
+        return set(self._slice(op, bounds))
+
+    def estimate(self, op, value):
+        """只做二分搜尋, 不切片"""
+        if op not in ("gt", "ge", "lt", "le"):
+            return None
+        bounds = self.parse(value)
+        if bounds is None:
+            return None
+        if op == "ge":
+            return self.highs.count_greater_than(bounds[0])
+        if op == "gt":
+            return self.highs.count_greater_than(bounds[1])
+        if op == "le":
+            return self.lows.count_less_than(bounds[1])
+        return self.lows.count_less_than(bounds[0])
+
+    def _slice(self, op, bounds):
+        if op == "ge":
+            return self.highs.greater_than(bounds[0])
+        if op == "gt":
+            return self.highs.greater_than(bounds[1])
+        if op == "le":
+            return self.lows.less_than(bounds[1])
+        return self.lows.less_than(bounds[0])
+
+
+class InsertionOrder:
+    """單一類型的寫入順序: 遞增序號與 id 平行存放, 供穩定排序與依序號定位
+
+    刪除只移除 id 對應的序號, 陣列中的舊項目於掃描時略過, 累積過多時再壓縮。
+    """
+
+    def __init__(self):
+        self.seqs = []
+        self.ids = []
+        self.positions = {}
+        self.next_seq = 0
+        self.removed = 0
+
+    def append(self, resource_id):
+        seq = self.next_seq
+        self.next_seq += 1
+        self.seqs.append(seq)
+        self.ids.append(resource_id)
+        self.positions[resource_id] = seq
+        return seq
+
+    def discard(self, resource_id):
+        if self.positions.pop(resource_id, None) is not None:
+            self.removed += 1
+            if self.removed > len(self.positions):
+                self._compact()
+
+    def _compact(self):
+        live = [(seq, resource_id) for seq, resource_id in zip(self.seqs, self.ids)
+                if self.positions.get(resource_id) == seq]
+        self.seqs = [seq for seq, _ in live]
+        self.ids = [resource_id for _, resource_id in live]
+        self.removed = 0
+
+    def seq(self, resource_id):
+        return self.positions.get(resource_id)
+
+    def scan(self, after=None):
+        """依序產生 (序號, id); after 為上一頁最後的序號"""
+        seqs, ids, positions = self.seqs, self.ids, self.positions
+        start = 0 if after is None else bisect_right(seqs, after)
+        for position in range(start, len(seqs)):
+            if positions.get(ids[position]) == seqs[position]:
+                yield seqs[position], ids[position]
+
+    def sort(self, resource_ids, after=None):
+        """將 id 集合依寫入順序排序, 回傳 [(序號, id)]"""
+        positions = self.positions
+        keyed = []
+        for resource_id in resource_ids:
+            seq = positions.get(resource_id)
+            if seq is not None and (after is None or seq > after):
+                keyed.append((seq, resource_id))
+        keyed.sort()
+        return keyed
+
+
+def parse_reference(reference):
+    """將參照字串解析為 (type, id); 支援絕對 URL 與 _history, contained (#) 與 urn: 等非本地參照回傳 None"""
+    if not isinstance(reference, str) or reference.startswith(("#", "urn:")):
+        return None
+    parts = reference.split("?", 1)[0].rstrip("/").split("/")
+    if "_history" in parts:
+        parts = parts[:parts.index("_history")]
+    if len(parts) < 2 or not parts[-2][:1].isupper() or not parts[-1]:
+        return None
+    return parts[-2], parts[-1]
+
+
+def extract_references(resource):
+    """取出資源中所有 Reference, 回傳 [(持有參照的元素名稱, 元素路徑, "Type/id")]"""
+    references = []
+
+    def walk(obj, path):
+        if isinstance(obj, dict):
+            target = parse_reference(obj.get("reference")) if path else None
+            if target is not None:
+                references.append((path[-1], ".".join(path), f"{target[0]}/{target[1]}"))
+            for k, v in obj.items():
+                if isinstance(v, (dict, list)):
+                    walk(v, path + (k,))
+        elif isinstance(obj, list):
+            for item in obj:
+                walk(item, path)
+
+    walk(resource, ())
+    return references
+
+
+def bulk_record(resource_id, resource, paths):
+    """FHIRResource.bulk_load 的單筆記錄 (id, 資源, 索引值, 參照); paths 為該類型的搜尋路徑"""
+    return resource_id, resource, extract_index_values(resource, paths), extract_references(resource)
+
+
+class ReferenceIndex:
+    """雙向參照索引, 記錄每個參照來自哪個元素 (如 Patient:organization)
+
+    forward: "來源Type/id" -> {元素名稱: {"目標Type/id"}}
+    reverse: "目標Type/id" -> {(來源類型, 元素名稱): {來源 id}}
+    kinds: (來源類型, 元素名稱) -> {目標類型: 參照數}, 供未指定類型的 chain 推斷目標
+    來源資源更新或刪除時依 forward 記錄移除舊參照, 不需保留舊版資源。
+    """
+
+    def __init__(self):
+        self.forward = {}
+        self.reverse = {}
+        self.kinds = {}
+
+    def add(self, resource_type, resource_id, resource):
+        self.add_references(resource_type, resource_id, extract_references(resource))
+
+    def add_references(self, resource_type, resource_id, references):
+        """加入預先取出的參照 (extract_references 的結果)"""
+        source = f"{resource_type}/{resource_id}"
+        outgoing = {}
+        for name, _, target in references:
+            outgoing.setdefault(name, set()).add(target)
+        for name, targets in outgoing.items():
+            kinds = self.kinds.setdefault((resource_type, name), {})
+            for target in targets:
+                self.reverse.setdefault(target, {}).setdefault((resource_type, name), set()).add(resource_id)
+                target_type = target.partition("/")[0]
+                kinds[target_type] = kinds.get(target_type, 0) + 1
+        if outgoing:
+            # 每個元素通常只有一兩個參照, 以 tuple 存放比 set 省記憶體
+            self.forward[source] = {name: tuple(targets) for name, targets in outgoing.items()}
+
+    def add_many(self, resource_type, items):
+        """整批加入 [(id, 參照)]"""
+        for resource_id, references in items:
+            self.add_references(resource_type, resource_id, references)
+
+    def remove(self, resource_type, resource_id):
+        outgoing = self.forward.pop(f"{resource_type}/{resource_id}", None)
+        if not outgoing:
+            return
+        for name, targets in outgoing.items():
+            kinds = self.kinds[(resource_type, name)]
+            for target in targets:
+                target_type = target.partition("/")[0]
+                kinds[target_type] -= 1
+                if not kinds[target_type]:
+                    del kinds[target_type]
+                incoming = self.reverse.get(target)
+                if incoming is None:
+                    continue
+                _discard(incoming, (resource_type, name), resource_id)
+                if not incoming:
+                    del self.reverse[target]
+            if not kinds:
+                del self.kinds[(resource_type, name)]
+
+    def targets(self, resource_type, resource_id, name="*"):
+        """正向查詢: 資源經由指定元素 ("*" 為全部) 參照到的目標"""
+        outgoing = self.forward.get(f"{resource_type}/{resource_id}", {})
+        if name == "*":
+            return set().union(*outgoing.values())
+        return outgoing.get(name, _EMPTY)
+
+    def targets_many(self, resource_type, resource_ids, name="*"):
+        """多筆來源的正向查詢聯集"""
+        targets = set()
+        for resource_id in resource_ids:
+            targets.update(self.targets(resource_type, resource_id, name))
+        return targets
+
+    def target_types(self, resource_type, name):
+        """元素目前實際參照到的目標類型"""
+        return sorted(self.kinds.get((resource_type, name), ()))
+
+    def sources(self, target, source_type, name="*"):
+        """反向查詢: 經由指定元素參照到 target 的來源資源 id"""
+        incoming = self.reverse.get(target, {})
+        if name == "*":
+            return set().union(*(ids for (t, _), ids in incoming.items() if t == source_type))
+        return incoming.get((source_type, name), _EMPTY)
+
+    def sources_many(self, targets, source_type, name="*"):
+        """多個目標的反向查詢聯集"""
+        ids = set()
+        for target in targets:
+            ids |= self.sources(target, source_type, name)
+        return ids
+
+
+INDEX_KINDS = {
+    "token": TokenIndex,
+    "string": NgramIndex,
+    "code": CodeIndex,
+    "date": partial(RangeIndex, parse_date),
+    "number": partial(RangeIndex, parse_number),
+}
+
+
+class ResourceIndex:
+    """單一資源類型在各搜尋路徑上的索引"""
+
+    def __init__(self, paths):
+        self.paths = {path: INDEX_KINDS[kind]() for path, kind in paths.items()}
+
+    def add(self, resource_id, resource):
+        for path, index in self.paths.items():
+            values = extract_values(resource, path)
+            if values:
+                index.add(resource_id, values)
+
+    def add_many(self, items):
+        """整批加入預先取出的值 [(id, {路徑: 值})], 見 extract_index_values"""
+        items = list(items)
+        for path, index in self.paths.items():
+            index.add_many([(resource_id, values[path]) for resource_id, values in items if values.get(path)])
+
+    def remove(self, resource_id, resource):
+        for path, index in self.paths.items():
+            values = extract_values(resource, path)
+            if values:
+                index.remove(resource_id, values)
+
+    def lookup(self, path, op, value):
+        """由索引取得符合條件的 id 集合; 路徑未建索引或不支援時回傳 None"""
+        index = self.paths.get(path)
+        if index is None:
+            return None
+        return index.lookup(op, value)
+
+    def kind(self, path):
+        index = self.paths.get(path)
+        return None if index is None else type(index).__name__
+
+    def estimate(self, path, op, value):
+        """估計符合筆數; 路徑未建索引或不支援時回傳 None"""
+        index = self.paths.get(path)
+        if index is None:
+            return None
+        return index.estimate(op, value)
+
+    def count(self, path, op, value):
+        """由索引回報符合的資源數 (不重複); 路徑未建索引或不支援時回傳 None"""
+        ids = self.lookup(path, op, value)
+        return None if ids is None else len(ids)
@@ -0,0 +1,198 @@
+"""
+效能測試
+
+比較記憶體模式與 SQLite 模式的寫入、讀取與搜尋速度:
+    python 效能測試.py [資源數] [SQLite 檔案路徑]
+未指定檔案時使用暫存目錄。
+
+比較一般模式與精簡模式每筆資源佔用的記憶體:
+    python 效能測試.py memory [資源數]
+
+比較標準庫 json 與 orjson 在 FHIR 資源、searchset 與 batch Bundle 上的編解碼速度:
+    python 效能測試.py codec [重複次數]
+"""
+import gc
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from 資源搜尋 import FHIRResource
+from 資料庫儲存 import SQLiteFHIRResource
+import 編解碼
+
+FAMILIES = ["Chen", "Lin", "Wang", "Huang", "Chang", "Lee", "Wu", "Liu"]
+CODES = ["8867-4", "8310-5", "8462-4", "8480-6", "29463-7", "39156-5"]
+
+SEARCHES = [
+    ("Patient", {"name": ["Chen"]}),
+    ("Patient", {"gender:exact": ["female"], "birthDate:ge": ["1990-01-01"]}),
+    ("Observation", {"code.coding.code": ["8867-4"], "valueQuantity.value:gt": ["100"]}),
+    ("Observation", {"subject:Patient.name": ["Lin"], "_count": ["50"]}),
+]
+
+
+def sample_patient(rng):
+    return {
+        "name": [{"family": rng.choice(FAMILIES), "given": [f"G{rng.randrange(1000)}"]}],
+        "gender": rng.choice(["male", "female"]),
+        "birthDate": f"{rng.randint(1940, 2020)}-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}",
+    }
+
+
+def sample_observation(rng, patient_id):
+    return {
+        "status": "final",
+        "code": {"coding": [{"code": rng.choice(CODES)}]},
+        "subject": {"reference": f"Patient/{patient_id}"},
+        "effectiveDateTime": f"2024-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}",
+        "valueQuantity": {"value": round(rng.uniform(40, 200), 1)},
+    }
+
+
+def timed(label, count, func):
+    start = time.perf_counter()
+    result = func()
+    elapsed = time.perf_counter() - start
+    print(f"  {label:<36} {elapsed * 1000:9.1f} ms  {count / elapsed if elapsed else 0:10.0f} ops/s")
+    return result
+
+
+def run(fhir_resource, count):
+    """寫入 count 位病人 (各兩筆觀察), 再量測讀取與搜尋"""
+    rng = random.Random(42)
+
+    def write():
+        patient_ids = []
+        for _ in range(count):
+            patient_id = fhir_resource.create("Patient", sample_patient(rng))["id"]
+            patient_ids.append(patient_id)
+            for _ in range(2):
+                fhir_resource.create("Observation", sample_observation(rng, patient_id))
+        return patient_ids
+
+    patient_ids = timed("create", count * 3, write)
+    timed("read", count, lambda: [fhir_resource.read("Patient", patient_id) for patient_id in patient_ids])
+    for resource_type, params in SEARCHES:
+        label = "search " + "&".join(params)[:28]
+        timed(label, 20, lambda: [fhir_resource.search(resource_type, dict(params)) for _ in range(20)])
+
+
+def measure_memory(factory, count):
+    """以 tracemalloc 量測寫入 count 筆觀察後整個 store (含索引) 的配置量, 回傳 (總位元組, 每筆位元組)"""
+    rng = random.Random(7)
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    fhir_resource = factory()
+    # 資料於迴圈內產生, 一般模式保留的巢狀 dict 才會計入
+    for index in range(count):
+        fhir_resource.create("Observation", sample_observation(rng, f"p{index % 1000}"))
+    gc.collect()
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    return used, used / count
+
+
+def memory_main(count):
+    modes = [
+        ("dict", lambda: FHIRResource()),
+        ("compact", lambda: FHIRResource(compact=True)),
+        ("dict, no index", lambda: FHIRResource(search_paths={})),
+        ("compact, no index", lambda: FHIRResource(search_paths={}, compact=True)),
+    ]
+    print(f"memory per resource ({count} observations)")
+    for label, factory in modes:
+        used, per_resource = measure_memory(factory, count)
+        print(f"  {label:<20} {used / 1024 / 1024:9.1f} MiB  {per_resource:8.0f} bytes/resource")
+
+
+def full_patient(rng, index):
+    """含 identifier、telecom、address 與中文姓名的病人, 接近實際交換的資料大小"""
+    return {
+        "resourceType": "Patient",
+        "id": f"p{index}",
+        "meta": {"versionId": "1", "lastUpdated": "2024-05-01T08:30:00+08:00"},
+        "identifier": [{"system": "http://www.moi.gov.tw/", "value": f"A1{rng.randrange(10 ** 8):08d}"}],
+        "name": [{"use": "official", "text": "陳大文", "family": rng.choice(FAMILIES), "given": ["Da-Wen"]}],
+        "telecom": [{"system": "phone", "value": f"09{rng.randrange(10 ** 8):08d}", "use": "mobile"}],
+        "gender": rng.choice(["male", "female"]),
+        "birthDate": f"{rng.randint(1940, 2020)}-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}",
+        "address": [{"text": "臺北市中正區重慶南路一段122號", "city": "臺北市", "postalCode": "100", "country": "TW"}],
+    }
+
+
+def full_observation(rng, index):
+    return {
+        "resourceType": "Observation",
+        "id": f"o{index}",
+        "meta": {"versionId": "1", "lastUpdated": "2024-05-01T08:30:00+08:00"},
+        "status": "final",
+        "category": [{"coding": [{"system": "http://terminology.hl7.org/CodeSystem/observation-category",
+                                  "code": "vital-signs", "display": "Vital Signs"}]}],
+        "code": {"coding": [{"system": "http://loinc.org", "code": rng.choice(CODES)}], "text": "心率"},
+        "subject": {"reference": f"Patient/p{index % 1000}"},
+        "effectiveDateTime": f"2024-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}T10:00:00+08:00",
+        "valueQuantity": {"value": round(rng.uniform(40, 200), 1), "unit": "beats/minute",
+                          "system": "http://unitsofmeasure.org", "code": "/min"},
+    }
+
+
+def codec_payloads():
+    rng = random.Random(11)
+    observations = [full_observation(rng, index) for index in range(100)]
+    return [
+        ("Patient", full_patient(rng, 0)),
+        ("Observation", observations[0]),
+        ("searchset Bundle (100)", {
+            "resourceType": "Bundle", "type": "searchset", "total": len(observations),
+            "entry": [{"fullUrl": f"Observation/{o['id']}", "resource": o} for o in observations],
+        }),
+        ("batch Bundle (500)", {
+            "resourceType": "Bundle", "type": "batch",
+            "entry": [{"resource": full_patient(rng, index), "request": {"method": "POST", "url": "Patient"}}
+                      for index in range(500)],
+        }),
+    ]
+
+
+def codec_main(repeat):
+    codecs = [("json", 編解碼.stdlib_dumps, 編解碼.stdlib_loads)]
+    if 編解碼.orjson is not None:
+        codecs.append(("orjson", 編解碼.orjson.dumps, 編解碼.orjson.loads))
+    else:
+        print("orjson not installed, measuring stdlib json only")
+    print(f"codec (active backend: {編解碼.BACKEND}, {repeat} rounds)")
+    for label, payload in codec_payloads():
+        encoded = 編解碼.stdlib_dumps(payload)
+        print(f"{label} ({len(encoded)} bytes)")
+        for name, dumps, loads in codecs:
+            timed(f"{name} dumps", repeat, lambda: [dumps(payload) for _ in range(repeat)])
+            timed(f"{name} loads", repeat, lambda: [loads(encoded) for _ in range(repeat)])
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == "memory":
+        memory_main(int(sys.argv[2]) if len(sys.argv) > 2 else 20000)
+        return
+    if len(sys.argv) > 1 and sys.argv[1] == "codec":
+        codec_main(int(sys.argv[2]) if len(sys.argv) > 2 else 1000)
+        return
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    print(f"memory ({count} patients)")
+    run(FHIRResource(), count)
+
+    with tempfile.TemporaryDirectory() as directory:
+        database = sys.argv[2] if len(sys.argv) > 2 else os.path.join(directory, "fhir.db")
+        print(f"sqlite {database} ({count} patients)")
+        fhir_resource = SQLiteFHIRResource(database)
+        try:
+            run(fhir_resource, count)
+        finally:
+            fhir_resource.close()
+
+
+if __name__ == "__main__":
+    main()
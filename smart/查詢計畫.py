@@ -0,0 +1,273 @@
+"""
+查詢計畫
+
+搜尋參數先編譯成可重複使用的 CompiledQuery (路徑、修飾符與比對函式皆已解析),
+存放在以正規化參數為鍵的 LRU 中; 執行時再依索引統計估算每個條件的選擇性,
+先執行最具選擇性的索引條件, 以 id 集合交集縮小候選, 其餘沒有索引的條件才逐筆比對。
+"""
+import sys
+import threading
+from bisect import bisect_right
+from collections import OrderedDict
+
+from 搜尋索引 import extract_values
+
+
+class Predicate:
+    """單一搜尋條件: 已拆解的路徑、修飾符、對應的索引運算與預先編譯的比對函式"""
+    __slots__ = ("param", "modifier", "value", "op", "parts", "test")
+
+    def __init__(self, param, modifier, value, op, test):
+        self.param = param
+        self.modifier = modifier
+        self.value = value
+        self.op = op
+        self.parts = tuple(param.split("."))
+        self.test = test
+
+    def matches(self, resource):
+        field_values = extract_values(resource, self.parts)
+        if self.modifier == "missing":
+            return (self.value.lower() == "true") == (not field_values)
+        test = self.test
+        return any(test(field_value) for field_value in field_values)
+
+
+class JoinPredicate(Predicate):
+    """需先搜尋其他類型, 再經參照索引換算為 id 集合的條件 (chain 與 _has)
+
+    resolver 於規劃時呼叫, 回傳符合的 id 集合; 回傳 None 表示不構成 join,
+    此時退回一般的路徑條件。
+    """
+    __slots__ = ("resolver",)
+
+    def __init__(self, param, modifier, value, op, test, resolver):
+        super().__init__(param, modifier, value, op, test)
+        self.resolver = resolver
+
+    def resolve(self):
+        return self.resolver()
+
+
+class CompiledQuery:
+    """編譯後的搜尋條件, 同一查詢形狀重複使用"""
+
+    def __init__(self, resource_type, predicates, fingerprint, key):
+        self.resource_type = resource_type
+        self.predicates = predicates
+        self.fingerprint = fingerprint
+        # 正規化後的查詢鍵, 同時作為結果快取的鍵
+        self.key = key
+        # 含 join 時結果也依賴其他類型的資料
+        self.joins = any(isinstance(predicate, JoinPredicate) for predicate in predicates)
+
+
+class PlanCache:
+    """有容量上限的 LRU, 鍵為 (資源類型, 正規化後的搜尋參數)"""
+
+    def __init__(self, capacity=512):
+        self.capacity = capacity
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            compiled = self.entries.get(key)
+            if compiled is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.entries.move_to_end(key)
+            return compiled
+
+    def put(self, key, compiled):
+        with self.lock:
+            self.entries[key] = compiled
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.capacity:
+                self.entries.popitem(last=False)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self.entries),
+            "capacity": self.capacity,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hitRate": self.hits / lookups if lookups else 0.0,
+        }
+
+
+class CachedResult:
+    """快取的搜尋結果: 依寫入順序排列的 (序號, id), 不保存資源本身"""
+    __slots__ = ("versions", "seqs", "ids", "size")
+
+    def __init__(self, versions, matches):
+        self.versions = versions
+        self.seqs = [seq for seq, _ in matches]
+        self.ids = [resource_id for _, resource_id in matches]
+        self.size = ResultCache.estimate_bytes(len(self.ids))
+
+    def __len__(self):
+        return len(self.ids)
+
+    def after(self, seq=None):
+        """游標之後的 (序號, id)"""
+        start = 0 if seq is None else bisect_right(self.seqs, seq)
+        return zip(self.seqs[start:], self.ids[start:])
+
+
+class ResultCache:
+    """搜尋結果快取: 以查詢鍵存放符合的 id 清單
+
+    每筆快取記錄填入時相關類型的寫入計數, 取用時計數不同即視為失效,
+    因此任何 create/update/delete 都會讓該類型的快取精確失效。
+    總用量以估計位元組數限制, 超過時依 LRU 淘汰。
+    """
+
+    # 每筆 (序號, id) 的估計用量: 兩個串列槽位與序號整數, id 字串與資源共用
+    ITEM_BYTES = 2 * 8 + 28
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    @classmethod
+    def estimate_bytes(cls, length):
+        return 2 * sys.getsizeof([]) + length * cls.ITEM_BYTES
+
+    @property
+    def max_entry_items(self):
+        """單筆快取最多保存的結果數 (不超過總預算的四分之一)"""
+        return max(0, (self.max_bytes // 4 - self.estimate_bytes(0)) // self.ITEM_BYTES)
+
+    def get(self, key, versions):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry.versions != versions:
+                self._drop(key)
+                self.invalidations += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return entry
+
+    def put(self, key, versions, matches):
+        entry = CachedResult(versions, matches)
+        with self.lock:
+            if key in self.entries:
+                self._drop(key)
+            self.entries[key] = entry
+            self.bytes += entry.size
+            while self.bytes > self.max_bytes and self.entries:
+                self._drop(next(iter(self.entries)))
+                self.evictions += 1
+        return entry
+
+    def _drop(self, key):
+        self.bytes -= self.entries.pop(key).size
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "bytes": self.bytes,
+            "maxBytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "invalidations": self.invalidations,
+            "evictions": self.evictions,
+            "hitRate": self.hits / lookups if lookups else 0.0,
+        }
+
+
+class SearchPlan:
+    """單次搜尋的執行計畫"""
+
+    def __init__(self, resource_type, indexed, residual, verify_ratio, joined=None):
+        self.resource_type = resource_type
+        # [(條件, 估計筆數)], 依估計筆數遞增排序
+        self.indexed = indexed
+        # 無法由索引回答, 需逐筆比對的條件
+        self.residual = residual
+        self.verify_ratio = verify_ratio
+        # join 條件 -> 規劃時已算出的 id 集合
+        self.joined = joined or {}
+        self.trace = []
+
+    def execute(self, index):
+        """回傳 (候選 id 集合, 需逐筆比對的條件); 沒有索引條件時候選為 None (整個分區)"""
+        ids = None
+        verify = []
+        trace = []
+        for predicate, estimate in self.indexed:
+            joined = predicate in self.joined
+            step = {"param": predicate.param, "modifier": predicate.modifier, "value": predicate.value,
+                    "index": "reference" if joined else index.kind(predicate.param), "estimate": estimate}
+            if ids is not None and not ids:
+                step["strategy"] = "skipped"
+            elif ids is not None and not joined and len(ids) * self.verify_ratio < estimate:
+                # 候選已遠少於此條件的串列長度, 逐筆驗證比取出串列便宜
+                verify.append(predicate)
+                step["strategy"] = "verify"
+            else:
+                if joined:
+                    postings = self.joined[predicate]
+                    step["strategy"] = "join"
+                else:
+                    postings = index.lookup(predicate.param, predicate.op, predicate.value)
+                    step["strategy"] = "index"
+                ids = set(postings) if ids is None else ids & postings
+                step["candidates"] = len(ids)
+            trace.append(step)
+
+        for predicate in self.residual:
+            trace.append({"param": predicate.param, "modifier": predicate.modifier, "value": predicate.value,
+                          "index": None, "strategy": "scan"})
+        self.trace = trace
+        return ids, verify + self.residual
+
+    def explain(self):
+        """供 _explain 輸出的計畫內容"""
+        return {"resourceType": self.resource_type, "steps": self.trace}
+
+
+class QueryPlanner:
+    """以索引統計估算條件選擇性, 產生 SearchPlan"""
+
+    def __init__(self, verify_ratio=8):
+        self.verify_ratio = verify_ratio
+
+    def plan(self, compiled, index):
+        """依目前的索引統計排序 CompiledQuery 的條件; 估計值隨資料變動, 不快取"""
+        indexed = []
+        residual = []
+        joined = {}
+        for predicate in compiled.predicates:
+            if isinstance(predicate, JoinPredicate):
+                ids = predicate.resolve()
+                if ids is not None:
+                    # join 的內層搜尋在規劃時執行, 結果筆數即為精確的選擇性
+                    joined[predicate] = ids
+                    indexed.append((predicate, len(ids)))
+                    continue
+            estimate = None
+            if index is not None and predicate.op is not None:
+                estimate = index.estimate(predicate.param, predicate.op, predicate.value)
+            if estimate is None:
+                residual.append(predicate)
+            else:
+                indexed.append((predicate, estimate))
+        indexed.sort(key=lambda item: item[1])
+        return SearchPlan(compiled.resource_type, indexed, residual, self.verify_ratio, joined)
@@ -0,0 +1,272 @@
+"""
+版本歷史
+
+目前版本完整存放在資源分區, 歷史只保存反向結構差異: 每個舊版本記錄
+「由下一個較新版本還原為此版本」所需的變更, 讀取舊版本時由目前版本逐步套用回去。
+差異只引用被改掉的欄位, 未變動的部分不重複存放。
+各類型另有依 lastUpdated 排序的時間索引, _since 以二分搜尋定位, 不需掃描全部歷史。
+"""
+import threading
+from datetime import datetime, timezone
+
+from advServer import FHIRHandler
+from 搜尋索引 import SortedKeys, parse_date
+
+# 差異操作: 設定舊值、刪除較新版本才有的欄位、遞迴套用巢狀差異
+SET, DELETE, PATCH = "set", "del", "patch"
+
+REQUEST_METHODS = {"create": "POST", "update": "PUT", "delete": "DELETE"}
+RESPONSE_STATUS = {"create": "201 Created", "update": "200 OK", "delete": "204 No Content"}
+
+
+def reverse_diff(new, old):
+    """計算將 new 還原為 old 的差異; 只比較物件欄位, 陣列與純量整個替換"""
+    patch = {}
+    for key, old_value in old.items():
+        if key not in new:
+            patch[key] = (SET, old_value)
+        elif new[key] != old_value:
+            new_value = new[key]
+            if isinstance(new_value, dict) and isinstance(old_value, dict):
+                patch[key] = (PATCH, reverse_diff(new_value, old_value))
+            else:
+                patch[key] = (SET, old_value)
+    for key in new:
+        if key not in old:
+            patch[key] = (DELETE,)
+    return patch
+
+
+def apply_diff(resource, patch):
+    """套用差異, 回傳新物件 (沿變更路徑淺複製, 不修改傳入的資源)"""
+    result = dict(resource)
+    for key, change in patch.items():
+        if change[0] == SET:
+            result[key] = change[1]
+        elif change[0] == DELETE:
+            result.pop(key, None)
+        else:
+            result[key] = apply_diff(result.get(key, {}), change[1])
+    return result
+
+
+def timestamp_of(value):
+    bounds = parse_date(value)
+    return bounds[0] if bounds is not None else 0.0
+
+
+def entry_fields(resource, previous, length):
+    """新版本的 (versionId, lastUpdated); length 為既有版本數
+    用戶端資料可能覆寫 meta, 缺少時以版本鏈長度遞補"""
+    if resource is not None:
+        meta = resource.get("meta", {})
+        return meta.get("versionId", str(length + 1)), meta.get("lastUpdated", datetime.now(timezone.utc).isoformat())
+    previous_version = previous.get("meta", {}).get("versionId", str(length))
+    version_id = str(int(previous_version) + 1) if previous_version.isdigit() else str(length + 1)
+    return version_id, datetime.now(timezone.utc).isoformat()
+
+
+def replay(entries, resource, current):
+    """由新到舊產生 (版本, 該版本內容); resource 為目前版本 (已刪除時為刪除前的最後版本)"""
+    if not entries:
+        # 沒有歷史記錄 (如啟用歷史前已存在的資源) 時只有目前版本
+        if current is not None:
+            meta = current.get("meta") or {}
+            version_id = meta.get("versionId", "1")
+            yield HistoryEntry(version_id, meta.get("lastUpdated"), "create" if version_id == "1" else "update"), current
+        return
+    for position in range(len(entries) - 1, -1, -1):
+        entry = entries[position]
+        if entry.method == "delete":
+            yield entry, None
+            continue
+        if position < len(entries) - 1 and entry.delta is not None:
+            # 刪除前的最後一版即為 tombstone, 其差異為空
+            resource = apply_diff(resource, entry.delta)
+        yield entry, resource
+
+
+class HistoryEntry:
+    """單一版本; delta 為由下一版本還原為此版本的差異 (最新版本為 None)"""
+    __slots__ = ("version_id", "last_updated", "method", "delta")
+
+    def __init__(self, version_id, last_updated, method):
+        self.version_id = version_id
+        self.last_updated = last_updated
+        self.method = method
+        self.delta = None
+
+
+class ResourceHistory:
+    __slots__ = ("entries", "tombstone")
+
+    def __init__(self):
+        self.entries = []
+        # 刪除後分區已不含資源, 保留刪除前的最後版本作為還原起點
+        self.tombstone = None
+
+
+class HistoryStore:
+    """各資源的版本鏈與各類型的時間索引"""
+
+    def __init__(self):
+        self.resources = {}
+        self.timelines = {}
+        self.lock = threading.Lock()
+
+    def record(self, resource_type, resource_id, method, resource, previous=None):
+        """記錄一次寫入; delete 時 resource 為 None, previous 為刪除前的版本"""
+        with self.lock:
+            last_updated, key = self._append(resource_type, resource_id, method, resource, previous)
+            self._timeline(resource_type).insert(timestamp_of(last_updated), key)
+
+    def record_many(self, resource_type, writes):
+        """整批記錄 [(id, 方法, 資源, 先前版本)], 時間索引只排序一次"""
+        timestamps = {}
+        with self.lock:
+            keys = []
+            for write in writes:
+                last_updated, key = self._append(resource_type, *write)
+                # 匯入的資源多半共用同一個 lastUpdated, 只解析一次
+                timestamp = timestamps.get(last_updated)
+                if timestamp is None:
+                    timestamp = timestamps[last_updated] = timestamp_of(last_updated)
+                keys.append((timestamp, key))
+            self._timeline(resource_type).insert_many(keys)
+
+    def _append(self, resource_type, resource_id, method, resource, previous):
+        """加入版本記錄, 回傳 (lastUpdated, 時間索引的值); 呼叫端需持有 lock"""
+        history = self.resources.get((resource_type, resource_id))
+        if history is None:
+            history = self.resources[(resource_type, resource_id)] = ResourceHistory()
+        version_id, last_updated = entry_fields(resource, previous, len(history.entries))
+        if resource is None:
+            history.tombstone = previous
+        if history.entries and previous is not None:
+            base = resource if resource is not None else previous
+            history.entries[-1].delta = reverse_diff(base, previous)
+        history.entries.append(HistoryEntry(version_id, last_updated, method))
+        return last_updated, (resource_id, version_id)
+
+    def export(self):
+        """各資源版本鏈的淺複製 {(類型, id): (tombstone, [版本])}, 供快照使用; 呼叫端需阻擋寫入"""
+        with self.lock:
+            return {key: (history.tombstone, list(history.entries)) for key, history in self.resources.items()}
+
+    def restore_many(self, resource_type, items):
+        """由快照整批還原 [(id, tombstone, [[versionId, lastUpdated, 方法, 差異], ...])]"""
+        timestamps = {}
+        keys = []
+        with self.lock:
+            for resource_id, tombstone, entries in items:
+                history = self.resources[(resource_type, resource_id)] = ResourceHistory()
+                history.tombstone = tombstone
+                for version_id, last_updated, method, delta in entries:
+                    entry = HistoryEntry(version_id, last_updated, method)
+                    entry.delta = delta
+                    history.entries.append(entry)
+                    timestamp = timestamps.get(last_updated)
+                    if timestamp is None:
+                        timestamp = timestamps[last_updated] = timestamp_of(last_updated)
+                    keys.append((timestamp, (resource_id, version_id)))
+            self._timeline(resource_type).insert_many(keys)
+
+    def _timeline(self, resource_type):
+        timeline = self.timelines.get(resource_type)
+        if timeline is None:
+            timeline = self.timelines[resource_type] = SortedKeys()
+        return timeline
+
+    def versions(self, resource_type, resource_id, current):
+        """由新到舊產生 (版本, 該版本內容); 刪除的版本內容為 None"""
+        with self.lock:
+            history = self.resources.get((resource_type, resource_id))
+            if history is None:
+                entries, resource = [], current
+            else:
+                entries = list(history.entries)
+                resource = current if current is not None else history.tombstone
+        return replay(entries, resource, current)
+
+    def version(self, resource_type, resource_id, version_id, current):
+        """取得指定版本, 回傳 (版本, 內容); 不存在時回傳 (None, None)"""
+        for entry, resource in self.versions(resource_type, resource_id, current):
+            if entry.version_id == version_id:
+                return entry, resource
+        return None, None
+
+    def since(self, resource_type, since=None):
+        """時間索引: lastUpdated 不早於 since 的 (id, 版本), 由新到舊"""
+        with self.lock:
+            timeline = self.timelines.get(resource_type)
+            if timeline is None:
+                return []
+            if since is None:
+                changes = list(timeline.ids)
+            else:
+                bounds = parse_date(since)
+                if bounds is None:
+                    raise ValueError(f"Invalid _since: {since}")
+                changes = timeline.at_least(bounds[0])
+        changes.reverse()
+        return changes
+
+    def bundle_entry(self, resource_type, resource_id, entry, resource):
+        url = f"{resource_type}/{resource_id}"
+        bundle_entry = {
+            "fullUrl": url,
+            "request": {
+                "method": REQUEST_METHODS[entry.method],
+                "url": resource_type if entry.method == "create" else url,
+            },
+            "response": {
+                "status": RESPONSE_STATUS[entry.method],
+                "etag": f'W/"{entry.version_id}"',
+                "lastModified": entry.last_updated,
+            },
+        }
+        if resource is not None:
+            bundle_entry["resource"] = resource
+        return bundle_entry
+
+
+class FHIRHistoryHandler(FHIRHandler):
+    """/Type/_history, /Type/id/_history 與 /Type/id/_history/vid (vread)"""
+
+    def options(self, *args):
+        self.set_status(204)
+        self.finish()
+
+    def get(self, resource_type, resource_id=None, version_id=None):
+        try:
+            if version_id is not None:
+                self._vread(resource_type, resource_id, version_id)
+                return
+            count = int(self.get_query_argument("_count", "100"))
+            since = self.get_query_argument("_since", None)
+            if resource_id is None:
+                bundle = self.fhir_resource.type_history(resource_type, since, count)
+            else:
+                bundle = self.fhir_resource.instance_history(resource_type, resource_id, since, count)
+        except ValueError as e:
+            self._outcome(400, "invalid", str(e))
+            return
+        if bundle is None:
+            self._outcome(404, "not-found", f"Resource {resource_type}/{resource_id} not found")
+            return
+        self.write_json(bundle)
+
+    def _vread(self, resource_type, resource_id, version_id):
+        entry, resource = self.fhir_resource.vread(resource_type, resource_id, version_id)
+        if entry is None:
+            self._outcome(404, "not-found", f"Version {resource_type}/{resource_id}/_history/{version_id} not found")
+        elif resource is None:
+            self._outcome(410, "deleted", f"Resource {resource_type}/{resource_id} was deleted in version {version_id}")
+        else:
+            self.set_header("ETag", f'W/"{entry.version_id}"')
+            self.write_json(resource)
+
+    def _outcome(self, status, code, message):
+        self.set_status(status)
+        self.write_json({"resourceType": "OperationOutcome",
+                         "issue": [{"severity": "error", "code": code, "diagnostics": message}]})
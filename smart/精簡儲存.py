@@ -0,0 +1,82 @@
+"""
+精簡儲存
+
+一般模式下每筆資源是巢狀 dict, "resourceType"、"coding"、"system" 等鍵與相同的
+系統 URI 在每份資源都重複一次。精簡模式改以序列化後的 UTF-8 位元組存放,
+旁邊只留一個 __slots__ 表頭 (類型、id、versionId、lastUpdated), 字串經 sys.intern 共用。
+搜尋由索引回答, 只有實際回傳或需逐筆比對的資源才解碼成 dict。
+"""
+import sys
+from collections.abc import MutableMapping
+
+from 編解碼 import dumps, loads
+
+
+def encode_resource(resource):
+    """序列化供長期存放; orjson 的輸出保留約 1 KB 的緩衝區, 複製成剛好大小的 bytes"""
+    return bytes(memoryview(dumps(resource)))
+
+
+class CompactRecord:
+    """單筆資源: 表頭欄位加上序列化內容"""
+    __slots__ = ("resource_type", "id", "version_id", "last_updated", "body")
+
+    def __init__(self, resource_type, resource_id, version_id, last_updated, body):
+        self.resource_type = resource_type
+        self.id = resource_id
+        self.version_id = version_id
+        self.last_updated = last_updated
+        self.body = body
+
+    @classmethod
+    def from_resource(cls, resource_type, resource_id, resource):
+        meta = resource.get("meta") or {}
+        version_id = meta.get("versionId")
+        return cls(
+            sys.intern(resource_type),
+            resource_id,
+            sys.intern(version_id) if isinstance(version_id, str) else version_id,
+            meta.get("lastUpdated"),
+            encode_resource(resource),
+        )
+
+    def decode(self):
+        return loads(self.body)
+
+
+class CompactPartition(MutableMapping):
+    """單一類型的精簡分區: id -> CompactRecord, 取值時才解碼"""
+
+    def __init__(self, resource_type, records=None):
+        self.resource_type = sys.intern(resource_type)
+        self.records = {} if records is None else records
+
+    def __getitem__(self, resource_id):
+        return self.records[resource_id].decode()
+
+    def get(self, resource_id, default=None):
+        record = self.records.get(resource_id)
+        return default if record is None else record.decode()
+
+    def record(self, resource_id):
+        """不解碼, 直接取得表頭與位元組"""
+        return self.records.get(resource_id)
+
+    def __setitem__(self, resource_id, resource):
+        self.records[resource_id] = CompactRecord.from_resource(self.resource_type, resource_id, resource)
+
+    def __delitem__(self, resource_id):
+        del self.records[resource_id]
+
+    def __contains__(self, resource_id):
+        return resource_id in self.records
+
+    def __iter__(self):
+        return iter(self.records)
+
+    def __len__(self):
+        return len(self.records)
+
+    def copy(self):
+        """共用記錄的淺複製 (記錄寫入後不再修改)"""
+        return CompactPartition(self.resource_type, dict(self.records))
@@ -0,0 +1,42 @@
+"""
+JSON 編解碼
+
+所有 handler、批量處理與儲存層都經由這裡編解碼。安裝 orjson 時使用 orjson,
+否則退回標準庫 json; 兩者輸出相同格式: 緊湊分隔、UTF-8 位元組、非 ASCII 字元不跳脫。
+"""
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+BACKEND = "orjson" if orjson is not None else "json"
+
+# orjson.JSONDecodeError 為 json.JSONDecodeError 的子類別, 呼叫端只需捕捉這個
+JSONDecodeError = json.JSONDecodeError
+
+
+def stdlib_dumps(obj):
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode()
+
+
+def stdlib_loads(data):
+    return json.loads(data)
+
+
+if orjson is not None:
+    def dumps(obj):
+        """編碼為 UTF-8 位元組"""
+        try:
+            return orjson.dumps(obj)
+        except TypeError:
+            # orjson 不支援的值 (如超過 64 位元的整數) 交由標準庫處理
+            return stdlib_dumps(obj)
+
+    def loads(data):
+        """由 bytes 或 str 解碼"""
+        return orjson.loads(data)
+else:
+    dumps = stdlib_dumps
+    loads = stdlib_loads
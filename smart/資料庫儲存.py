@@ -0,0 +1,626 @@
+"""
+SQLite 儲存
+
+以標準庫 sqlite3 實作與記憶體模式相同的分區、寫入順序、搜尋索引與參照索引介面,
+FHIRResource 的 create/read/update/delete/search 流程不需修改即可改為存放在磁碟。
+
+- 資源以 JSON 欄位存放, AUTOINCREMENT 的 seq 即寫入順序 (刪除後不重用, 游標保持有效)
+- search_values 為各搜尋路徑的值 (原值、小寫值與日期/數值區間), 對應記憶體的各類索引
+- refs 為參照的正反兩向, 對應 ReferenceIndex
+- history 為各版本的表頭與反向差異 (刪除時另存刪除前的版本), 對應 HistoryStore, 重啟後仍保留
+- WAL 模式, 每次寫入為一筆交易; SQL 皆為固定字串, 由連線的 statement cache 重複使用
+"""
+import sqlite3
+import threading
+from collections.abc import MutableMapping
+from contextlib import contextmanager
+from operator import itemgetter
+
+from 編解碼 import dumps, loads
+from 資源搜尋 import FHIRResource
+from 搜尋索引 import extract_index_values, extract_references, parse_date, parse_number
+from 版本歷史 import HistoryEntry, HistoryStore, entry_fields, replay, reverse_diff, timestamp_of
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS resources (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    type TEXT NOT NULL,
+    id TEXT NOT NULL,
+    content TEXT NOT NULL CHECK (json_valid(content)),
+    UNIQUE (type, id)
+);
+CREATE TABLE IF NOT EXISTS search_values (
+    type TEXT NOT NULL,
+    path TEXT NOT NULL,
+    id TEXT NOT NULL,
+    value TEXT NOT NULL,
+    folded TEXT NOT NULL,
+    lo REAL,
+    hi REAL
+);
+CREATE INDEX IF NOT EXISTS search_values_value ON search_values (type, path, value);
+CREATE INDEX IF NOT EXISTS search_values_folded ON search_values (type, path, folded);
+CREATE INDEX IF NOT EXISTS search_values_lo ON search_values (type, path, lo);
+CREATE INDEX IF NOT EXISTS search_values_hi ON search_values (type, path, hi);
+CREATE INDEX IF NOT EXISTS search_values_id ON search_values (type, id);
+CREATE TABLE IF NOT EXISTS refs (
+    source_type TEXT NOT NULL,
+    source_id TEXT NOT NULL,
+    name TEXT NOT NULL,
+    target_type TEXT NOT NULL,
+    target_id TEXT NOT NULL,
+    UNIQUE (source_type, source_id, name, target_type, target_id)
+);
+CREATE INDEX IF NOT EXISTS refs_target ON refs (target_type, target_id, source_type, name);
+CREATE TABLE IF NOT EXISTS history (
+    type TEXT NOT NULL,
+    id TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    version_id TEXT NOT NULL,
+    last_updated TEXT NOT NULL,
+    method TEXT NOT NULL,
+    ts REAL NOT NULL,
+    delta JSON,
+    tombstone JSON,
+    PRIMARY KEY (type, id, position)
+);
+CREATE INDEX IF NOT EXISTS history_time ON history (type, ts);
+"""
+
+# 範圍運算對應的欄位與搜尋區間端點 (0 為下界, 1 為上界), 語意同 compare_range
+RANGE_CONDITIONS = {
+    "ge": ("hi >", 0),
+    "gt": ("hi >", 1),
+    "le": ("lo <", 1),
+    "lt": ("lo <", 0),
+}
+RANGE_PARSERS = {"date": parse_date, "number": parse_number}
+# :below 的字首上界: 字首接上最大的 Unicode 字元
+MAX_CHAR = "\U0010ffff"
+# IN (...) 一次帶入的參數上限
+CHUNK = 500
+# 依序掃描時每批取回的筆數
+SCAN_BATCH = 256
+
+
+class SQLiteStore:
+    """單一連線加鎖: Tornado 與批量作業的執行緒共用同一連線"""
+
+    def __init__(self, database):
+        self.database = database
+        self.connection = sqlite3.connect(
+            database, isolation_level=None, check_same_thread=False, cached_statements=256
+        )
+        self.lock = threading.RLock()
+        self.depth = 0
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript(SCHEMA)
+
+    def execute(self, sql, args=()):
+        with self.lock:
+            return self.connection.execute(sql, args).fetchall()
+
+    def executemany(self, sql, rows):
+        with self.lock:
+            self.connection.executemany(sql, rows)
+
+    @contextmanager
+    def transaction(self):
+        """巢狀呼叫只在最外層 BEGIN/COMMIT, 發生例外時整筆回滾"""
+        with self.lock:
+            if self.depth == 0:
+                self.connection.execute("BEGIN IMMEDIATE")
+            self.depth += 1
+            try:
+                yield
+            except BaseException:
+                self.depth -= 1
+                if self.depth == 0:
+                    self.connection.execute("ROLLBACK")
+                raise
+            self.depth -= 1
+            if self.depth == 0:
+                self.connection.execute("COMMIT")
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+class _TypeMap(dict):
+    """依資源類型延遲建立物件的 dict; get 對任何類型都回傳物件"""
+
+    def __init__(self, factory):
+        super().__init__()
+        self.factory = factory
+
+    def __missing__(self, resource_type):
+        value = self[resource_type] = self.factory(resource_type)
+        return value
+
+    def get(self, resource_type, default=None):
+        return self[resource_type]
+
+
+class SQLitePartition(MutableMapping):
+    """單一類型的資源分區, 以 id 存取 JSON 欄位"""
+
+    def __init__(self, store, resource_type):
+        self.store = store
+        self.resource_type = resource_type
+
+    def __getitem__(self, resource_id):
+        rows = self.store.execute(
+            "SELECT content FROM resources WHERE type = ? AND id = ?", (self.resource_type, resource_id)
+        )
+        if not rows:
+            raise KeyError(resource_id)
+        return loads(rows[0][0])
+
+    def get(self, resource_id, default=None):
+        try:
+            return self[resource_id]
+        except KeyError:
+            return default
+
+    def __setitem__(self, resource_id, resource):
+        # 已存在時只更新內容, 保留原本的 seq (寫入順序)
+        self.store.execute(
+            "INSERT INTO resources (type, id, content) VALUES (?, ?, ?) "
+            "ON CONFLICT (type, id) DO UPDATE SET content = excluded.content",
+            (self.resource_type, resource_id, dumps(resource).decode()),
+        )
+
+    def __delitem__(self, resource_id):
+        with self.store.lock:
+            cursor = self.store.connection.execute(
+                "DELETE FROM resources WHERE type = ? AND id = ?", (self.resource_type, resource_id)
+            )
+            if not cursor.rowcount:
+                raise KeyError(resource_id)
+
+    def __contains__(self, resource_id):
+        return bool(self.store.execute(
+            "SELECT 1 FROM resources WHERE type = ? AND id = ?", (self.resource_type, resource_id)
+        ))
+
+    def __iter__(self):
+        return (resource_id for _, resource_id in SQLiteOrder(self.store, self.resource_type).scan())
+
+    def __len__(self):
+        return self.store.execute("SELECT COUNT(*) FROM resources WHERE type = ?", (self.resource_type,))[0][0]
+
+    def __bool__(self):
+        return bool(self.store.execute("SELECT 1 FROM resources WHERE type = ? LIMIT 1", (self.resource_type,)))
+
+
+class SQLiteOrder:
+    """寫入順序: 直接使用 resources.seq, 與 InsertionOrder 介面相同"""
+
+    def __init__(self, store, resource_type):
+        self.store = store
+        self.resource_type = resource_type
+
+    def append(self, resource_id):
+        # seq 已在寫入資源時配置
+        return self.seq(resource_id)
+
+    def discard(self, resource_id):
+        """資源列刪除時序號即一併移除"""
+
+    def seq(self, resource_id):
+        rows = self.store.execute(
+            "SELECT seq FROM resources WHERE type = ? AND id = ?", (self.resource_type, resource_id)
+        )
+        return rows[0][0] if rows else None
+
+    def scan(self, after=None):
+        """依序產生 (序號, id); 每批以 seq 為鍵續取, 不在多次 yield 之間持有游標"""
+        last = -1 if after is None else after
+        while True:
+            rows = self.store.execute(
+                "SELECT seq, id FROM resources WHERE type = ? AND seq > ? ORDER BY seq LIMIT ?",
+                (self.resource_type, last, SCAN_BATCH),
+            )
+            yield from rows
+            if len(rows) < SCAN_BATCH:
+                return
+            last = rows[-1][0]
+
+    def sort(self, resource_ids, after=None):
+        """將 id 集合依寫入順序排序, 回傳 [(序號, id)]"""
+        resource_ids = list(resource_ids)
+        keyed = []
+        for start in range(0, len(resource_ids), CHUNK):
+            chunk = resource_ids[start:start + CHUNK]
+            keyed.extend(self.store.execute(
+                f"SELECT seq, id FROM resources WHERE type = ? AND seq > ? "
+                f"AND id IN ({', '.join('?' * len(chunk))})",
+                (self.resource_type, -1 if after is None else after, *chunk),
+            ))
+        keyed.sort()
+        return keyed
+
+
+class SQLiteIndex:
+    """單一類型的搜尋索引, 與 ResourceIndex 介面相同, 值存放於 search_values"""
+
+    def __init__(self, store, resource_type, paths):
+        self.store = store
+        self.resource_type = resource_type
+        self.paths = dict(paths)
+
+    def add(self, resource_id, resource):
+        self._insert(self._rows(resource_id, extract_index_values(resource, self.paths)))
+
+    def add_many(self, items):
+        """整批加入預先取出的值 [(id, {路徑: 值})]; 依 (路徑, 值) 排序後寫入, 索引 B-tree 依序成長"""
+        rows = []
+        for resource_id, values in items:
+            rows.extend(self._rows(resource_id, values))
+        rows.sort(key=itemgetter(1, 3))
+        self._insert(rows)
+
+    def _rows(self, resource_id, values):
+        rows = []
+        for path, found in values.items():
+            parse = RANGE_PARSERS.get(self.paths.get(path))
+            for value in found:
+                bounds = parse(value) if parse is not None else None
+                if parse is not None and bounds is None:
+                    continue
+                lo, hi = bounds if bounds is not None else (None, None)
+                rows.append((self.resource_type, path, resource_id, value, value.lower(), lo, hi))
+        return rows
+
+    def _insert(self, rows):
+        if rows:
+            self.store.executemany(
+                "INSERT INTO search_values (type, path, id, value, folded, lo, hi) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                rows,
+            )
+
+    def remove(self, resource_id, resource):
+        self.store.execute(
+            "DELETE FROM search_values WHERE type = ? AND id = ?", (self.resource_type, resource_id)
+        )
+
+    def _condition(self, path, op, value):
+        """回傳 (WHERE 子句, 參數); 路徑未建索引或不支援的運算回傳 None"""
+        kind = self.paths.get(path)
+        if kind is None:
+            return None
+        if kind in RANGE_PARSERS:
+            if op not in RANGE_CONDITIONS:
+                return None
+            bounds = RANGE_PARSERS[kind](value)
+            if bounds is None:
+                return None
+            column, end = RANGE_CONDITIONS[op]
+            return f"{column} ?", (bounds[end],)
+        if op == "exact":
+            return "value = ?", (value,)
+        if op == "eq":
+            return "folded = ?", (value.lower(),)
+        if op == "contains" and value:
+            return "instr(folded, ?) > 0", (value.lower(),)
+        if op == "below" and kind == "code":
+            return "value >= ? AND value < ?", (value, value + MAX_CHAR)
+        return None
+
+    def _query(self, select, path, op, value):
+        condition = self._condition(path, op, value)
+        if condition is None:
+            return None
+        where, args = condition
+        return self.store.execute(
+            f"SELECT {select} FROM search_values WHERE type = ? AND path = ? AND {where}",
+            (self.resource_type, path, *args),
+        )
+
+    def lookup(self, path, op, value):
+        """由索引取得符合條件的 id 集合; 路徑未建索引或不支援時回傳 None"""
+        rows = self._query("DISTINCT id", path, op, value)
+        return None if rows is None else {resource_id for resource_id, in rows}
+
+    def kind(self, path):
+        kind = self.paths.get(path)
+        return None if kind is None else f"{type(self).__name__}:{kind}"
+
+    def estimate(self, path, op, value):
+        """估計符合筆數 (值的筆數, 為資源數的上限)"""
+        rows = self._query("COUNT(*)", path, op, value)
+        return None if rows is None else rows[0][0]
+
+    def count(self, path, op, value):
+        rows = self._query("COUNT(DISTINCT id)", path, op, value)
+        return None if rows is None else rows[0][0]
+
+
+class SQLiteReferenceIndex:
+    """雙向參照索引, 與 ReferenceIndex 介面相同, 存放於 refs"""
+
+    def __init__(self, store):
+        self.store = store
+
+    def add(self, resource_type, resource_id, resource):
+        self.add_references(resource_type, resource_id, extract_references(resource))
+
+    def add_references(self, resource_type, resource_id, references):
+        self.add_many(resource_type, [(resource_id, references)])
+
+    def add_many(self, resource_type, items):
+        """整批加入 [(id, 參照)], 一次 executemany"""
+        rows = []
+        for resource_id, references in items:
+            for name, _, target in references:
+                target_type, _, target_id = target.partition("/")
+                rows.append((resource_type, resource_id, name, target_type, target_id))
+        if rows:
+            self.store.executemany(
+                "INSERT OR IGNORE INTO refs (source_type, source_id, name, target_type, target_id) "
+                "VALUES (?, ?, ?, ?, ?)",
+                rows,
+            )
+
+    def remove(self, resource_type, resource_id):
+        self.store.execute(
+            "DELETE FROM refs WHERE source_type = ? AND source_id = ?", (resource_type, resource_id)
+        )
+
+    def targets(self, resource_type, resource_id, name="*"):
+        """正向查詢: 資源經由指定元素 ("*" 為全部) 參照到的目標"""
+        if name == "*":
+            rows = self.store.execute(
+                "SELECT target_type, target_id FROM refs WHERE source_type = ? AND source_id = ?",
+                (resource_type, resource_id),
+            )
+        else:
+            rows = self.store.execute(
+                "SELECT target_type, target_id FROM refs WHERE source_type = ? AND source_id = ? AND name = ?",
+                (resource_type, resource_id, name),
+            )
+        return {f"{target_type}/{target_id}" for target_type, target_id in rows}
+
+    def targets_many(self, resource_type, resource_ids, name="*"):
+        """多筆來源的正向查詢, 以 IN (...) 分批取回"""
+        resource_ids = list(resource_ids)
+        name_clause, name_args = ("", ()) if name == "*" else (" AND name = ?", (name,))
+        targets = set()
+        for start in range(0, len(resource_ids), CHUNK):
+            chunk = resource_ids[start:start + CHUNK]
+            rows = self.store.execute(
+                f"SELECT target_type, target_id FROM refs WHERE source_type = ?{name_clause} "
+                f"AND source_id IN ({', '.join('?' * len(chunk))})",
+                (resource_type, *name_args, *chunk),
+            )
+            targets.update(f"{target_type}/{target_id}" for target_type, target_id in rows)
+        return targets
+
+    def target_types(self, resource_type, name):
+        """元素目前實際參照到的目標類型"""
+        rows = self.store.execute(
+            "SELECT DISTINCT target_type FROM refs WHERE source_type = ? AND name = ? ORDER BY target_type",
+            (resource_type, name),
+        )
+        return [target_type for target_type, in rows]
+
+    def sources(self, target, source_type, name="*"):
+        """反向查詢: 經由指定元素參照到 target 的來源資源 id"""
+        target_type, _, target_id = target.partition("/")
+        if name == "*":
+            rows = self.store.execute(
+                "SELECT source_id FROM refs WHERE target_type = ? AND target_id = ? AND source_type = ?",
+                (target_type, target_id, source_type),
+            )
+        else:
+            rows = self.store.execute(
+                "SELECT source_id FROM refs WHERE target_type = ? AND target_id = ? AND source_type = ? AND name = ?",
+                (target_type, target_id, source_type, name),
+            )
+        return {source_id for source_id, in rows}
+
+    def sources_many(self, targets, source_type, name="*"):
+        """多個目標的反向查詢, 依目標類型以 IN (...) 分批取回"""
+        by_type = {}
+        for target in targets:
+            target_type, _, target_id = target.partition("/")
+            by_type.setdefault(target_type, []).append(target_id)
+        name_clause, name_args = ("", ()) if name == "*" else (" AND name = ?", (name,))
+        ids = set()
+        for target_type, target_ids in by_type.items():
+            for start in range(0, len(target_ids), CHUNK):
+                chunk = target_ids[start:start + CHUNK]
+                rows = self.store.execute(
+                    f"SELECT source_id FROM refs WHERE source_type = ?{name_clause} AND target_type = ? "
+                    f"AND target_id IN ({', '.join('?' * len(chunk))})",
+                    (source_type, *name_args, target_type, *chunk),
+                )
+                ids.update(source_id for source_id, in rows)
+        return ids
+
+
+class SQLiteHistoryStore(HistoryStore):
+    """版本歷史, 與 HistoryStore 介面相同, 存放於 history; 與資源的寫入在同一筆交易內"""
+
+    def __init__(self, store):
+        self.store = store
+
+    def record(self, resource_type, resource_id, method, resource, previous=None):
+        self.record_many(resource_type, [(resource_id, method, resource, previous)])
+
+    def record_many(self, resource_type, writes):
+        """整批記錄 [(id, 方法, 資源, 先前版本)]"""
+        writes = list(writes)
+        positions = self._last_positions(resource_type, [write[0] for write in writes])
+        rows = []
+        deltas = []
+        timestamps = {}
+        for resource_id, method, resource, previous in writes:
+            last = positions.get(resource_id, 0)
+            version_id, last_updated = entry_fields(resource, previous, last)
+            if last and previous is not None:
+                base = resource if resource is not None else previous
+                deltas.append((dumps(reverse_diff(base, previous)).decode(), resource_type, resource_id, last))
+            timestamp = timestamps.get(last_updated)
+            if timestamp is None:
+                timestamp = timestamps[last_updated] = timestamp_of(last_updated)
+            tombstone = dumps(previous).decode() if resource is None else None
+            rows.append((resource_type, resource_id, last + 1, version_id, last_updated, method, timestamp, tombstone))
+            positions[resource_id] = last + 1
+        with self.store.transaction():
+            self.store.executemany(
+                "INSERT INTO history (type, id, position, version_id, last_updated, method, ts, tombstone) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                rows,
+            )
+            # 差異寫在前一個版本上, 該版本可能是同一批剛插入的
+            self.store.executemany(
+                "UPDATE history SET delta = ? WHERE type = ? AND id = ? AND position = ?", deltas
+            )
+
+    def _last_positions(self, resource_type, resource_ids):
+        """各資源目前最後一個版本的位置 {id: 位置}, 沒有歷史的省略"""
+        positions = {}
+        resource_ids = list(dict.fromkeys(resource_ids))
+        for start in range(0, len(resource_ids), CHUNK):
+            chunk = resource_ids[start:start + CHUNK]
+            positions.update(self.store.execute(
+                f"SELECT id, MAX(position) FROM history WHERE type = ? "
+                f"AND id IN ({', '.join('?' * len(chunk))}) GROUP BY id",
+                (resource_type, *chunk),
+            ))
+        return positions
+
+    def versions(self, resource_type, resource_id, current):
+        rows = self.store.execute(
+            "SELECT version_id, last_updated, method, delta, tombstone FROM history "
+            "WHERE type = ? AND id = ? ORDER BY position",
+            (resource_type, resource_id),
+        )
+        entries = []
+        tombstone = None
+        for version_id, last_updated, method, delta, deleted in rows:
+            entry = HistoryEntry(version_id, last_updated, method)
+            entry.delta = None if delta is None else loads(delta)
+            entries.append(entry)
+            if deleted is not None:
+                tombstone = deleted
+        resource = current
+        if current is None and tombstone is not None:
+            resource = loads(tombstone)
+        return replay(entries, resource, current)
+
+    def since(self, resource_type, since=None):
+        lower = float("-inf")
+        if since is not None:
+            bounds = parse_date(since)
+            if bounds is None:
+                raise ValueError(f"Invalid _since: {since}")
+            lower = bounds[0]
+        return self._scan_since(resource_type, lower)
+
+    def _scan_since(self, resource_type, lower):
+        """由新到舊產生 (id, 版本); 每批以 (ts, rowid) 續取"""
+        rows = self.store.execute(
+            "SELECT ts, rowid, id, version_id FROM history WHERE type = ? AND ts >= ? "
+            "ORDER BY ts DESC, rowid DESC LIMIT ?",
+            (resource_type, lower, SCAN_BATCH),
+        )
+        while rows:
+            for _, _, resource_id, version_id in rows:
+                yield resource_id, version_id
+            if len(rows) < SCAN_BATCH:
+                return
+            ts, rowid = rows[-1][:2]
+            rows = self.store.execute(
+                "SELECT ts, rowid, id, version_id FROM history WHERE type = ? AND ts >= ? "
+                "AND (ts < ? OR (ts = ? AND rowid < ?)) ORDER BY ts DESC, rowid DESC LIMIT ?",
+                (resource_type, lower, ts, ts, rowid, SCAN_BATCH),
+            )
+
+
+class SQLiteFHIRResource(FHIRResource):
+    """資料存放於 SQLite 的 FHIRResource; database 為檔案路徑 (":memory:" 為記憶體資料庫)"""
+
+    def __init__(self, database, search_paths=None, result_cache_bytes=0, include_limit=1000):
+        super().__init__(search_paths, result_cache_bytes, include_limit)
+        self.store = SQLiteStore(database)
+        self.resources = _TypeMap(lambda resource_type: SQLitePartition(self.store, resource_type))
+        self.orders = _TypeMap(lambda resource_type: SQLiteOrder(self.store, resource_type))
+        self.indexes = {
+            resource_type: SQLiteIndex(self.store, resource_type, paths)
+            for resource_type, paths in self.search_paths.items()
+        }
+        self.references = SQLiteReferenceIndex(self.store)
+        self.history = SQLiteHistoryStore(self.store)
+
+    def _partition(self, resource_type):
+        return self.resources[resource_type]
+
+    def _index(self, resource_type):
+        return self.indexes.get(resource_type)
+
+    def count(self, resource_type=None):
+        if resource_type is not None:
+            return len(self.resources[resource_type])
+        return dict(self.store.execute("SELECT type, COUNT(*) FROM resources GROUP BY type"))
+
+    # 每次寫入 (資源、搜尋值與參照) 為一筆交易
+    def create(self, resource_type, data):
+        with self.store.transaction():
+            return super().create(resource_type, data)
+
+    def update(self, resource_type, resource_id, data):
+        with self.store.transaction():
+            return super().update(resource_type, resource_id, data)
+
+    def delete(self, resource_type, resource_id):
+        with self.store.transaction():
+            return super().delete(resource_type, resource_id)
+
+    def apply(self, changes):
+        # 交易的全部寫入在同一筆 SQLite 交易內, 失敗時整筆回滾
+        with self.store.transaction():
+            return super().apply(changes)
+
+    def bulk_load(self, resource_type, records):
+        """整批匯入為一筆 SQLite 交易: 資源、搜尋值與參照各一次 executemany, 不逐筆查詢既有資源"""
+        records = list(records)
+        with self.store.transaction(), self.committing():
+            replaced = self._existing(resource_type, [record[0] for record in records])
+            for resource_id, previous in replaced.items():
+                self._unindex_resource(resource_type, resource_id, previous)
+                self.bodies.pop((resource_type, resource_id), None)
+            for resource_id, resource, _, _ in records:
+                previous = replaced.get(resource_id)
+                if previous is not None:
+                    resource["meta"]["versionId"] = str(int(previous["meta"]["versionId"]) + 1)
+            # 已存在時只更新內容, 保留原本的 seq (寫入順序)
+            self.store.executemany(
+                "INSERT INTO resources (type, id, content) VALUES (?, ?, ?) "
+                "ON CONFLICT (type, id) DO UPDATE SET content = excluded.content",
+                [(resource_type, resource_id, dumps(resource).decode()) for resource_id, resource, _, _ in records],
+            )
+            self._index_many(resource_type, records)
+            self._record_history(resource_type, records, replaced)
+            self._touch(resource_type)
+        return replaced
+
+    def _existing(self, resource_type, resource_ids):
+        """已存在的資源 {id: 資源}"""
+        existing = {}
+        for start in range(0, len(resource_ids), CHUNK):
+            chunk = resource_ids[start:start + CHUNK]
+            existing.update(
+                (resource_id, loads(content))
+                for resource_id, content in self.store.execute(
+                    f"SELECT id, content FROM resources WHERE type = ? AND id IN ({', '.join('?' * len(chunk))})",
+                    (resource_type, *chunk),
+                )
+            )
+        return existing
+
+    def close(self):
+        self.store.close()
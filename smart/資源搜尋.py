@@ -1,55 +1,160 @@
 import tornado.ioloop
 import tornado.web
 import json
+import base64
+import hashlib
 from datetime import datetime, timedelta
 import uuid
-from urllib.parse import parse_qs
+from urllib.parse import parse_qs, urlencode
 import re
+from itertools import chain, islice
 from dateutil import parser as date_parser
+from advServer import FHIRResource as BaseFHIRResource
+from 精簡儲存 import CompactPartition
+from 搜尋索引 import REFERENCE_SEARCH_PARAMS, InsertionOrder, ReferenceIndex, compare_range, parse_date, parse_number
+from 版本歷史 import HistoryStore
+from 查詢計畫 import CompiledQuery, JoinPredicate, PlanCache, Predicate, QueryPlanner, ResultCache
 
-class FHIRResource:
-    def __init__(self):
-        self.resources = {}
-        # 存儲資源之間的參照關係
-        self.references = {}
-    def create(self, resource_type, data):
-        resource_id = str(uuid.uuid4())
-        timestamp = datetime.now().isoformat()
-        resource = {
-          "resourceType": resource_type,
-          "id": resource_id,
-          "meta": {
-            "versionId": "1",
-            "lastUpdated": timestamp
-          }
+class FHIRResource(BaseFHIRResource):
+    # 可直接由索引回答的修飾符 -> 索引運算; 預設 (無修飾符) 為模糊比對
+    INDEXED_MODIFIERS = {
+        None: 'contains', 'contains': 'contains', 'exact': 'exact',
+        'gt': 'gt', 'ge': 'ge', 'lt': 'lt', 'le': 'le', 'below': 'below',
+    }
+    # 非過濾條件的特殊參數
+    SPECIAL_PARAMS = {
+        '_page', '_cursor', '_count', '_include', '_revinclude', '_include:iterate', '_revinclude:iterate',
+        '_summary', '_explain', '_total',
+    }
+    # Reference 本身的欄位, 以這些欄位接續的路徑 (如 subject.reference) 不視為 chain
+    REFERENCE_FIELDS = {'reference', 'display', 'identifier', 'type'}
+
+    def __init__(self, search_paths=None, result_cache_bytes=0, include_limit=1000, compact=False):
+        super().__init__(search_paths)
+        # 精簡模式: 資源以序列化位元組存放, 取出時才解碼
+        self.compact = compact
+        # 單次請求經 _include/_revinclude 加入的資源上限
+        self.include_limit = include_limit
+        # 雙向參照索引, 供 _include/_revinclude 直接查詢
+        self.references = ReferenceIndex()
+        self.planner = QueryPlanner()
+        self.plan_cache = PlanCache()
+        # 搜尋結果快取 (選用), result_cache_bytes 為記憶體預算
+        self.result_cache = ResultCache(result_cache_bytes) if result_cache_bytes else None
+        # 版本歷史: 舊版本以反向差異保存
+        self.history = HistoryStore()
+
+    def _partition(self, resource_type):
+        if not self.compact:
+            return super()._partition(resource_type)
+        partition = self.resources.get(resource_type)
+        if partition is None:
+            partition = self.resources[resource_type] = CompactPartition(resource_type)
+            self.orders[resource_type] = InsertionOrder()
+        return partition
+
+    def _record(self, resource_type, resource_id):
+        """精簡模式下的原始記錄; 一般模式回傳 None"""
+        partition = self.resources.get(resource_type)
+        if isinstance(partition, CompactPartition):
+            return partition.record(resource_id)
+        return None
+
+    def read_header(self, resource_type, resource_id):
+        record = self._record(resource_type, resource_id)
+        if record is not None:
+            return record.version_id, record.last_updated
+        return super().read_header(resource_type, resource_id)
+
+    def read_bytes(self, resource_type, resource_id):
+        # 精簡模式存放的就是序列化後的內容, 不需解碼再編碼
+        record = self._record(resource_type, resource_id)
+        if record is not None:
+            return record.body
+        return super().read_bytes(resource_type, resource_id)
+
+    def resource_bytes(self, resource_type, resource_id, resource):
+        record = self._record(resource_type, resource_id)
+        if record is not None and record.version_id == (resource.get("meta") or {}).get("versionId"):
+            return record.body
+        return super().resource_bytes(resource_type, resource_id, resource)
+
+    def _put(self, resource_type, resource_id, resource):
+        previous = super()._put(resource_type, resource_id, resource)
+        self.history.record(resource_type, resource_id, "create" if previous is None else "update", resource, previous)
+        return previous
+
+    def bulk_load(self, resource_type, records):
+        with self.committing():
+            replaced = super().bulk_load(resource_type, records)
+            self._record_history(resource_type, records, replaced)
+        return replaced
+
+    def _record_history(self, resource_type, records, replaced):
+        writes = []
+        for resource_id, resource, _, _ in records:
+            previous = replaced.get(resource_id)
+            writes.append((resource_id, "create" if previous is None else "update", resource, previous))
+        self.history.record_many(resource_type, writes)
+
+    def _remove(self, resource_type, resource_id):
+        resource = super()._remove(resource_type, resource_id)
+        if resource is not None:
+            self.history.record(resource_type, resource_id, "delete", None, resource)
+        return resource
+
+    def vread(self, resource_type, resource_id, version_id):
+        """讀取指定版本, 回傳 (版本記錄, 內容); 刪除的版本內容為 None"""
+        return self.history.version(resource_type, resource_id, version_id, self.read(resource_type, resource_id))
+
+    def instance_history(self, resource_type, resource_id, since=None, count=100):
+        """單一資源的歷史 Bundle (由新到舊); 沒有任何版本時回傳 None"""
+        since_key = None
+        if since is not None:
+            bounds = parse_date(since)
+            if bounds is None:
+                raise ValueError(f"Invalid _since: {since}")
+            since_key = bounds[0]
+        current = self.read(resource_type, resource_id)
+        entries = []
+        for entry, resource in self.history.versions(resource_type, resource_id, current):
+            if since_key is not None and (parse_date(entry.last_updated) or (0,))[0] < since_key:
+                break
+            entries.append(self.history.bundle_entry(resource_type, resource_id, entry, resource))
+        if not entries and since is None:
+            return None
+        return self._history_bundle(entries, count)
+
+    def type_history(self, resource_type, since=None, count=100):
+        """類型層級的歷史 Bundle, _since 由時間索引定位"""
+        entries = []
+        for resource_id, version_id in self.history.since(resource_type, since):
+            if len(entries) >= count:
+                break
+            entry, resource = self.vread(resource_type, resource_id, version_id)
+            if entry is not None:
+                entries.append(self.history.bundle_entry(resource_type, resource_id, entry, resource))
+        return self._history_bundle(entries, count)
+
+    def _history_bundle(self, entries, count):
+        return {
+            "resourceType": "Bundle",
+            "type": "history",
+            "entry": entries[:count],
         }
-        resource.update(data)
-        key = f"{resource_type}/{resource_id}"
-        self.resources[key] = resource
+
+    def _index_resource(self, resource_type, resource_id, resource):
+        super()._index_resource(resource_type, resource_id, resource)
         # 存儲參照關係
-        self._store_references(resource_type, resource_id, data)
-        return resource
-    
-    def _store_references(self, resource_type, resource_id, data):
-        """存儲資源之間的參照關係"""
-        def extract_references(obj, path=""):
-            if isinstance(obj, dict):
-                for k, v in obj.items():
-                    if k == "reference" and isinstance(v, str):
-                        # 存儲正向參照
-                        referenced_type, referenced_id = v.split("/")
-                        if referenced_type not in self.references:
-                            self.references[referenced_type] = {}
-                        if referenced_id not in self.references[referenced_type]:
-                            self.references[referenced_type][referenced_id] = set()
-                        self.references[referenced_type][referenced_id].add(f"{resource_type}/{resource_id}")
-                    elif isinstance(v, (dict, list)):
-                        extract_references(v, f"{path}.{k}" if path else k)
-            elif isinstance(obj, list):
-                for item in obj:
-                    extract_references(item, path)
-        
-        extract_references(data)
+        self.references.add(resource_type, resource_id, resource)
+
+    def _unindex_resource(self, resource_type, resource_id, resource):
+        super()._unindex_resource(resource_type, resource_id, resource)
+        self.references.remove(resource_type, resource_id)
+
+    def _index_many(self, resource_type, records):
+        super()._index_many(resource_type, records)
+        self.references.add_many(resource_type, ((resource_id, references) for resource_id, _, _, references in records))
 
     def search(self, resource_type, params):
         """增強的搜索功能"""
@@ -59,211 +164,476 @@ class FHIRResource:
         except ValueError:
             page = 1
             count = 10
+        if count < 0:
+            raise ValueError(f"Invalid _count: {count}")
 
         # 處理 _include 和 _revinclude
-        include_params = params.get('_include', [])
-        revinclude_params = params.get('_revinclude', [])
-
-        # 首先過濾主要資源
-        matching_resources = [
-            resource for key, resource in self.resources.items()
-            if key.startswith(f"{resource_type}/")
-        ]
-
-        # 應用搜索條件
-        filtered_resources = self._apply_search_filters(matching_resources, params)
-        
-        # 收集包含的資源
+        include_params = params.get('_include', []) + [p + ':iterate' for p in params.get('_include:iterate', [])]
+        revinclude_params = params.get('_revinclude', []) + [p + ':iterate' for p in params.get('_revinclude:iterate', [])]
+
+        # _summary=count 與 _count=0 只回報筆數, 盡量由索引計算
+        if params.get('_summary', [None])[0] == 'count' or count == 0:
+            return {
+                "resourceType": "Bundle",
+                "type": "searchset",
+                "total": self._count_matches(resource_type, params),
+            }
+
+        # 取得 (或編譯) 此查詢形狀的 CompiledQuery
+        compiled = self._compile_query(resource_type, params)
+
+        # _cursor 為上一頁最後一筆的寫入序號, 由該處往後取 (keyset 分頁)
+        after = None
+        cursor = params.get('_cursor', [None])[0]
+        if cursor:
+            after = self._decode_cursor(cursor, compiled.fingerprint)
+
+        # 結果快取命中時直接取 id 清單, 否則依選擇性規劃, 結果以 generator 逐筆產生
+        plan = None
+        cached = self._cached_result(compiled)
+        if cached is not None:
+            matches, candidate_total, exact = self._iter_cached(resource_type, cached, after), len(cached), True
+        else:
+            plan = self.planner.plan(compiled, self.indexes.get(resource_type))
+            matches, candidate_total, exact = self._iter_matches(resource_type, plan, after)
+            if after is None and self.result_cache is not None:
+                matches, candidate_total, exact = self._fill_result_cache(compiled, matches, candidate_total, exact)
+
+        # 只取到本頁結束再多一筆 (判斷是否有下一頁), 滿頁即停止比對
+        start_index = 0 if cursor else (page - 1) * count
+        taken = list(islice(matches, start_index + count + 1))
+        paged = taken[start_index:start_index + count]
+        has_next = len(taken) > start_index + count
+        paged_resources = [resource for _, _, resource in paged]
+
+        # 收集包含的資源, 只處理本頁結果
         included_resources = []
+        truncated = False
         if include_params or revinclude_params:
-            included_resources = self._get_included_resources(
-                filtered_resources,
+            included_resources, truncated = self._get_included_resources(
+                resource_type,
+                [resource_id for _, resource_id, _ in paged],
                 include_params,
                 revinclude_params
             )
 
-        # 計算分頁
-        start_index = (page - 1) * count
-        end_index = start_index + count
-        
-        # 準備分頁後的主要資源
-        paged_resources = filtered_resources[start_index:end_index]
-        
+        entries = [{"resource": resource} for resource in paged_resources] + \
+                  [{"resource": resource} for resource in included_resources]
+        if truncated:
+            entries.append(self._include_limit_entry())
+
+        # _explain 以 OperationOutcome 附上實際採用的查詢計畫
+        if params.get('_explain', ['false'])[0] == 'true':
+            explain = plan.explain() if plan else {"resourceType": resource_type, "resultCache": "hit"}
+            entries.append(self._explain_entry(explain))
+
+        next_cursor = self._encode_cursor(compiled.fingerprint, paged[-1][0]) if has_next and paged else None
+
         # 創建Bundle資源
-        return {
+        bundle = {
             "resourceType": "Bundle",
             "type": "searchset",
-            "total": len(filtered_resources),
-            "link": self._create_pagination_links(resource_type, params, page, count, len(filtered_resources)),
-            "entry": [{"resource": resource} for resource in paged_resources] +
-                    [{"resource": resource} for resource in included_resources]
+            "link": self._create_cursor_links(resource_type, params, next_cursor),
+            "entry": entries
         }
 
-    def _get_included_resources(self, resources, include_params, revinclude_params):
-        """處理 _include 和 _revinclude 參數"""
-        included = set()
-        
-        # 處理 _include
-        for include_param in include_params:
-            # 格式: ResourceType:search-parameter
-            try:
-                resource_type, search_param = include_param.split(':')
-                for resource in resources:
-                    # 遍歷資源中的參照
-                    references = self._extract_references(resource, search_param)
-                    for ref in references:
-                        if ref in self.resources:
-                            included.add(ref)
-            except ValueError:
-                continue
+        # _total: none 不計算, estimate 以候選數估計, accurate (預設) 才數完剩餘結果
+        total_mode = params.get('_total', ['accurate'])[0]
+        if not has_next and after is None:
+            bundle["total"] = len(taken)
+        elif total_mode == 'estimate' or (total_mode == 'accurate' and exact):
+            bundle["total"] = candidate_total
+        elif total_mode == 'accurate' and after is None:
+            bundle["total"] = len(taken) + sum(1 for _ in matches)
+        elif total_mode == 'accurate':
+            # 游標之前的結果沒有走過, 精確總數需從頭計算
+            plan = self.planner.plan(compiled, self.indexes.get(resource_type))
+            bundle["total"] = sum(1 for _ in self._iter_matches(resource_type, plan)[0])
+        return bundle
+
+    def _query_fingerprint(self, params, resource_type=None):
+        """搜尋條件的摘要, 避免游標被套用到不同的查詢"""
+        normalized = sorted(
+            (param, values) for param, values in params.items() if param not in self.SPECIAL_PARAMS
+        )
+        return hashlib.sha1(json.dumps([resource_type, normalized]).encode()).hexdigest()[:12]
+
+    def _encode_cursor(self, fingerprint, after):
+        """將排序鍵 (寫入序號) 與查詢摘要編成不透明的游標"""
+        payload = json.dumps({"a": after, "q": fingerprint}, separators=(',', ':'))
+        return base64.urlsafe_b64encode(payload.encode()).decode().rstrip('=')
+
+    def _decode_cursor(self, cursor, fingerprint):
+        try:
+            padded = cursor + '=' * (-len(cursor) % 4)
+            payload = json.loads(base64.urlsafe_b64decode(padded.encode()))
+            after = int(payload["a"])
+        except (ValueError, KeyError, TypeError):
+            raise ValueError("Invalid _cursor")
+        if payload["q"] != fingerprint:
+            raise ValueError("_cursor does not belong to this search")
+        return after
+
+    def _create_cursor_links(self, resource_type, params, next_cursor):
+        """創建游標分頁連結, next 帶上不透明的 _cursor"""
+        base_url = f"/{resource_type}?"
+        query = [(k, v) for k, values in params.items() if k not in ('_page', '_cursor') for v in values]
+
+        links = [{
+            "relation": "self",
+            "url": base_url + urlencode(query + [(k, v) for k in ('_page', '_cursor') for v in params.get(k, [])])
+        }]
+        if '_cursor' in params or params.get('_page', ['1'])[0] != '1':
+            links.append({"relation": "first", "url": base_url + urlencode(query)})
+        if next_cursor:
+            links.append({"relation": "next", "url": base_url + urlencode(query + [('_cursor', next_cursor)])})
+        return links
+
+    def _explain_entry(self, explain):
+        """將查詢計畫包成 search.mode 為 outcome 的 Bundle entry"""
+        return {
+            "resource": {
+                "resourceType": "OperationOutcome",
+                "issue": [{
+                    "severity": "information",
+                    "code": "informational",
+                    "diagnostics": json.dumps(explain, ensure_ascii=False)
+                }]
+            },
+            "search": {"mode": "outcome"}
+        }
+
+    def _include_limit_entry(self):
+        """包含的資源達上限時附上的警告"""
+        return {
+            "resource": {
+                "resourceType": "OperationOutcome",
+                "issue": [{
+                    "severity": "warning",
+                    "code": "too-costly",
+                    "diagnostics": f"_include/_revinclude stopped after {self.include_limit} resources"
+                }]
+            },
+            "search": {"mode": "outcome"}
+        }
+
+    def _parse_include_rules(self, include_params, revinclude_params):
+        """解析為 (方向, 來源類型, 元素名稱, 目標類型, 是否 iterate)"""
+        rules = []
+        for direction, values in (('include', include_params), ('revinclude', revinclude_params)):
+            for value in values:
+                # 格式: SourceType:search-parameter[:TargetType][:iterate]
+                parts = value.split(':')
+                iterate = parts[-1] == 'iterate'
+                if iterate:
+                    parts = parts[:-1]
+                if len(parts) not in (2, 3):
+                    continue
+                element, target_type = self._reference_param(parts[0], parts[1])
+                if len(parts) == 3:
+                    target_type = parts[2]
+                rules.append((direction, parts[0], element, target_type, iterate))
+        return rules
+
+    def _reference_param(self, resource_type, name):
+        """搜尋參數對應的 (參照元素名稱, 目標類型), 取自 REFERENCE_SEARCH_PARAMS;
+        表中沒有的參數視為與元素同名, 連字號轉為 camelCase (service-provider -> serviceProvider)"""
+        mapped = REFERENCE_SEARCH_PARAMS.get(resource_type, {}).get(name)
+        if mapped is not None:
+            return mapped
+        return re.sub(r'-(\w)', lambda m: m.group(1).upper(), name), None
+
+    def _expand_reference(self, ref, rule):
+        """依單一規則由 "Type/id" 沿參照索引走一步, 回傳相鄰的資源參照"""
+        direction, source_type, name, target_type, _ = rule
+        ref_type, _, ref_id = ref.partition("/")
+        if direction == 'include':
+            if source_type not in (ref_type, '*'):
+                return ()
+            return (target for target in self.references.targets(ref_type, ref_id, name)
+                    if target_type is None or target.startswith(f"{target_type}/"))
+        if target_type not in (None, ref_type):
+            return ()
+        return (f"{source_type}/{source_id}" for source_id in self.references.sources(ref, source_type, name))
+
+    def _get_included_resources(self, resource_type, resource_ids, include_params, revinclude_params):
+        """處理 _include 和 _revinclude 參數, 完全由參照索引查詢
+
+        第一層對本頁結果套用所有規則, 之後每層只對上一層新加入的資源套用 iterate 規則,
+        以廣度優先逐層展開; 已走過的資源不再加入 (避免循環參照), 達 include_limit 即停止。
+        回傳 (包含的資源, 是否因上限截斷)。
+        """
+        rules = self._parse_include_rules(include_params, revinclude_params)
+        iterate_rules = [rule for rule in rules if rule[4]]
+        frontier = [f"{resource_type}/{resource_id}" for resource_id in resource_ids]
+        seen = set(frontier)
+        included = []
+        level_rules = rules
+        while frontier and level_rules:
+            next_frontier = []
+            for rule in level_rules:
+                for ref in frontier:
+                    for target in self._expand_reference(ref, rule):
+                        if target in seen:
+                            continue
+                        resource = self._read_reference(target)
+                        if resource is None:
+                            continue
+                        if len(included) >= self.include_limit:
+                            return included, True
+                        seen.add(target)
+                        included.append(resource)
+                        next_frontier.append(target)
+            frontier = next_frontier
+            level_rules = iterate_rules
+        return included, False
+
+    def _read_reference(self, ref):
+        """依 "Type/id" 形式的參照讀取資源"""
+        ref_type, _, ref_id = ref.partition("/")
+        return self.read(ref_type, ref_id)
+
+    def _compile_query(self, resource_type, params):
+        """將搜尋參數編譯為 CompiledQuery; 以正規化後的參數為鍵快取於 LRU"""
+        key = (resource_type, tuple(sorted(
+            (param, tuple(values)) for param, values in params.items() if param not in self.SPECIAL_PARAMS
+        )))
+        compiled = self.plan_cache.get(key)
+        if compiled is None:
+            predicates = []
+            for param, values in key[1]:
+                predicate = self._compile_join(resource_type, param, values[0])
+                if predicate is None:
+                    base_param, modifier = self._parse_param(param)
+                    predicate = self._compile_predicate(base_param, modifier, values[0])
+                predicates.append(predicate)
+            compiled = CompiledQuery(resource_type, predicates, self._query_fingerprint(params, resource_type), key)
+            self.plan_cache.put(key, compiled)
+        return compiled
+
+    def _compile_predicate(self, param, modifier, value):
+        """解析單一條件: 對應索引運算並預先建立比對函式"""
+        test = None if modifier == 'missing' else self._value_matcher(value, modifier)
+        return Predicate(param, modifier, value, self.INDEXED_MODIFIERS.get(modifier), test)
+
+    def _compile_join(self, resource_type, param, value):
+        """chain 參數 (如 subject:Patient.name, service-provider.name) 與 _has 編譯為 JoinPredicate"""
+        if param.startswith('_has:'):
+            return self._compile_has(resource_type, param, value)
+        head, dot, rest = param.partition('.')
+        if not dot:
+            return None
+        name, _, target_type = head.partition(':')
+        if target_type and not target_type[:1].isupper():
+            return None
+        if not target_type and (rest.split(':')[0].split('.')[0] in self.REFERENCE_FIELDS or
+                                any(path.startswith(f"{name}.") for path in self.search_paths.get(resource_type, ()))):
+            return None
+        element, default_type = self._reference_param(resource_type, name)
+        target_type = target_type or default_type
+        # 未指定目標類型時, 若元素實際上沒有參照則退回一般路徑條件
+        base_param, modifier = self._parse_param(f"{name}.{rest}")
+        predicate = self._compile_predicate(base_param, modifier, value)
+
+        def resolve():
+            return self._resolve_chain(resource_type, element, target_type or None, rest, value)
+        return JoinPredicate(base_param, modifier, value, predicate.op, predicate.test, resolve)
+
+    def _resolve_chain(self, resource_type, element, target_type, inner_param, value):
+        """內層搜尋得到目標 id, 再經反向參照索引換算為外層資源 id"""
+        target_types = [target_type] if target_type else self.references.target_types(resource_type, element)
+        if not target_types:
+            return None
+        ids = set()
+        for inner_type in target_types:
+            inner_ids = self._search_ids(inner_type, {inner_param: [value]})
+            targets = (f"{inner_type}/{inner_id}" for inner_id in inner_ids)
+            ids |= self.references.sources_many(targets, resource_type, element)
+        return self._live_ids(resource_type, ids)
+
+    def _compile_has(self, resource_type, param, value):
+        """_has:Type:element:param (param 可再為 _has, 即巢狀反向鏈結)"""
+        parts = param.split(':', 3)
+        if len(parts) != 4 or not all(parts[1:]):
+            raise ValueError(f"Invalid _has parameter: {param}")
+        _, source_type, name, inner_param = parts
+        element, _ = self._reference_param(source_type, name)
+
+        def resolve():
+            return self._resolve_has(resource_type, source_type, element, inner_param, value)
+        return JoinPredicate(param, None, value, None, None, resolve)
+
+    def _resolve_has(self, resource_type, source_type, element, inner_param, value):
+        """內層搜尋得到來源 id, 再經正向參照索引取出其參照的外層資源 id"""
+        prefix = f"{resource_type}/"
+        source_ids = self._search_ids(source_type, {inner_param: [value]})
+        targets = self.references.targets_many(source_type, source_ids, element)
+        return self._live_ids(resource_type, {target[len(prefix):] for target in targets if target.startswith(prefix)})
+
+    def _live_ids(self, resource_type, ids):
+        """只保留 store 中存在的 id; 參照可能指向不存在的資源, join 結果須取交集才是確切筆數"""
+        order = self.orders.get(resource_type)
+        if order is None or not ids:
+            return set()
+        return {resource_id for _, resource_id in order.sort(ids)}
+
+    def matches(self, resource_type, resource, params):
+        """單筆資源是否符合搜尋條件 (不經索引), 供比對尚未寫入 store 的資源"""
+        compiled = self._compile_query(resource_type, params)
+        for predicate in compiled.predicates:
+            if isinstance(predicate, JoinPredicate):
+                ids = predicate.resolve()
+                if ids is not None:
+                    if resource.get("id") not in ids:
+                        return False
+                    continue
+            if not predicate.matches(resource):
+                return False
+        return True
+
+    def _search_ids(self, resource_type, params):
+        """不分頁地取得符合條件的全部 id, 供 join 的內層搜尋使用"""
+        compiled = self._compile_query(resource_type, params)
+        plan = self.planner.plan(compiled, self.indexes.get(resource_type))
+        return {resource_id for _, resource_id, _ in self._iter_matches(resource_type, plan)[0]}
+
+    def _iter_matches(self, resource_type, plan, after=None):
+        """執行查詢計畫, 回傳 (依寫入順序產生 (序號, id, 資源) 的 generator, 候選數, 候選是否即為結果)"""
+        partition = self.resources.get(resource_type, {})
+        order = self.orders.get(resource_type)
+        ids, residual = plan.execute(self.indexes.get(resource_type))
+        if order is None:
+            return iter(()), 0, True
+
+        if ids is None:
+            candidates = order.scan(after)
+            candidate_total = len(partition)
+        else:
+            candidates = order.sort(ids, after)
+            candidate_total = len(ids)
+        return self._filter_candidates(partition, candidates, residual), candidate_total, not residual
 
-        # 處理 _revinclude
-        for revinclude_param in revinclude_params:
-            # 格式: ResourceType:search-parameter
-            try:
-                resource_type, search_param = revinclude_param.split(':')
-                for resource in resources:
-                    resource_ref = f"{resource['resourceType']}/{resource['id']}"
-                    if resource_type in self.references and resource_ref in self.references[resource_type]:
-                        for ref in self.references[resource_type][resource_ref]:
-                            if ref in self.resources:
-                                included.add(ref)
-            except ValueError:
+    def _result_versions(self, compiled):
+        """結果所依賴各類型的寫入計數, 任一變動即表示快取失效"""
+        if compiled.joins:
+            # join 的目標類型可能依資料推斷, 以所有類型的計數判斷
+            return tuple(sorted(self.write_versions.items()))
+        return ((compiled.resource_type, self.version(compiled.resource_type)),)
+
+    def _cached_result(self, compiled):
+        if self.result_cache is None:
+            return None
+        return self.result_cache.get(compiled.key, self._result_versions(compiled))
+
+    def _fill_result_cache(self, compiled, matches, candidate_total, exact):
+        """結果數在單筆上限內時完整算出並存入快取; 超過上限則維持逐筆產生"""
+        versions = self._result_versions(compiled)
+        limit = self.result_cache.max_entry_items
+        head = list(islice(matches, limit + 1))
+        if len(head) > limit:
+            return chain(head, matches), candidate_total, exact
+        self.result_cache.put(compiled.key, versions, [(seq, resource_id) for seq, resource_id, _ in head])
+        return iter(head), len(head), True
+
+    def _iter_cached(self, resource_type, cached, after=None):
+        partition = self.resources.get(resource_type, {})
+        for seq, resource_id in cached.after(after):
+            resource = partition.get(resource_id)
+            if resource is not None:
+                yield seq, resource_id, resource
+
+    def _filter_candidates(self, partition, candidates, residual):
+        """逐筆套用剩餘條件, 由呼叫端決定取用多少筆"""
+        for seq, resource_id in candidates:
+            resource = partition.get(resource_id)
+            if resource is None:
                 continue
+            if all(predicate.matches(resource) for predicate in residual):
+                yield seq, resource_id, resource
 
-        return [self.resources[ref] for ref in included]
-
-    def _extract_references(self, resource, search_param):
-        """從資源中提取參照"""
-        references = set()
-        
-        def extract(obj, path=""):
-            if isinstance(obj, dict):
-                for k, v in obj.items():
-                    if k == search_param and "reference" in v:
-                        references.add(v["reference"])
-                    elif isinstance(v, (dict, list)):
-                        extract(v, f"{path}.{k}" if path else k)
-            elif isinstance(obj, list):
-                for item in obj:
-                    extract(item, path)
-        
-        extract(resource)
-        return references
-
-    def _apply_search_filters(self, resources, params):
-        """應用搜索過濾器"""
-        filtered = resources.copy()
-        
-        # 移除特殊參數
-        special_params = {'_page', '_count', '_include', '_revinclude'}
-        search_params = {k: v for k, v in params.items() if k not in special_params}
-        
-        for param, values in search_params.items():
-            filtered = self._filter_by_param(filtered, param, values[0])
-            
-        return filtered
+    def _count_matches(self, resource_type, params):
+        """計算符合筆數, 條件皆有索引時不取出資源"""
+        compiled = self._compile_query(resource_type, params)
+        index = self.indexes.get(resource_type)
+        if not compiled.predicates:
+            return self.count(resource_type)
+        if len(compiled.predicates) == 1 and index is not None:
+            predicate = compiled.predicates[0]
+            if predicate.op is not None and not compiled.joins:
+                total = index.count(predicate.param, predicate.op, predicate.value)
+                if total is not None:
+                    return total
+        matches, candidate_total, exact = self._iter_matches(resource_type, self.planner.plan(compiled, index))
+        if exact:
+            return candidate_total
+        return sum(1 for _ in matches)
 
-    def _filter_by_param(self, resources, param, value):
-        """根據參數過濾資源"""
-        filtered = []
-        
-        # 解析搜索修飾符
+    def _parse_param(self, param):
+        """解析搜索修飾符, 回傳 (參數, 修飾符)"""
         param_parts = param.split(':')
-        base_param = param_parts[0]
         modifier = param_parts[1] if len(param_parts) > 1 else None
-        
-        for resource in resources:
-            if self._match_param(resource, base_param, value, modifier):
-                filtered.append(resource)
-                
-        return filtered
+        return param_parts[0], modifier
 
     def _match_param(self, resource, param, value, modifier=None):
-        """匹配參數值"""
-        if '.' in param:
-            # 處理複雜參數
-            base, sub_param = param.split('.', 1)
-            return self._match_complex_param(resource, base, sub_param, value, modifier)
-        else:
-            # 處理簡單參數
-            return self._match_simple_param(resource, param, value, modifier)
-
-    def _match_complex_param(self, resource, base, sub_param, value, modifier=None):
-        """匹配複雜參數"""
-        if base not in resource:
-            return False
-            
-        if isinstance(resource[base], list):
-            for item in resource[base]:
-                if self._match_value(item.get(sub_param), value, modifier):
-                    return True
-        elif isinstance(resource[base], dict):
-            return self._match_value(resource[base].get(sub_param), value, modifier)
-            
-        return False
-
-    def _match_simple_param(self, resource, param, value, modifier=None):
-        """匹配簡單參數"""
-        if param not in resource:
-            return False
-        return self._match_value(resource[param], value, modifier)
+        """匹配參數值, 參數可為 name.given 這類巢狀路徑"""
+        return self._compile_predicate(param, modifier, value).matches(resource)
 
     def _match_value(self, field_value, search_value, modifier=None):
         """根據不同的修飾符匹配值"""
         if field_value is None:
             return False
+        if modifier == 'missing':
+            return (search_value.lower() == 'true') == (field_value is None)
+        return self._value_matcher(search_value, modifier)(field_value)
 
-        # 處理不同的修飾符
+    def _value_matcher(self, search_value, modifier=None):
+        """依修飾符預先處理搜尋值, 回傳比對單一欄位值的函式"""
         if modifier == 'exact':
-            return str(field_value) == search_value
-        elif modifier == 'contains':
-            return search_value.lower() in str(field_value).lower()
-        elif modifier == 'missing':
-            return (search_value.lower() == 'true') == (field_value is None)
+            return lambda field_value: str(field_value) == search_value
         elif modifier in ['gt', 'ge', 'lt', 'le']:
-            return self._compare_values(field_value, search_value, modifier)
+            return self._range_matcher(search_value, modifier)
         elif modifier == 'below':
             # 處理層級式編碼
-            return str(field_value).startswith(search_value)
+            return lambda field_value: str(field_value).startswith(search_value)
         else:
-            # 默認使用模糊匹配
-            try:
-                pattern = f".*{re.escape(search_value)}.*"
-                return re.match(pattern, str(field_value), re.IGNORECASE) is not None
-            except (TypeError, AttributeError):
-                return False
+            # contains 與默認的模糊匹配 (不分大小寫的子字串)
+            needle = search_value.lower()
+            return lambda field_value: needle in str(field_value).lower()
+
+    def _range_matcher(self, search_value, modifier):
+        """數值或日期比較; 搜尋值只正規化一次, 欄位值以相同方式正規化後比較區間"""
+        search_ranges = []
+        for parse in (parse_number, parse_date):
+            search_range = parse(search_value)
+            if search_range is not None:
+                search_ranges.append((parse, search_range))
+
+        def matches(field_value):
+            for parse, search_range in search_ranges:
+                field_range = parse(field_value)
+                if field_range is not None:
+                    return compare_range(field_range, search_range, modifier)
+            return self._compare_dates(field_value, search_value, modifier)
+        return matches
 
     def _compare_values(self, field_value, search_value, modifier):
         """比較數值或日期"""
+        return self._range_matcher(search_value, modifier)(field_value)
+
+    def _compare_dates(self, field_value, search_value, modifier):
+        """非 FHIR 格式的日期仍以 dateutil 解析"""
         try:
-            # 嘗試作為數值比較
-            field_num = float(field_value)
-            search_num = float(search_value)
+            field_date = date_parser.parse(str(field_value))
+            search_date = date_parser.parse(search_value)
             
             if modifier == 'gt':
-                return field_num > search_num
+                return field_date > search_date
             elif modifier == 'ge':
-                return field_num >= search_num
+                return field_date >= search_date
             elif modifier == 'lt':
-                return field_num < search_num
+                return field_date < search_date
             elif modifier == 'le':
-                return field_num <= search_num
-                
-        except (ValueError, TypeError):
-            try:
-                # 嘗試作為日期比較
-                field_date = date_parser.parse(str(field_value))
-                search_date = date_parser.parse(search_value)
+                return field_date <= search_date
                 
-                if modifier == 'gt':
-                    return field_date > search_date
-                elif modifier == 'ge':
-                    return field_date >= search_date
-                elif modifier == 'lt':
-                    return field_date < search_date
-                elif modifier == 'le':
-                    return field_date <= search_date
-                    
-            except (ValueError, TypeError):
-                return False
+        except (ValueError, TypeError, OverflowError):
+            return False